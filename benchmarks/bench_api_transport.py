@@ -0,0 +1,109 @@
+"""
+对比 pixivpy3 (requests + 线程池) 与 aiohttp 传输层的 API 调用性能。
+
+在本地启动一个模拟 app-api 的服务器，分别用两种传输层并发调用 illust_detail，
+输出 calls/sec 与 p50/p99 延迟。
+
+用法:
+    python benchmarks/bench_api_transport.py --calls 2000 --concurrency 64 --delay-ms 5
+"""
+import argparse
+import asyncio
+import statistics
+import sys
+import time
+from pathlib import Path
+
+from aiohttp import web
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from pixivpy3 import AppPixivAPI  # noqa: E402
+
+from pixiv_mcp_server.api_client import PixivAPIClient  # noqa: E402
+from pixiv_mcp_server.rate_limiter import AdaptiveRateLimiter  # noqa: E402
+from pixiv_mcp_server.state import state  # noqa: E402
+from pixiv_mcp_server.transport import AiohttpTransport  # noqa: E402
+
+
+def build_fake_app_api(delay_ms: float) -> web.Application:
+    async def illust_detail(request: web.Request) -> web.Response:
+        if delay_ms:
+            await asyncio.sleep(delay_ms / 1000)
+        illust_id = int(request.query.get('illust_id', 0))
+        return web.json_response({
+            'illust': {
+                'id': illust_id,
+                'title': f'bench-{illust_id}',
+                'type': 'illust',
+                'page_count': 1,
+                'user': {'id': 1, 'name': 'bench'},
+                'tags': [{'name': 'bench'}],
+                'meta_single_page': {'original_image_url': 'https://i.pximg.net/img-original/x.png'},
+            }
+        })
+
+    app = web.Application()
+    app.add_routes([web.get('/v1/illust/detail', illust_detail)])
+    return app
+
+
+async def run_transport(client: PixivAPIClient, calls: int, concurrency: int) -> dict:
+    latencies = []
+    sem = asyncio.Semaphore(concurrency)
+
+    async def one(i: int):
+        async with sem:
+            start = time.perf_counter()
+            result = await client.illust_detail(i)
+            latencies.append(time.perf_counter() - start)
+            assert result['illust']['id'] == i
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(calls)))
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        'calls_per_sec': calls / elapsed,
+        'p50_ms': statistics.median(latencies) * 1000,
+        'p99_ms': latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000,
+    }
+
+
+async def main(args) -> None:
+    runner = web.AppRunner(build_fake_app_api(args.delay_ms))
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+
+    api = AppPixivAPI()
+    api.hosts = f'http://127.0.0.1:{port}'
+    api.access_token = 'bench-token'
+    # 关闭全局限流器，否则两种传输层都会被钉在 RATE_LIMIT_PER_SECOND，测不出传输层本身的差异
+    state.rate_limiter = AdaptiveRateLimiter(rate=0, burst=1)
+
+    results = {}
+    results['requests'] = await run_transport(PixivAPIClient(api), args.calls, args.concurrency)
+
+    transport = AiohttpTransport(api, pool_size=args.concurrency, pool_per_host=args.concurrency)
+    client = PixivAPIClient(api, transport=transport)
+    try:
+        results['aiohttp'] = await run_transport(client, args.calls, args.concurrency)
+    finally:
+        await client.aclose()
+        await runner.cleanup()
+
+    print(f"calls={args.calls} concurrency={args.concurrency} server_delay={args.delay_ms}ms")
+    print(f"{'transport':<10} {'calls/sec':>10} {'p50 ms':>9} {'p99 ms':>9}")
+    for name, r in results.items():
+        print(f"{name:<10} {r['calls_per_sec']:>10.1f} {r['p50_ms']:>9.2f} {r['p99_ms']:>9.2f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--calls', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=64)
+    parser.add_argument('--delay-ms', type=float, default=5.0)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,132 @@
+"""
+对比预览代理的两种上游连接方式：每个请求新建 ClientSession（旧实现），与整个应用共享一个连接池。
+
+在本地启动一个模拟 i.pximg.net 的图片服务器（通过自定义解析器将图片域名解析到 127.0.0.1），
+模拟客户端渲染卡片列表时并发请求 N 张缩略图，重复若干轮，
+输出 p50/p99 延迟、吞吐量（张/秒）以及上游实际建立的连接数。
+--connect-delay-ms 在每次新建连接的解析阶段等待，用于模拟真实网络中 DNS 与 TLS 握手的往返耗时。
+
+用法:
+    python benchmarks/bench_preview_proxy.py --images 30 --rounds 10 --size-kb 40 --connect-delay-ms 30
+"""
+import argparse
+import asyncio
+import os
+import socket
+import statistics
+import sys
+import time
+from pathlib import Path
+
+from aiohttp import ClientSession, ClientTimeout, TCPConnector, web
+from aiohttp.abc import AbstractResolver
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from pixiv_mcp_server.preview_proxy import ProxyContext, create_preview_app  # noqa: E402
+
+IMAGE_HOST = 'i.pximg.net'
+
+
+class LocalResolver(AbstractResolver):
+    """将所有主机解析到 127.0.0.1，并模拟建立新连接的耗时。"""
+
+    def __init__(self, delay_ms: float):
+        self.delay = delay_ms / 1000
+        self.lookups = 0
+
+    async def resolve(self, host, port=0, family=socket.AF_INET):
+        self.lookups += 1
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        return [{
+            'hostname': host, 'host': '127.0.0.1', 'port': port,
+            'family': socket.AF_INET, 'proto': 0, 'flags': socket.AI_NUMERICHOST,
+        }]
+
+    async def close(self) -> None:
+        pass
+
+
+def build_image_server(size_kb: int, peers: set) -> web.Application:
+    body = os.urandom(size_kb * 1024)
+
+    async def image(request: web.Request) -> web.Response:
+        peers.add(request.transport.get_extra_info('peername'))
+        return web.Response(body=body, content_type='image/jpeg')
+
+    app = web.Application()
+    app.add_routes([web.get('/{tail:.*}', image)])
+    return app
+
+
+def build_legacy_app(resolver: LocalResolver) -> web.Application:
+    """旧实现：每个请求新建 ClientSession 与连接器。"""
+    async def handler(request: web.Request) -> web.Response:
+        async with ClientSession(connector=TCPConnector(resolver=resolver), timeout=ClientTimeout(total=30)) as session:
+            async with session.get(request.query['url']) as resp:
+                content = await resp.read()
+                return web.Response(body=content, content_type=resp.content_type, status=resp.status)
+
+    app = web.Application()
+    app.add_routes([web.get('/pximg', handler)])
+    return app
+
+
+async def serve(app: web.Application):
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    return runner, site._server.sockets[0].getsockname()[1]
+
+
+async def run_proxy(name: str, app: web.Application, image_port: int, args, peers: set, resolver: LocalResolver) -> None:
+    runner, port = await serve(app)
+    peers.clear()
+    resolver.lookups = 0
+    latencies = []
+    async with ClientSession() as client:
+        async def fetch(i: int) -> None:
+            url = f'http://{IMAGE_HOST}:{image_port}/c/250x250_80_a2/img-master/img/2024/01/01/00/00/00/{i}_p0_square1200.jpg'
+            start = time.perf_counter()
+            async with client.get(f'http://127.0.0.1:{port}/pximg', params={'url': url}) as resp:
+                await resp.read()
+                assert resp.status == 200, resp.status
+            latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        for r in range(args.rounds):
+            await asyncio.gather(*(fetch(r * args.images + i) for i in range(args.images)))
+        elapsed = time.perf_counter() - start
+    await runner.cleanup()
+
+    latencies.sort()
+    total = args.rounds * args.images
+    print(
+        f"{name:>8}: {total / elapsed:8.1f} 张/秒  p50 {statistics.median(latencies) * 1000:7.1f} ms  "
+        f"p99 {latencies[min(total - 1, int(total * 0.99))] * 1000:7.1f} ms  "
+        f"上游连接 {len(peers)}  解析 {resolver.lookups} 次"
+    )
+
+
+async def main(args) -> None:
+    peers: set = set()
+    image_runner, image_port = await serve(build_image_server(args.size_kb, peers))
+    resolver = LocalResolver(args.connect_delay_ms)
+    print(
+        f"{args.rounds} 轮 × {args.images} 张并发缩略图，每张 {args.size_kb} KiB，"
+        f"新建连接耗时 {args.connect_delay_ms} ms"
+    )
+    await run_proxy('per-req', build_legacy_app(resolver), image_port, args, peers, resolver)
+    await run_proxy('pooled', create_preview_app(ProxyContext(None, resolver=resolver)), image_port, args, peers, resolver)
+    await image_runner.cleanup()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--images', type=int, default=30)
+    parser.add_argument('--rounds', type=int, default=10)
+    parser.add_argument('--size-kb', type=int, default=40)
+    parser.add_argument('--connect-delay-ms', type=float, default=30)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,110 @@
+"""
+验证 StreamDownloader 的断点续传：本地服务器在传输中途主动断开连接，下载器应通过 Range 请求续传，
+最终文件与原始内容逐字节一致，且内存占用与文件大小无关。
+
+服务器支持 Range 与 If-Range（ETag）；前 --drops 个响应在发送 --drop-kb KiB 后直接关闭连接。
+输出续传次数、上游请求数、耗时与下载期间 Python 分配的内存峰值（tracemalloc）。
+
+用法:
+    python benchmarks/bench_stream_resume.py --size-mb 64 --drops 4 --drop-kb 4096
+"""
+import argparse
+import asyncio
+import hashlib
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+from aiohttp import web
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from pixiv_mcp_server.stream_download import StreamDownloader  # noqa: E402
+
+SEND_CHUNK = 64 * 1024
+
+
+def build_flaky_server(body: bytes, drops: int, drop_bytes: int, log: list) -> web.Application:
+    etag = '"%s"' % hashlib.sha256(body).hexdigest()[:16]
+
+    async def image(request: web.Request) -> web.StreamResponse:
+        start = 0
+        rng = request.http_range
+        # If-Range 与当前版本不符时忽略 Range，返回完整内容
+        if rng.start is not None and request.headers.get('If-Range') == etag:
+            start = rng.start
+        if start >= len(body):
+            return web.Response(status=416, headers={'Content-Range': f'bytes */{len(body)}'})
+        log.append(start)
+
+        status = 206 if start else 200
+        response = web.StreamResponse(status=status)
+        response.content_type = 'application/octet-stream'
+        response.content_length = len(body) - start
+        response.headers['ETag'] = etag
+        if status == 206:
+            response.headers['Content-Range'] = f'bytes {start}-{len(body) - 1}/{len(body)}'
+        await response.prepare(request)
+
+        # 前 drops 个响应只发送 drop_bytes 字节就断开连接
+        limit = len(body) if len(log) > drops else min(len(body), start + drop_bytes)
+        offset = start
+        while offset < limit:
+            end = min(offset + SEND_CHUNK, limit)
+            await response.write(body[offset:end])
+            offset = end
+        if limit < len(body):
+            request.transport.close()
+            return response
+        await response.write_eof()
+        return response
+
+    app = web.Application()
+    app.add_routes([web.get('/{tail:.*}', image)])
+    return app
+
+
+async def main(args) -> None:
+    # 不重复的内容，使续传位置的任何偏差都会体现在哈希上
+    body = random.Random(0).randbytes(args.size_mb * 1024 * 1024)
+    log: list = []
+    runner = web.AppRunner(build_flaky_server(body, args.drops, args.drop_kb * 1024, log))
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+
+    downloader = StreamDownloader(max_retries=args.drops + 1)
+    with tempfile.TemporaryDirectory() as tmp:
+        dest = Path(tmp) / 'original.bin'
+        tracemalloc.start()
+        started = time.perf_counter()
+        try:
+            await downloader.download(f'http://127.0.0.1:{port}/img-original/original.bin', dest)
+        finally:
+            elapsed = time.perf_counter() - started
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            await downloader.close()
+            await runner.cleanup()
+
+        identical = hashlib.sha256(dest.read_bytes()).digest() == hashlib.sha256(body).digest()
+        leftover = any(dest.parent.glob(dest.name + '.part*'))
+
+    print(f"文件 {args.size_mb} MiB，前 {args.drops} 个响应在 {args.drop_kb} KiB 后断开")
+    print(f"上游请求: {len(log)}  起始偏移: {log}")
+    print(f"Range 续传: {downloader.resumed}  耗时: {elapsed:.2f} s  内存峰值: {peak / 1024 / 1024:.2f} MiB")
+    print(f"内容一致: {identical}  残留 .part: {leftover}")
+    if not identical or leftover or downloader.resumed < args.drops:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size-mb', type=int, default=64)
+    parser.add_argument('--drops', type=int, default=4)
+    parser.add_argument('--drop-kb', type=int, default=4096)
+    asyncio.run(main(parser.parse_args()))
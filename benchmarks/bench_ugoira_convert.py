@@ -0,0 +1,123 @@
+"""
+对比动图 (ugoira) 的两种转换方式：解压帧到磁盘后用 concat 合成，与从 zip 直接管道送入 FFmpeg。
+
+用 Pillow 生成合成的 ugoira zip（帧时长不等），分别运行两种方式，
+输出耗时、临时写盘字节数，以及输出中每帧时长是否与元数据一致。
+需要 PATH 中可用的 ffmpeg。
+
+用法:
+    python benchmarks/bench_ugoira_convert.py --frames 60 --size 600 --runs 3 --format webp
+"""
+import argparse
+import asyncio
+import io
+import random
+import shutil
+import statistics
+import struct
+import sys
+import tempfile
+import time
+import zipfile
+from pathlib import Path
+
+from PIL import Image
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from pixiv_mcp_server.downloader import _pipe_convert_ugoira, _sync_convert_ugoira  # noqa: E402
+
+
+def build_ugoira_zip(path: Path, frame_count: int, size: int) -> list:
+    """生成带噪点的 JPEG 帧，帧时长从常见取值中随机选择。"""
+    rng = random.Random(0)
+    frames = []
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_STORED) as zf:
+        for i in range(frame_count):
+            im = Image.effect_noise((size, size), 40 + i % 30).convert('RGB')
+            buf = io.BytesIO()
+            im.save(buf, 'JPEG', quality=90)
+            name = f'{i:06d}.jpg'
+            zf.writestr(name, buf.getvalue())
+            frames.append({'file': name, 'delay': rng.choice([40, 60, 80, 100, 120])})
+    return frames
+
+
+def extracted_bytes(zip_path: Path, frames: list) -> int:
+    """磁盘模式写入临时目录的字节数：全部帧文件加 concat 列表。"""
+    with zipfile.ZipFile(zip_path) as zf:
+        total = sum(info.file_size for info in zf.infolist())
+    listing = ''.join(f"file '{f['file']}'\nduration {f['delay'] / 1000.0}\n" for f in frames)
+    return total + len(listing.encode('utf-8'))
+
+
+def webp_durations(path: Path) -> list:
+    """读取动画 WebP 中每个 ANMF 块的帧时长（毫秒）。"""
+    data = path.read_bytes()
+    durations, i = [], 12
+    while i + 8 <= len(data):
+        tag = data[i:i + 4]
+        size = struct.unpack('<I', data[i + 4:i + 8])[0]
+        if tag == b'ANMF':
+            durations.append(int.from_bytes(data[i + 20:i + 23], 'little'))
+        i += 8 + size + (size & 1)
+    return durations
+
+
+def gif_durations(path: Path) -> list:
+    with Image.open(path) as im:
+        durations = []
+        for i in range(im.n_frames):
+            im.seek(i)
+            durations.append(im.info.get('duration'))
+    return durations
+
+
+async def run_mode(name: str, convert, source_zip: Path, frames: list, work: Path, fmt: str, runs: int) -> None:
+    times = []
+    output = work / f'out-{name}.{fmt}'
+    for _ in range(runs):
+        zip_path = work / f'input-{name}.zip'
+        shutil.copyfile(source_zip, zip_path)  # 转换结束后 zip 会被删除
+        if output.exists():
+            output.unlink()
+        start = time.perf_counter()
+        await convert(
+            zip_path=str(zip_path), frames=frames, work_dir=str(work),
+            output_path=str(output), format=fmt,
+        )
+        times.append(time.perf_counter() - start)
+
+    temp_bytes = extracted_bytes(source_zip, frames) if name == 'disk' else 0
+    line = (
+        f"{name:>5}: median {statistics.median(times):.2f}s  min {min(times):.2f}s  "
+        f"temp written {temp_bytes / 1024 / 1024:.1f} MiB  output {output.stat().st_size / 1024:.0f} KiB"
+    )
+    expected = [f['delay'] for f in frames]
+    durations = webp_durations(output) if fmt == 'webp' else gif_durations(output)
+    line += f"  timing exact: {durations == expected}"
+    print(line)
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--frames', type=int, default=60)
+    parser.add_argument('--size', type=int, default=600)
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--format', choices=['webp', 'gif'], default='webp')
+    args = parser.parse_args()
+
+    if shutil.which('ffmpeg') is None:
+        sys.exit('需要 PATH 中可用的 ffmpeg')
+
+    with tempfile.TemporaryDirectory() as tmp:
+        work = Path(tmp)
+        source_zip = work / 'source.zip'
+        frames = build_ugoira_zip(source_zip, args.frames, args.size)
+        print(f"{args.frames} 帧 {args.size}x{args.size}，zip {source_zip.stat().st_size / 1024 / 1024:.1f} MiB，格式 {args.format}")
+        await run_mode('disk', _sync_convert_ugoira, source_zip, frames, work, args.format, args.runs)
+        await run_mode('pipe', _pipe_convert_ugoira, source_zip, frames, work, args.format, args.runs)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,71 @@
+"""
+对比动图 (ugoira) 的 FFmpeg 管道编码与 Pillow 进程池备用编码器。
+
+生成一批合成的 ugoira zip，按 CPU_BOUND_SEMAPHORE 的并发度同时转换，
+输出吞吐量（作品/秒）与平均输出大小。FFmpeg 不在 PATH 中时只测 Pillow。
+
+用法:
+    python benchmarks/bench_ugoira_encoders.py --works 8 --frames 30 --size 600 --workers 4 --format webp
+"""
+import argparse
+import asyncio
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from bench_ugoira_convert import build_ugoira_zip  # noqa: E402
+
+from pixiv_mcp_server.config import settings  # noqa: E402
+from pixiv_mcp_server.downloader import _pillow_convert_ugoira, _pipe_convert_ugoira  # noqa: E402
+from pixiv_mcp_server.state import state  # noqa: E402
+from pixiv_mcp_server.ugoira_encoder import shutdown_executor  # noqa: E402
+
+
+async def run_encoder(name: str, convert, source_zip: Path, frames: list, work: Path, works: int, fmt: str) -> None:
+    jobs = []
+    for i in range(works):
+        zip_path = work / f'{name}-{i}.zip'
+        shutil.copyfile(source_zip, zip_path)  # 转换结束后 zip 会被删除
+        jobs.append((str(zip_path), str(work / f'{name}-{i}.{fmt}')))
+
+    start = time.perf_counter()
+    await asyncio.gather(*(
+        convert(zip_path=zip_path, frames=frames, work_dir=str(work), output_path=output, format=fmt)
+        for zip_path, output in jobs
+    ))
+    elapsed = time.perf_counter() - start
+    avg_size = sum(Path(output).stat().st_size for _, output in jobs) / works
+    print(f"{name:>7}: {works / elapsed:.2f} 作品/秒  总耗时 {elapsed:.2f}s  平均输出 {avg_size / 1024:.0f} KiB")
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--works', type=int, default=8)
+    parser.add_argument('--frames', type=int, default=30)
+    parser.add_argument('--size', type=int, default=600)
+    parser.add_argument('--workers', type=int, default=settings.cpu_bound_semaphore)
+    parser.add_argument('--format', choices=['webp', 'gif'], default='webp')
+    args = parser.parse_args()
+
+    settings.cpu_bound_semaphore = args.workers
+    state.cpu_bound_semaphore.resize(args.workers)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        work = Path(tmp)
+        source_zip = work / 'source.zip'
+        frames = build_ugoira_zip(source_zip, args.frames, args.size)
+        print(f"{args.works} 个作品 × {args.frames} 帧 {args.size}x{args.size}，并发 {args.workers}，格式 {args.format}")
+        if shutil.which('ffmpeg'):
+            await run_encoder('ffmpeg', _pipe_convert_ugoira, source_zip, frames, work, args.works, args.format)
+        else:
+            print(" ffmpeg: 未在 PATH 中找到，跳过")
+        await run_encoder('pillow', _pillow_convert_ugoira, source_zip, frames, work, args.works, args.format)
+    shutdown_executor()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
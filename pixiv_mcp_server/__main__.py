@@ -1,5 +1,6 @@
 import logging
 import os
+import time
 import urllib3
 import json
 from pathlib import Path
@@ -75,6 +76,7 @@ def setup_environment():
 
 def main():
     """主函数：初始化并执行服务器"""
+    state.started_at = time.perf_counter()
     # 步骤 1: 配置日志
     logging.basicConfig(
         level=logging.INFO,
@@ -92,10 +94,12 @@ def main():
     # 启动本地预览代理（后台线程）
     if state.preview_proxy_enabled:
         try:
-            start_preview_proxy(
+            state.preview_proxy = start_preview_proxy(
                 host=state.preview_proxy_host, 
                 port=state.preview_proxy_port,
-                proxy=settings.https_proxy
+                proxy=settings.https_proxy,
+                bandwidth=state.bandwidth_limiter,
+                cache_dir=settings.preview_cache_dir if settings.preview_cache_enabled else None,
             )
         except Exception as e:
             logger.warning(f"预览代理启动失败: {e}")
@@ -114,22 +118,18 @@ def main():
     )
 
     # 步骤 4: 自动认证 (仅依赖环境变量或.env文件)
+    # 优先复用本地缓存的 access token；否则由后台刷新任务完成认证，不阻塞 stdio 循环
     if state.refresh_token:
-        logger.info("检测到 refresh_token，正在尝试自动认证...")
-        try:
-            # 注意：这里的 state.api 是在 initialize_api_client 中创建的
-            state.api.auth(refresh_token=state.refresh_token)
-            state.is_authenticated = True
-            state.user_id = state.api.user_id
-            logger.info(f"自动认证成功！用户ID: {state.user_id}")
-        except Exception as e:
-            state.is_authenticated = False
-            logger.warning(f"自动认证失败: {e}")
-            logger.warning("将以匿名模式运行。请检查 REFRESH_TOKEN 是否有效或网络/代理设置。")
+        if state.token_refresher.restore():
+            logger.info(f"已从本地缓存恢复 access token。用户ID: {state.user_id}")
+        else:
+            logger.info("检测到 refresh_token，将在后台进行自动认证...")
     else:
         state.is_authenticated = False
         logger.info("未在环境中找到 refresh_token，将以匿名模式运行。")
 
+    logger.info(f"启动准备耗时: {(time.perf_counter() - state.started_at) * 1000:.0f} ms")
+
     # 步骤 5: 运行服务器
     mcp.run(transport="stdio")
     logger.info("Pixiv MCP 服务器已停止。")
@@ -1,10 +1,15 @@
 import asyncio
+import json
 import logging
-from typing import Optional, Any, Dict
-
-from pixivpy3 import PixivError
+from typing import Optional, Any, AsyncIterator, Dict
 
+from .auth import TokenRefresher
+from .cache import READ_ONLY_METHODS, ResponseCache, make_call_key
+from .config import settings
+from .rate_limiter import RateLimitedError, is_rate_limited_response
+from .singleflight import SingleFlight
 from .state import state
+from .transport import AiohttpTransport
 
 logger = logging.getLogger('pixiv-mcp-server')
 
@@ -12,19 +17,86 @@ class PixivAPIClient:
     """
     一个封装了 pixivpy3 API 调用的异步客户端。
     它将同步的 pixivpy3 方法转换为异步方法，以便在 asyncio 环境中使用。
+    配置了 transport 时，受支持的 app-api 方法改由原生 aiohttp 传输层发送；
+    配置了 cache 时，只读方法的成功响应会按方法 TTL 缓存；
+    相同参数的并发只读调用会被合并为一次上游请求。
     """
 
-    def __init__(self, api):
+    def __init__(self, api, transport: Optional[AiohttpTransport] = None, cache: Optional[ResponseCache] = None):
         self.api = api
+        self.transport = transport
+        self.cache = cache
+        self.single_flight = SingleFlight()
+
+    async def _invoke_once(self, method_name: str, *args, **kwargs) -> Dict[str, Any]:
+        """执行一次原始调用：优先使用异步传输层，否则回退到 pixivpy3 线程调用。"""
+        if self.transport and self.transport.supports(method_name):
+            return await self.transport.call(method_name, *args, **kwargs)
+        method = getattr(self.api, method_name)
+        return await asyncio.to_thread(method, *args, **kwargs)
+
+    async def _invoke(self, method_name: str, *args, **kwargs) -> Dict[str, Any]:
+        """
+        受全局限流器约束地执行原始调用。
+        遇到限流响应时通知限流器降速，并按带抖动的指数退避重试。
+        """
+        limiter = state.rate_limiter
+        max_retries = settings.rate_limit_max_retries
+        for attempt in range(max_retries + 1):
+            await limiter.acquire()
+            try:
+                result = await self._invoke_once(method_name, *args, **kwargs)
+            except RateLimitedError:
+                limiter.on_throttle()
+                if attempt >= max_retries:
+                    raise
+            else:
+                if not is_rate_limited_response(result):
+                    limiter.on_success()
+                    return result
+                limiter.on_throttle()
+                if attempt >= max_retries:
+                    return result
+            delay = limiter.backoff_delay(attempt)
+            logger.warning(f"{method_name} 触发限流，{delay:.1f} 秒后重试 ({attempt + 1}/{max_retries})，当前速率 {limiter.rate:.2f}/s")
+            await asyncio.sleep(delay)
 
     async def _call_api_with_auth_refresh(self, method_name: str, *args, **kwargs) -> Dict[str, Any]:
+        """
+        通用 API 调用入口：只读方法先查询响应缓存，未命中时通过 single-flight
+        合并相同的并发调用，再发起带认证刷新的请求。错误响应与异常永远不会被缓存。
+        """
+        if method_name not in READ_ONLY_METHODS:
+            return await self._request_with_auth_refresh(method_name, *args, **kwargs)
+
+        key = make_call_key(method_name, args, kwargs, state.user_id)
+        use_cache = self.cache is not None and self.cache.cacheable(method_name)
+        if use_cache:
+            payload = self.cache.get(key)
+            if payload is not None:
+                return self.api.parse_json(payload)
+
+        async def fetch() -> Dict[str, Any]:
+            result = await self._request_with_auth_refresh(method_name, *args, **kwargs)
+            if use_cache and isinstance(result, dict) and result and 'error' not in result:
+                self.cache.put(key, method_name, json.dumps(result, ensure_ascii=False).encode('utf-8'))
+            return result
+
+        return await self.single_flight.do(key, fetch)
+
+    async def _request_with_auth_refresh(self, method_name: str, *args, **kwargs) -> Dict[str, Any]:
         """
         一个封装了认证刷新逻辑的通用 API 调用方法。
         它同时处理异常和包含 'error' 键的返回字典。
+        正常情况下 token 由 TokenRefresher 在过期前主动刷新，这里的被动刷新仅作为兜底。
         """
-        # 首次尝试调用
-        method = getattr(self.api, method_name)
-        result = await asyncio.to_thread(method, *args, **kwargs)
+        # 启动时认证在后台进行，尚无 token 的调用先等待其完成
+        if self.api.access_token is None and state.refresh_token and state.token_refresher:
+            await state.token_refresher.wait_ready()
+
+        # 记录本次调用使用的 token，用于判断失败后是否已被其他调用者刷新
+        token_used = self.api.access_token
+        result = await self._invoke(method_name, *args, **kwargs)
 
         # 检查返回结果是否为错误
         if isinstance(result, dict) and 'error' in result:
@@ -33,20 +105,12 @@ class PixivAPIClient:
             # 检查是否是认证相关的错误
             if ('token' in error_message or 'authenticate' in error_message or 'oauth' in error_message) and state.refresh_token:
                 logger.info("Access token 可能已过期或无效，正在尝试刷新...")
-                async with state.auth_lock:
-                    try:
-                        # 重新认证
-                        await asyncio.to_thread(self.api.auth, refresh_token=state.refresh_token)
-                        logger.info("Token 刷新成功。")
-                        state.is_authenticated = True
-                        # 再次调用原始方法
-                        method = getattr(self.api, method_name)
-                        return await asyncio.to_thread(method, *args, **kwargs)
-                    except PixivError as refresh_e:
-                        logger.error(f"刷新 token 失败: {refresh_e}")
-                        state.is_authenticated = False
-                        # 即使刷新失败，也返回原始的错误信息
-                        return result
+                if state.token_refresher and await state.token_refresher.refresh(stale_token=token_used):
+                    # 再次调用原始方法
+                    return await self._invoke(method_name, *args, **kwargs)
+                state.is_authenticated = False
+                # 即使刷新失败，也返回原始的错误信息
+                return result
             else:
                 # 如果不是认证错误，则直接返回错误信息
                 return result
@@ -93,11 +157,61 @@ class PixivAPIClient:
     async def ugoira_metadata(self, illust_id: int) -> Dict[str, Any]:
         return await self._call_api_with_auth_refresh('ugoira_metadata', illust_id)
 
+    async def iter_pages(self, method_name: str, *args, max_pages: Optional[int] = None, **kwargs) -> AsyncIterator[Dict[str, Any]]:
+        """
+        逐页迭代列表类接口：按响应中的 next_url 翻页，每取到一页立即产出，不会预先取完整个列表。
+        出错时产出该错误响应后结束。
+        """
+        pages = 0
+        while True:
+            result = await self._call_api_with_auth_refresh(method_name, *args, **kwargs)
+            yield result
+            pages += 1
+            next_url = result.get('next_url') if isinstance(result, dict) and 'error' not in result else None
+            if not next_url or (max_pages is not None and pages >= max_pages):
+                return
+            # next_url 的查询参数已包含位置参数（如 word、user_id），翻页时全部改为关键字传入
+            args, kwargs = (), self.api.parse_qs(next_url)
+
     async def download(self, url: str, **kwargs) -> None:
         return await self._call_api_with_auth_refresh('download', url, **kwargs)
 
+    def stats(self) -> Dict[str, Any]:
+        """返回客户端层面的运行统计。"""
+        return {
+            "transport": "aiohttp" if self.transport else "requests",
+            "cache": self.cache.stats() if self.cache else None,
+            "single_flight": self.single_flight.stats(),
+            "token": state.token_refresher.stats() if state.token_refresher else None,
+        }
+
+    async def aclose(self) -> None:
+        """释放异步传输层持有的连接池。"""
+        if self.transport:
+            await self.transport.close()
+
 # 在 state 中初始化一个全局的 API 客户端实例
 # 这将在服务器启动时完成
 def initialize_api_client():
     if state.api:
-        state.api_client = PixivAPIClient(state.api)
+        state.token_refresher = TokenRefresher(
+            state.api,
+            margin=settings.token_refresh_margin,
+            cache_path=settings.token_cache_path,
+        )
+        transport = None
+        if settings.api_transport.lower() == 'aiohttp':
+            transport = AiohttpTransport(
+                state.api,
+                proxy=settings.https_proxy,
+                pool_size=settings.api_pool_size,
+                pool_per_host=settings.api_pool_per_host,
+            )
+            logger.info(f"API 传输层: aiohttp (连接池 {settings.api_pool_size}, 单主机 {settings.api_pool_per_host})")
+        cache = None
+        if settings.api_cache_enabled:
+            cache = ResponseCache(
+                max_entries=settings.api_cache_max_entries,
+                max_bytes=settings.api_cache_max_bytes,
+            )
+        state.api_client = PixivAPIClient(state.api, transport=transport, cache=cache)
@@ -0,0 +1,119 @@
+import asyncio
+import logging
+import time
+from typing import Any, Optional
+
+from pixivpy3 import PixivError
+
+from .state import state
+from .token_store import load_cached_token, save_cached_token
+
+logger = logging.getLogger('pixiv-mcp-server')
+
+
+class TokenRefresher:
+    """
+    根据 api.auth 返回的 expires_in，在 access token 过期前主动刷新。
+    刷新在后台线程中进行，完成前调用方继续使用旧 token，不会被阻塞。
+    配置了 cache_path 时，token 会持久化到本地，供下次启动直接复用。
+    """
+
+    def __init__(self, api, margin: float = 300, cache_path: str = ""):
+        self.api = api
+        self.margin = margin
+        self.cache_path = cache_path
+        self.expires_at: Optional[float] = None
+        self.refresh_count = 0
+        self.failure_count = 0
+        self._task: Optional[asyncio.Task] = None
+        self._ready = asyncio.Event()
+
+    def record(self, token: Any) -> None:
+        """记录一次认证结果中的过期时间，并写入本地 token 缓存。"""
+        try:
+            expires_in = float(token['response']['expires_in'])
+        except (KeyError, TypeError, ValueError):
+            expires_in = 3600.0
+        self.expires_at = time.time() + expires_in
+        save_cached_token(self.cache_path, state.refresh_token, self.api.access_token, self.api.user_id, self.expires_at)
+
+    def restore(self) -> bool:
+        """尝试从本地缓存恢复仍然有效的 access token，成功时无需任何网络请求。"""
+        cached = load_cached_token(self.cache_path, state.refresh_token, min_ttl=self.margin)
+        if not cached:
+            return False
+        self.api.set_auth(cached['access_token'], state.refresh_token)
+        self.api.user_id = cached['user_id']
+        self.expires_at = float(cached['expires_at'])
+        state.is_authenticated = True
+        state.user_id = cached['user_id']
+        self._ready.set()
+        return True
+
+    async def wait_ready(self, timeout: float = 30.0) -> None:
+        """等待首次认证完成（无论成功与否），供启动后立即到达的调用使用。"""
+        if self._ready.is_set():
+            return
+        try:
+            await asyncio.wait_for(self._ready.wait(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("等待首次认证超时，继续执行请求。")
+
+    async def refresh(self, stale_token: Optional[str] = None) -> bool:
+        """
+        使用 refresh_token 获取新的 access token。
+        传入 stale_token 时，若 token 已被其他调用者刷新，则直接返回成功，避免重复刷新。
+        """
+        if not state.refresh_token:
+            return False
+        async with state.auth_lock:
+            if stale_token is not None and self.api.access_token != stale_token:
+                return True
+            try:
+                token = await asyncio.to_thread(self.api.auth, refresh_token=state.refresh_token)
+            except PixivError as e:
+                self.failure_count += 1
+                logger.error(f"刷新 token 失败: {e}")
+                self._ready.set()
+                return False
+            self.record(token)
+            self.refresh_count += 1
+            state.is_authenticated = True
+            state.user_id = self.api.user_id
+            self._ready.set()
+            logger.info(f"Token 刷新成功。用户ID: {state.user_id}")
+            return True
+
+    async def _run(self) -> None:
+        retry_delay = 30.0
+        while True:
+            delay = 0.0
+            if self.expires_at is not None:
+                delay = max(0.0, self.expires_at - self.margin - time.time())
+            await asyncio.sleep(delay)
+            if await self.refresh():
+                retry_delay = 30.0
+            else:
+                await asyncio.sleep(retry_delay)
+                retry_delay = min(retry_delay * 2, 600.0)
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run(), name='pixiv-token-refresher')
+
+    async def stop(self) -> None:
+        if self._task and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self._task = None
+
+    def stats(self) -> dict:
+        return {
+            "expires_in": round(self.expires_at - time.time()) if self.expires_at else None,
+            "refresh_count": self.refresh_count,
+            "failure_count": self.failure_count,
+            "running": bool(self._task and not self._task.done()),
+        }
@@ -0,0 +1,110 @@
+import asyncio
+import threading
+import time
+from typing import Any, Dict
+
+# 桶容量：允许的突发量为多少秒的额度
+BURST_SECONDS = 0.5
+# 桶容量下限，保证小额度时单个数据块也能一次通过
+MIN_BURST_BYTES = 64 * 1024
+# 批量流量等待令牌时的最长单次休眠，以便及时让位给交互流量或响应限额调整
+MAX_BULK_SLEEP = 0.1
+
+
+class BandwidthLimiter:
+    """
+    全局字节速率限制（按字节计的令牌桶），由下载器与预览代理共享。
+    预览代理运行在独立线程的事件循环中，因此内部状态由线程锁保护，等待只在各自的事件循环中进行。
+    - 交互流量（预览）直接预支令牌，余额可以为负，只需等待自己的欠额还清；
+    - 批量流量（下载）只在余额足够时取走令牌，余额被交互流量透支时一直让位。
+    rate <= 0 时不限速。
+    """
+
+    def __init__(self, rate: float):
+        self._lock = threading.Lock()
+        self.rate = 0.0
+        self.burst = float(MIN_BURST_BYTES)
+        self.interactive_bytes = 0
+        self.bulk_bytes = 0
+        self.interactive_wait = 0.0
+        self.bulk_wait = 0.0
+        self._tokens = 0.0
+        self._updated_at = time.monotonic()
+        self.set_rate(rate)
+
+    @property
+    def enabled(self) -> bool:
+        return self.rate > 0
+
+    def set_rate(self, rate: float) -> None:
+        """运行时调整限额，立即对正在等待的传输生效。"""
+        with self._lock:
+            self._refill()
+            self.rate = max(0.0, float(rate))
+            self.burst = max(self.rate * BURST_SECONDS, MIN_BURST_BYTES)
+            self._tokens = min(self._tokens, self.burst) if self.rate > 0 else self.burst
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        if self.rate > 0:
+            self._tokens = min(self.burst, self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+    async def acquire(self, nbytes: int, interactive: bool = False) -> None:
+        """为即将传输（或刚收到）的 nbytes 字节获取额度，额度不足时等待。"""
+        if nbytes <= 0:
+            return
+        if not self.enabled:
+            with self._lock:
+                if interactive:
+                    self.interactive_bytes += nbytes
+                else:
+                    self.bulk_bytes += nbytes
+            return
+        if interactive:
+            await self._acquire_interactive(nbytes)
+        else:
+            await self._acquire_bulk(nbytes)
+
+    async def _acquire_interactive(self, nbytes: int) -> None:
+        with self._lock:
+            self._refill()
+            self._tokens -= nbytes
+            self.interactive_bytes += nbytes
+            delay = -self._tokens / self.rate if self._tokens < 0 else 0.0
+            self.interactive_wait += delay
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def _acquire_bulk(self, nbytes: int) -> None:
+        started = time.monotonic()
+        while True:
+            with self._lock:
+                if not self.enabled:
+                    self.bulk_bytes += nbytes
+                    return
+                self._refill()
+                # 大于桶容量的块在桶满时放行，透支部分由后续等待偿还
+                needed = min(nbytes, self.burst)
+                if self._tokens >= needed:
+                    self._tokens -= nbytes
+                    self.bulk_bytes += nbytes
+                    self.bulk_wait += time.monotonic() - started
+                    return
+                delay = (needed - self._tokens) / self.rate
+            await asyncio.sleep(min(delay, MAX_BULK_SLEEP))
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            self._refill()
+            tokens = self._tokens
+        return {
+            "enabled": self.enabled,
+            "rate_bytes_per_sec": self.rate,
+            "burst_bytes": int(self.burst),
+            "available_bytes": int(tokens),
+            "interactive_bytes": self.interactive_bytes,
+            "bulk_bytes": self.bulk_bytes,
+            "interactive_wait_sec": round(self.interactive_wait, 3),
+            "bulk_wait_sec": round(self.bulk_wait, 3),
+        }
@@ -0,0 +1,105 @@
+import json
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+# 各 API 方法的缓存有效期（秒），未列出的方法不缓存
+DEFAULT_CACHE_TTLS: Dict[str, float] = {
+    'illust_detail': 3600,
+    'ugoira_metadata': 3600,
+    'illust_related': 600,
+    'illust_ranking': 300,
+    'trending_tags_illust': 300,
+    'search_illust': 120,
+    'search_user': 120,
+    'user_bookmarks_illust': 60,
+    'user_following': 60,
+    'illust_follow': 60,
+    'illust_recommended': 60,
+}
+
+# 只读方法：可被缓存，也可安全地合并相同的并发调用
+READ_ONLY_METHODS = frozenset(DEFAULT_CACHE_TTLS)
+
+# 返回内容因登录用户而异的方法，缓存键中必须包含用户 ID
+PERSONALIZED_METHODS = frozenset({
+    'illust_follow',
+    'illust_recommended',
+    'user_bookmarks_illust',
+    'user_following',
+})
+
+
+def make_call_key(method_name: str, args: tuple, kwargs: Dict[str, Any], user_id: Any = None) -> str:
+    """生成规范化的调用键：忽略值为 None 的关键字参数，个性化方法附带用户 ID。"""
+    normalized_kwargs = sorted((k, str(v)) for k, v in kwargs.items() if v is not None)
+    owner = str(user_id) if method_name in PERSONALIZED_METHODS else None
+    return json.dumps([method_name, owner, [str(a) for a in args], normalized_kwargs], ensure_ascii=False)
+
+
+class ResponseCache:
+    """
+    带 TTL 与 LRU 淘汰的内存响应缓存。
+    条目以序列化后的 JSON 字节保存，既能精确计算字节预算，也避免调用方就地修改污染缓存。
+    """
+
+    def __init__(self, max_entries: int = 512, max_bytes: int = 32 * 1024 * 1024, ttls: Optional[Dict[str, float]] = None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttls = dict(DEFAULT_CACHE_TTLS if ttls is None else ttls)
+        self._entries: "OrderedDict[str, Tuple[float, bytes]]" = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def cacheable(self, method_name: str) -> bool:
+        return bool(self.ttls.get(method_name))
+
+    def get(self, key: str) -> Optional[bytes]:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires_at, payload = entry
+        if expires_at <= time.monotonic():
+            self._remove(key)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return payload
+
+    def put(self, key: str, method_name: str, payload: bytes) -> None:
+        ttl = self.ttls.get(method_name)
+        if not ttl or len(payload) > self.max_bytes:
+            return
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (time.monotonic() + ttl, payload)
+        self._bytes += len(payload)
+        while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.evictions += 1
+
+    def _remove(self, key: str) -> None:
+        _, payload = self._entries.pop(key)
+        self._bytes -= len(payload)
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._bytes = 0
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "max_entries": self.max_entries,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": round(self.hits / total, 4) if total else 0.0,
+        }
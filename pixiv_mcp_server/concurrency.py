@@ -0,0 +1,205 @@
+import asyncio
+import logging
+import statistics
+import time
+from collections import deque
+from typing import Any, Callable, Deque, Dict, List, Optional
+
+logger = logging.getLogger('pixiv-mcp-server')
+
+# 自适应调整的评估周期：至少积累这么多样本，且距上次调整至少这么多秒
+ADAPT_MIN_SAMPLES = 16
+ADAPT_INTERVAL_SECONDS = 5.0
+# 错误率超过该值时乘性收缩
+ADAPT_ERROR_RATE = 0.1
+ADAPT_DECREASE_FACTOR = 0.75
+# 延迟相对基线的容忍倍数：低于下限且已跑满时扩容，超过上限时缩容
+ADAPT_GROW_RATIO = 1.3
+ADAPT_SHRINK_RATIO = 2.0
+# 基线每个周期向上漂移的比例，使其能跟上网络条件的长期变化
+ADAPT_BASELINE_DRIFT = 1.05
+# 计算单位延迟时的最小字节数，避免极小文件的固定开销主导样本
+MIN_SAMPLE_BYTES = 64 * 1024
+
+
+class ResizableLimiter:
+    """
+    可在运行时调整上限的并发限制器，用法与 asyncio.Semaphore 相同（async with）。
+    调小上限时不打断已持有的名额，只是在它们释放前不再放行新的等待者。
+    """
+
+    def __init__(self, limit: int, name: str = ''):
+        self.name = name
+        self.limit = max(1, int(limit))
+        self.in_use = 0
+        self.peak = 0
+        self.acquired = 0
+        self._waiters: Deque[asyncio.Future] = deque()
+        self._listeners: List[Callable[[int], None]] = []
+
+    @property
+    def waiting(self) -> int:
+        return sum(1 for waiter in self._waiters if not waiter.done())
+
+    def locked(self) -> bool:
+        return self.in_use >= self.limit
+
+    def _grant(self) -> None:
+        self.in_use += 1
+        self.acquired += 1
+        self.peak = max(self.peak, self.in_use)
+
+    async def acquire(self) -> None:
+        if not self._waiters and self.in_use < self.limit:
+            self._grant()
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            # 已被放行但随即被取消时归还名额
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            raise
+        finally:
+            try:
+                self._waiters.remove(waiter)
+            except ValueError:
+                pass
+
+    def release(self) -> None:
+        self.in_use -= 1
+        self._wake()
+
+    def _wake(self) -> None:
+        for waiter in self._waiters:
+            if self.in_use >= self.limit:
+                break
+            if not waiter.done():
+                self._grant()
+                waiter.set_result(None)
+
+    async def __aenter__(self) -> None:
+        await self.acquire()
+
+    async def __aexit__(self, *exc) -> None:
+        self.release()
+
+    def add_listener(self, callback: Callable[[int], None]) -> None:
+        """注册上限变化的回调，参数为新的上限。"""
+        self._listeners.append(callback)
+
+    def resize(self, limit: int) -> None:
+        limit = max(1, int(limit))
+        if limit == self.limit:
+            return
+        logger.info(f"并发上限 {self.name or ''} 调整: {self.limit} -> {limit}")
+        self.limit = limit
+        self._wake()
+        for callback in self._listeners:
+            callback(limit)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "limit": self.limit,
+            "in_use": self.in_use,
+            "waiting": self.waiting,
+            "peak": self.peak,
+            "utilization": round(self.in_use / self.limit, 3),
+            "acquired": self.acquired,
+        }
+
+
+class AdaptiveLimiter(ResizableLimiter):
+    """
+    根据观测到的延迟与错误率在 [min_limit, max_limit] 内自动调整上限的并发限制器。
+    每个评估周期取单位字节延迟的中位数与历史基线比较：
+    - 错误率过高时乘性收缩；
+    - 延迟明显高于基线（上游或链路已拥塞）时减一；
+    - 延迟接近基线且名额已被用满时加一。
+    adaptive=False 时只记录样本，不改变上限。
+    """
+
+    def __init__(self, limit: int, name: str = '', min_limit: int = 1, max_limit: int = 64, adaptive: bool = False):
+        super().__init__(limit, name)
+        self.min_limit = max(1, min_limit)
+        self.max_limit = max(self.min_limit, max_limit)
+        self.adaptive = adaptive
+        self.baseline: Optional[float] = None
+        self.adjustments = 0
+        self._samples: List[float] = []
+        self._errors = 0
+        self._saturated = False
+        self._last_adjust = time.monotonic()
+        if adaptive:
+            self.limit = self._clamp(self.limit)
+
+    def _clamp(self, limit: int) -> int:
+        return min(self.max_limit, max(self.min_limit, limit))
+
+    def _grant(self) -> None:
+        super()._grant()
+        if self.in_use >= self.limit:
+            self._saturated = True
+
+    def set_bounds(self, min_limit: Optional[int] = None, max_limit: Optional[int] = None) -> None:
+        if min_limit is not None:
+            self.min_limit = max(1, min_limit)
+        if max_limit is not None:
+            self.max_limit = max(self.min_limit, max_limit)
+        if self.adaptive:
+            self.resize(self._clamp(self.limit))
+
+    def set_adaptive(self, adaptive: bool) -> None:
+        self.adaptive = adaptive
+        if adaptive:
+            self.resize(self._clamp(self.limit))
+
+    def record(self, elapsed: float, nbytes: int = 0, ok: bool = True) -> None:
+        """记录一次请求的耗时与结果，必要时调整上限。"""
+        if ok:
+            self._samples.append(elapsed / max(nbytes, MIN_SAMPLE_BYTES))
+        else:
+            self._errors += 1
+        total = len(self._samples) + self._errors
+        if total < ADAPT_MIN_SAMPLES or time.monotonic() - self._last_adjust < ADAPT_INTERVAL_SECONDS:
+            return
+        self._evaluate(self._errors / total)
+
+    def _evaluate(self, error_rate: float) -> None:
+        median = statistics.median(self._samples) if self._samples else None
+        saturated = self._saturated
+        self._samples = []
+        self._errors = 0
+        self._last_adjust = time.monotonic()
+
+        if median is not None:
+            self.baseline = median if self.baseline is None else min(self.baseline * ADAPT_BASELINE_DRIFT, median)
+        if not self.adaptive:
+            self._saturated = self.in_use >= self.limit
+            return
+
+        limit = self.limit
+        if error_rate > ADAPT_ERROR_RATE:
+            limit = int(limit * ADAPT_DECREASE_FACTOR)
+        elif median is not None and median > self.baseline * ADAPT_SHRINK_RATIO:
+            limit -= 1
+        elif median is not None and median <= self.baseline * ADAPT_GROW_RATIO and saturated:
+            limit += 1
+        limit = self._clamp(limit)
+        if limit != self.limit:
+            self.adjustments += 1
+            self.resize(limit)
+        self._saturated = self.in_use >= self.limit
+
+    def stats(self) -> Dict[str, Any]:
+        data = super().stats()
+        data.update({
+            "adaptive": self.adaptive,
+            "min_limit": self.min_limit,
+            "max_limit": self.max_limit,
+            "adjustments": self.adjustments,
+            "baseline_sec_per_byte": self.baseline,
+        })
+        return data
@@ -10,13 +10,50 @@ class Settings(BaseSettings):
     download_path: str = "./downloads"
     filename_template: str = "{author} - {title}_{id}"
     ugoira_format: str = "webp"
+    ugoira_convert_mode: str = "pipe"
+    ugoira_cache_enabled: bool = True
+    ugoira_cache_max_bytes: int = 2 * 1024 * 1024 * 1024
+    ugoira_cache_keep_zip: bool = False
+    library_index_enabled: bool = True
     preview_proxy_enabled: bool = True
     preview_proxy_host: str = "127.0.0.1"
     preview_proxy_port: int = 8643
+    preview_proxy_pool_size: int = 64
+    preview_proxy_pool_per_host: int = 32
+    preview_cache_enabled: bool = True
+    preview_cache_dir: str = "~/.cache/pixiv-mcp-server/previews"
+    preview_cache_max_bytes: int = 512 * 1024 * 1024
+    preview_cache_ttl: int = 24 * 3600
+    preview_resize_workers: int = 2
+    preview_thumbnail_size: int = 0
+    preview_thumbnail_format: str = "webp"
+    preview_thumbnail_quality: int = 80
+    preview_prefetch_enabled: bool = False
     download_semaphore: int = 8
+    download_concurrency_adaptive: bool = False
+    download_concurrency_min: int = 2
+    download_concurrency_max: int = 32
+    download_metadata_workers: int = 4
+    task_registry_max_tasks: int = 10000
+    task_registry_ttl: int = 24 * 3600
     cpu_bound_semaphore: int = 2
+    per_host_download_limit: int = 6
     https_proxy: str = ""
     default_limit: int = 10
+    api_transport: str = "requests"
+    api_pool_size: int = 32
+    api_pool_per_host: int = 8
+    api_cache_enabled: bool = True
+    api_cache_max_entries: int = 512
+    api_cache_max_bytes: int = 32 * 1024 * 1024
+    token_refresh_margin: int = 300
+    rate_limit_per_second: float = 10.0
+    rate_limit_burst: int = 20
+    rate_limit_min_per_second: float = 0.5
+    rate_limit_max_retries: int = 3
+    download_rate_limit_per_second: float = 0.0
+    bandwidth_limit: int = 0
+    token_cache_path: str = "~/.cache/pixiv-mcp-server/token.json"
 
 
 settings = Settings()
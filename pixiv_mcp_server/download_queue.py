@@ -0,0 +1,354 @@
+import asyncio
+import logging
+import time
+import uuid
+from collections import OrderedDict, deque
+from pathlib import Path
+from typing import Any, AsyncIterator, Deque, Dict, List, Optional
+
+from .config import settings
+from .downloader import _new_job, _run_stage, _update_task_status
+from .journal import JOURNAL_FILENAME, DownloadJournal
+from .library import LIBRARY_FILENAME, LibraryIndex
+from .state import state
+from .ugoira_cache import UGOIRA_CACHE_DIRNAME, UgoiraCache
+from .utils import handle_api_error
+
+logger = logging.getLogger('pixiv-mcp-server')
+
+# 已结束任务在日志中的保留时间
+JOURNAL_RETENTION_SECONDS = 7 * 24 * 3600
+
+# 阶段吞吐量的统计窗口（秒）
+THROUGHPUT_WINDOW_SECONDS = 60
+
+# 保留状态的已结束列表批量下载数
+LISTING_HISTORY = 100
+
+
+class PipelineStage:
+    """流水线中的一个阶段：一个输入队列加固定数量的 worker。"""
+
+    def __init__(self, name: str, workers: int, maxsize: int = 0):
+        self.name = name
+        self.workers = max(1, workers)
+        # 当前存活的 worker 数；调小 workers 后多出的 worker 处理完手头作业即退出
+        self.running = 0
+        # 有界队列提供背压：下游积压时上游 worker 在 put 处等待
+        self.queue: "asyncio.Queue[Dict[str, Any]]" = asyncio.Queue(maxsize)
+        self.busy = 0
+        self.processed = 0
+        self._completions: Deque[float] = deque()
+
+    def record_completion(self) -> None:
+        now = time.monotonic()
+        self.processed += 1
+        self._completions.append(now)
+        while self._completions and self._completions[0] < now - THROUGHPUT_WINDOW_SECONDS:
+            self._completions.popleft()
+
+    def stats(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        recent = sum(1 for t in self._completions if t >= now - THROUGHPUT_WINDOW_SECONDS)
+        return {
+            "queued": self.queue.qsize(),
+            "capacity": self.queue.maxsize or None,
+            "workers": self.workers,
+            "running": self.running,
+            "busy": self.busy,
+            "processed": self.processed,
+            "per_second": round(recent / THROUGHPUT_WINDOW_SECONDS, 3),
+        }
+
+
+class DownloadQueue:
+    """
+    持久化的下载队列：任务参数与状态写入下载目录中的 SQLite 日志，服务器重启后自动恢复未完成的任务。
+    作业依次经过 元数据 -> 下载 -> 编码 -> 收尾 四个阶段，各阶段由独立的 worker 池消费，
+    网络并发 (download_semaphore) 与 CPU 并发 (cpu_bound_semaphore) 互不占用；
+    阶段之间以有界队列相连，下游积压时上游自动减速。
+    """
+
+    def __init__(self):
+        self._stages: Dict[str, PipelineStage] = {}
+        self._workers: List[asyncio.Task] = []
+        self._rebuild_task: Optional[asyncio.Task] = None
+        self._listings: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._listing_tasks: Dict[str, asyncio.Task] = {}
+        # 下载与编码阶段的 worker 数跟随对应并发上限的运行时调整
+        state.download_semaphore.add_listener(lambda limit: self.resize_stage('fetch', limit))
+        state.cpu_bound_semaphore.add_listener(lambda limit: self.resize_stage('encode', limit))
+
+    def _build_stages(self) -> None:
+        fetch_workers = state.download_semaphore.limit
+        encode_workers = state.cpu_bound_semaphore.limit
+        self._stages = {
+            # 入口队列不设上限：任务已写入日志，排队本身不占资源
+            'metadata': PipelineStage('metadata', settings.download_metadata_workers),
+            'fetch': PipelineStage('fetch', fetch_workers, maxsize=fetch_workers * 2),
+            'encode': PipelineStage('encode', encode_workers, maxsize=encode_workers * 2),
+            'finalize': PipelineStage('finalize', 1, maxsize=16),
+        }
+
+    @property
+    def started(self) -> bool:
+        return bool(self._workers)
+
+    def _open_journal(self) -> None:
+        if state.download_journal is not None:
+            return
+        path = Path(state.download_path) / JOURNAL_FILENAME
+        try:
+            state.download_journal = DownloadJournal(str(path))
+            state.download_journal.prune(time.time() - JOURNAL_RETENTION_SECONDS)
+        except Exception as e:
+            # 日志不可用时仍可下载，只是无法跨重启恢复
+            logger.warning(f"无法打开下载任务日志 {path}: {e}")
+            state.download_journal = None
+
+    def _open_ugoira_cache(self) -> None:
+        if state.ugoira_cache is not None or not settings.ugoira_cache_enabled:
+            return
+        path = Path(state.download_path) / UGOIRA_CACHE_DIRNAME
+        try:
+            state.ugoira_cache = UgoiraCache(
+                str(path), settings.ugoira_cache_max_bytes, keep_zip=settings.ugoira_cache_keep_zip
+            )
+        except Exception as e:
+            logger.warning(f"无法打开动图缓存 {path}: {e}")
+            state.ugoira_cache = None
+
+    def _open_library_index(self) -> None:
+        if state.library_index is not None or not settings.library_index_enabled:
+            return
+        path = Path(state.download_path) / LIBRARY_FILENAME
+        try:
+            Path(state.download_path).mkdir(parents=True, exist_ok=True)
+            state.library_index = LibraryIndex(str(path))
+        except Exception as e:
+            logger.warning(f"无法打开作品索引 {path}: {e}")
+            state.library_index = None
+            return
+        if state.library_index.created:
+            # 首次使用时从已有的下载目录建立索引，在后台线程中扫描
+            self._rebuild_task = asyncio.create_task(self.rebuild_library_index())
+
+    async def rebuild_library_index(self) -> int:
+        """扫描下载目录重建作品索引，返回识别出的作品数。"""
+        if state.library_index is None:
+            raise RuntimeError("作品索引未启用。")
+        return await asyncio.to_thread(state.library_index.rebuild, state.download_path, state.filename_template)
+
+    def start(self) -> None:
+        """打开任务日志、恢复未完成的任务并启动 worker。重复调用无副作用。"""
+        if self.started:
+            return
+        self._build_stages()
+        self._open_journal()
+        self._open_ugoira_cache()
+        self._open_library_index()
+        self._resume_unfinished()
+        for stage in self._stages.values():
+            for _ in range(stage.workers):
+                self._spawn_worker(stage)
+        worker_counts = ', '.join(f"{stage.name}={stage.workers}" for stage in self._stages.values())
+        logger.info(f"下载流水线已启动，各阶段 worker 数: {worker_counts}")
+
+    def _spawn_worker(self, stage: PipelineStage) -> None:
+        stage.running += 1
+        self._workers.append(
+            asyncio.create_task(self._worker(stage), name=f'pixiv-download-{stage.name}-{len(self._workers)}')
+        )
+
+    def resize_stage(self, name: str, workers: int) -> None:
+        """调整阶段的 worker 数：增加时立即启动新 worker，减少时多出的 worker 在处理完当前作业后退出。"""
+        stage = self._stages.get(name)
+        if stage is None:
+            return
+        stage.workers = max(1, workers)
+        if not self.started:
+            return
+        self._workers = [worker for worker in self._workers if not worker.done()]
+        while stage.running < stage.workers:
+            self._spawn_worker(stage)
+
+    def _resume_unfinished(self) -> None:
+        if state.download_journal is None:
+            return
+        pending = state.download_journal.unfinished()
+        for item in pending:
+            task_id = item['task_id']
+            state.download_tasks.add(
+                task_id, item['illust_id'], "queued", "服务器重启后已恢复，正在等待调度。", batch_id=item['batch_id']
+            )
+            state.download_journal.update(task_id, "queued", "服务器重启后已恢复。")
+            self._stages['metadata'].queue.put_nowait(_new_job(task_id, item['illust_id'], item['params']))
+        if pending:
+            logger.info(f"已从任务日志恢复 {len(pending)} 个未完成的下载任务。")
+
+    def enqueue(
+        self,
+        task_id: str,
+        illust_id: int,
+        params: Dict[str, Any],
+        batch_id: Optional[str] = None,
+        illust: Optional[Dict[str, Any]] = None,
+    ) -> None:
+        """加入一个下载任务。illust 为已取得的作品信息（不写入日志，重启恢复时重新获取）。"""
+        state.download_tasks.add(task_id, illust_id, "queued", "任务已创建，正在等待调度。", batch_id=batch_id)
+        if not self.started:
+            self.start()
+        if state.download_journal is not None:
+            state.download_journal.add(task_id, illust_id, params, batch_id=batch_id)
+        self._stages['metadata'].queue.put_nowait(_new_job(task_id, illust_id, params, illust=illust))
+
+    def enqueue_listing(
+        self,
+        batch_id: str,
+        pages: AsyncIterator[Dict[str, Any]],
+        params: Dict[str, Any],
+        max_items: Optional[int] = None,
+    ) -> None:
+        """在后台逐页消费列表接口，每到一页就把其中的作品加入同一批次。"""
+        if not self.started:
+            self.start()
+        self._listings[batch_id] = {"status": "listing", "pages": 0, "enqueued": 0, "duplicates": 0, "error": None}
+        task = asyncio.create_task(self._feed_listing(batch_id, pages, params, max_items), name=f'pixiv-listing-{batch_id}')
+        self._listing_tasks[batch_id] = task
+        task.add_done_callback(lambda _: self._listing_tasks.pop(batch_id, None))
+        # 只保留最近的列表状态
+        while len(self._listings) > LISTING_HISTORY:
+            oldest = next(iter(self._listings))
+            if oldest in self._listing_tasks:
+                break
+            self._listings.pop(oldest)
+
+    async def _feed_listing(
+        self, batch_id: str, pages: AsyncIterator[Dict[str, Any]], params: Dict[str, Any], max_items: Optional[int]
+    ) -> None:
+        info = self._listings[batch_id]
+        seen = set()
+        try:
+            async for page in pages:
+                error = handle_api_error(page)
+                if error:
+                    info["status"], info["error"] = "failed", error
+                    return
+                info["pages"] += 1
+                for illust in page.get('illusts') or []:
+                    illust_id = illust.get('id')
+                    if not illust_id:
+                        continue
+                    if illust_id in seen:
+                        # 按偏移翻页时列表变化可能导致相邻两页重复
+                        info["duplicates"] += 1
+                        continue
+                    seen.add(illust_id)
+                    # 不可见（已删除或受限）的作品交给元数据阶段获取详情并报告原因
+                    prefetched = illust if illust.get('visible', True) else None
+                    self.enqueue(f"task_{uuid.uuid4()}", illust_id, params, batch_id=batch_id, illust=prefetched)
+                    info["enqueued"] += 1
+                    if max_items is not None and info["enqueued"] >= max_items:
+                        info["status"] = "done"
+                        return
+            info["status"] = "done"
+        except asyncio.CancelledError:
+            info["status"] = "cancelled"
+            raise
+        except Exception as e:
+            logger.error(f"遍历列表批次 {batch_id} 时出错: {e}", exc_info=True)
+            info["status"], info["error"] = "failed", str(e)
+        finally:
+            await pages.aclose()
+            logger.info(f"列表批次 {batch_id} 结束 ({info['status']})：{info['pages']} 页，加入 {info['enqueued']} 个作品。")
+
+    def listing_status(self, batch_id: str) -> Optional[Dict[str, Any]]:
+        info = self._listings.get(batch_id)
+        return dict(info) if info is not None else None
+
+    def cancel_listing(self, batch_id: str) -> bool:
+        """停止继续翻页；已加入队列的任务不受影响。"""
+        task = self._listing_tasks.get(batch_id)
+        if task is None or task.done():
+            return False
+        task.cancel()
+        return True
+
+    async def _worker(self, stage: PipelineStage) -> None:
+        try:
+            while stage.running <= stage.workers:
+                await self._handle_next(stage)
+        finally:
+            stage.running -= 1
+
+    async def _handle_next(self, stage: PipelineStage) -> None:
+        job = await stage.queue.get()
+        task_id = job['task_id']
+        try:
+            if state.download_tasks.status_of(task_id) == "cancelled":
+                return
+            next_stage = await self._process(stage, job)
+            if next_stage is not None:
+                # 下游队列已满时在此等待，形成背压
+                await self._stages[next_stage].queue.put(job)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"下载 worker 处理任务 {task_id} 时出错: {e}", exc_info=True)
+            _update_task_status(task_id, "failed", f"调度失败: {e}")
+        finally:
+            stage.queue.task_done()
+
+    async def _process(self, stage: PipelineStage, job: Dict[str, Any]) -> Optional[str]:
+        """以独立任务运行阶段，使用户取消只结束该任务，worker 继续消费队列。"""
+        task_id = job['task_id']
+        handle = asyncio.create_task(_run_stage(stage.name, job))
+        state.download_task_handles[task_id] = handle
+        stage.busy += 1
+        try:
+            result = (await asyncio.gather(handle, return_exceptions=True))[0]
+        finally:
+            stage.busy -= 1
+            state.download_task_handles.pop(task_id, None)
+        stage.record_completion()
+        return result if isinstance(result, str) else None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "stages": {name: stage.stats() for name, stage in self._stages.items()},
+            "running": len(state.download_task_handles),
+            "listings": len(self._listing_tasks),
+            "tasks": state.download_tasks.stats(),
+            "journal": state.download_journal.path if state.download_journal else None,
+            "ugoira_cache": state.ugoira_cache.stats() if state.ugoira_cache else None,
+            "library_index": state.library_index.stats() if state.library_index else None,
+        }
+
+    async def stop(self) -> None:
+        """停止 worker。先断开任务日志，使关闭时被中断的任务保持未完成状态，下次启动时恢复。"""
+        journal = state.download_journal
+        state.download_journal = None
+        listing_tasks = list(self._listing_tasks.values())
+        for task in listing_tasks:
+            task.cancel()
+        if listing_tasks:
+            await asyncio.gather(*listing_tasks, return_exceptions=True)
+        for worker in self._workers:
+            worker.cancel()
+        if self._workers:
+            await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        if journal is not None:
+            journal.close()
+        if state.ugoira_cache is not None:
+            state.ugoira_cache.close()
+            state.ugoira_cache = None
+        if self._rebuild_task is not None:
+            await asyncio.gather(self._rebuild_task, return_exceptions=True)
+            self._rebuild_task = None
+        if state.library_index is not None:
+            state.library_index.close()
+            state.library_index = None
+
+
+download_queue = DownloadQueue()
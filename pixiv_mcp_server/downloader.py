@@ -1,5 +1,6 @@
 import asyncio
 import logging
+import math
 import os
 import shutil
 import subprocess
@@ -7,33 +8,192 @@ import sys
 import time
 import zipfile
 from pathlib import Path
-from typing import Dict, List
+from typing import Dict, Iterable, List, Optional, Tuple
 from urllib.parse import urlparse
 
+from .concurrency import ResizableLimiter
+from .config import settings
 from .state import state
+from .stream_download import StreamDownloader
+from .task_registry import TaskProgress
+from .ugoira_cache import UgoiraCache, illust_revision
+from .ugoira_encoder import encode_ugoira_in_pool, has_webp_support
 from .utils import (
     _generate_filename,
     _sanitize_filename,
     check_ffmpeg,
+    ffmpeg_version,
     handle_api_error,
 )
 
 logger = logging.getLogger('pixiv-mcp-server')
 HAS_FFMPEG = check_ffmpeg()
+# 可变帧率输出：-fps_mode 自 FFmpeg 5.1 起才有，更早的版本只认 -vsync（无法解析版本的 git 构建视为新版）
+_FFMPEG_VERSION = ffmpeg_version() if HAS_FFMPEG else None
+FFMPEG_VFR_ARGS = ['-vsync', 'vfr'] if _FFMPEG_VERSION is not None and _FFMPEG_VERSION < (5, 1) else ['-fps_mode', 'vfr']
+
+# 图片与动图 zip 的流式下载器（使用独立于 API 调用的限流器）
+stream_downloader = StreamDownloader(
+    rate_limiter=state.download_rate_limiter, bandwidth=state.bandwidth_limiter, proxy=settings.https_proxy
+)
+
+# 单页下载失败后的额外重试次数（连接中断的续传由 StreamDownloader 自行处理）
+PAGE_RETRIES = 2
+# 多页作品的页面暂存目录名（隐藏目录，作品索引扫描时会跳过）
+PAGE_STAGING_DIR = '.staging'
+
+# 按图片主机划分的连接预算，与作品级的 download_semaphore 相互独立
+_host_semaphores: Dict[str, ResizableLimiter] = {}
+
+
+def _host_semaphore(url: str) -> ResizableLimiter:
+    host = (urlparse(url).hostname or '').lower()
+    sem = _host_semaphores.get(host)
+    if sem is None:
+        sem = _host_semaphores[host] = ResizableLimiter(settings.per_host_download_limit, name=host)
+    return sem
+
+
+def resize_host_limits(limit: int) -> None:
+    """调整所有图片主机的连接预算（新出现的主机按 settings.per_host_download_limit 创建）。"""
+    for sem in _host_semaphores.values():
+        sem.resize(limit)
+
+
+def host_limit_stats() -> Dict[str, Dict]:
+    return {host: sem.stats() for host, sem in _host_semaphores.items()}
+
+
+async def _fetch_file(url: str, dest: Path, progress: Optional[TaskProgress] = None) -> None:
+    """下载单个文件，并将耗时与成败反馈给网络并发限制器，供自适应模式调整上限。"""
+    started = time.monotonic()
+    try:
+        downloaded = await stream_downloader.download(url, dest, progress=progress)
+    except asyncio.CancelledError:
+        raise
+    except Exception:
+        state.download_semaphore.record(time.monotonic() - started, ok=False)
+        raise
+    if downloaded:
+        state.download_semaphore.record(time.monotonic() - started, dest.stat().st_size)
+
+
+async def _download_page(url: str, dest: Path, progress: Optional[TaskProgress] = None) -> None:
+    """在主机连接预算内下载单个页面，失败时按页重试。"""
+    async with _host_semaphore(url):
+        for attempt in range(PAGE_RETRIES + 1):
+            try:
+                await _fetch_file(url, dest, progress)
+                if progress is not None:
+                    progress.page_done()
+                return
+            except Exception as e:
+                if attempt >= PAGE_RETRIES:
+                    raise
+                logger.warning(f"页面 {dest.name} 下载失败 ({e})，第 {attempt + 1} 次重试...")
+                await asyncio.sleep(1.0 + attempt)
+
+
+async def _download_pages(task_id: str, illust: Dict, save_path_base: Path) -> List[Tuple[int, Path]]:
+    """
+    并发下载多页作品的所有页面，并按页更新任务进度。返回 (页码, 路径) 列表。
+    页面先下载到作品目录下的暂存目录，全部成功后才移入作品目录，避免留下只有部分页面的作品；
+    失败时已完成的页面保留在暂存目录中，重试时无需重新下载。
+    """
+    staging = save_path_base / PAGE_STAGING_DIR
+    staging.mkdir(exist_ok=True)
+    pages = illust['meta_pages']
+    total = len(pages)
+    done = [False] * total
+    paths: List[Tuple[int, Path]] = []
+    progress = state.download_tasks.progress(task_id)
+    if progress is not None:
+        progress.pages_total = total
+
+    async def fetch(i: int, page: Dict) -> None:
+        url = page['image_urls']['original']
+        file_ext = os.path.splitext(os.path.basename(urlparse(url).path))[1]
+        filename = _generate_filename(illust, page_num=i) + file_ext
+        final = save_path_base / filename
+        paths.append((i, final))
+        if final.exists():
+            if progress is not None:
+                progress.page_done()
+        else:
+            await _download_page(url, staging / filename, progress)
+        done[i] = True
+        # 从第 0 页起连续完成的页数，便于按顺序查看已就绪的页面（页数与字节进度见任务的 progress）
+        contiguous = next((k for k, finished in enumerate(done) if not finished), total)
+        _update_task_status(task_id, "downloading", f"已下载 {sum(done)}/{total} 页。", {
+            "pages_contiguous": contiguous,
+        })
+
+    results = await asyncio.gather(*(fetch(i, page) for i, page in enumerate(pages)), return_exceptions=True)
+    failed = [f"p{i}" for i, r in enumerate(results) if isinstance(r, BaseException)]
+    if failed:
+        raise RuntimeError(f"{len(failed)}/{total} 页下载失败: {', '.join(failed)}")
+    for _, final in paths:
+        staged = staging / final.name
+        if staged.exists():
+            os.replace(staged, final)
+    try:
+        staging.rmdir()
+    except OSError:
+        # 暂存目录中还有其他残留文件（如被取消的任务），留待下次下载时使用
+        pass
+    return sorted(paths)
 
 def _update_task_status(task_id: str, status: str, message: str, details: Dict = None):
-    """统一更新任务状态"""
-    if task_id not in state.download_tasks:
-        state.download_tasks[task_id] = {}
-    
-    state.download_tasks[task_id].update({
-        "status": status,
-        "message": message,
-        "updated_at": time.time(),
-        "details": details or state.download_tasks[task_id].get("details", {})
-    })
+    """统一更新任务状态。已取消的任务不再接受后续状态覆盖。"""
+    if state.download_tasks.status_of(task_id) == "cancelled":
+        return
+    state.download_tasks.update(task_id, status, message, details)
+    if state.download_journal is not None:
+        state.download_journal.update(task_id, status, message)
     logger.info(f"任务 {task_id}: 状态更新为 {status} - {message}")
 
+async def _run_ffmpeg(
+    cmd: List[str], cwd: str, stdin_chunks: Optional[Iterable[bytes]] = None
+) -> subprocess.CompletedProcess:
+    """异步运行 FFmpeg；提供 stdin_chunks 时逐块写入其标准输入。所在任务被取消时立即终止子进程。"""
+    kwargs = {}
+    if sys.platform == 'win32':
+        kwargs['creationflags'] = subprocess.CREATE_NO_WINDOW
+    process = await asyncio.create_subprocess_exec(
+        *cmd, cwd=cwd,
+        stdin=asyncio.subprocess.PIPE if stdin_chunks is not None else asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE, **kwargs
+    )
+
+    async def feed() -> None:
+        try:
+            for chunk in stdin_chunks:
+                process.stdin.write(chunk)
+                await process.stdin.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            # FFmpeg 提前退出，错误信息见 stderr
+            pass
+        finally:
+            process.stdin.close()
+
+    try:
+        if stdin_chunks is not None:
+            # 写入与读取输出并发进行，避免任一方向的管道缓冲区写满导致死锁
+            _, stdout, stderr = await asyncio.gather(feed(), process.stdout.read(), process.stderr.read())
+            await process.wait()
+        else:
+            stdout, stderr = await process.communicate()
+    except asyncio.CancelledError:
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+        raise
+    stdout_text = stdout.decode('utf-8', errors='replace')
+    stderr_text = stderr.decode('utf-8', errors='replace')
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, cmd, stdout_text, stderr_text)
+    return subprocess.CompletedProcess(cmd, process.returncode, stdout_text, stderr_text)
+
 async def _sync_convert_ugoira(
     zip_path: str, 
     frames: List[Dict], 
@@ -102,18 +262,17 @@ async def _sync_convert_ugoira(
                     absolute_output_path
                 ]
         
-        creationflags = subprocess.CREATE_NO_WINDOW if sys.platform == 'win32' else 0
-        
         async with state.cpu_bound_semaphore:
-            logger.info(f"开始动图合成 (格式: {format})... CPU并发: {state.cpu_bound_semaphore._value + 1}/{os.cpu_count() or 2}")
-            process = await asyncio.to_thread(
-                subprocess.run,
-                cmd, cwd=temp_dir, check=True, capture_output=True, 
-                text=True, encoding='utf-8', creationflags=creationflags
-            )
+            logger.info(f"开始动图合成 (格式: {format})... CPU并发: {state.cpu_bound_semaphore.in_use}/{state.cpu_bound_semaphore.limit}")
+            await _run_ffmpeg(cmd, cwd=temp_dir)
             logger.info(f"动图合成成功: {output_path}")
 
         return output_path
+    except asyncio.CancelledError:
+        # 删除被中断的 FFmpeg 输出，避免留下损坏的文件
+        if os.path.exists(output_path):
+            os.remove(output_path)
+        raise
     except subprocess.CalledProcessError as e:
         logger.error(f"FFmpeg conversion failed for {Path(output_path).stem}. Exit code: {e.returncode}")
         logger.error(f"FFmpeg stderr:\n{e.stderr}")
@@ -127,102 +286,352 @@ async def _sync_convert_ugoira(
         if os.path.exists(zip_path):
             os.remove(zip_path)
 
-async def _background_download_single(
-    task_id: str, 
-    illust_id: int,
-    webp_quality: int,
-    webp_preset: str,
-    webp_lossless: bool,
-    gif_preset: str,
-    gif_fps: int | None
-):
-    """在背景下载单个作品，并应用智能存储和命名规则，同时更新任务状态。"""
+# 管道模式下帧时长的量化粒度（毫秒）；GIF 本身只支持百分之一秒精度
+PIPE_DELAY_QUANTUM_MS = 10
+
+# image2pipe 输入需显式指定解码器，按帧文件扩展名选择
+_PIPE_FRAME_CODECS = {'.jpg': 'mjpeg', '.jpeg': 'mjpeg', '.png': 'png'}
+
+
+def _read_zip_frames(zip_path: str, frames: List[Dict]) -> List[bytes]:
+    """按元数据顺序将 zip 中的帧读入内存。"""
+    with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+        return [zip_ref.read(frame['file']) for frame in frames]
+
+
+async def _pipe_convert_ugoira(
+    zip_path: str,
+    frames: List[Dict],
+    work_dir: str,
+    output_path: str,
+    format: str,
+    webp_quality: int = 80,
+    webp_preset: str = 'default',
+    webp_lossless: bool = False,
+    gif_preset: str = 'ultrafast',
+    gif_fps: int = None
+) -> str:
+    """
+    不解压到磁盘，直接从 zip 中读取帧并通过 stdin (image2pipe) 送入 FFmpeg。
+    每帧只解码一次，由 setpts 按元数据中的 delay 重建时间戳；
+    末尾追加一帧最后一帧的副本作为结束时间点，使最后一帧的时长同样准确。
+    """
+    delays = [max(1, round(frame['delay'] / PIPE_DELAY_QUANTUM_MS)) * PIPE_DELAY_QUANTUM_MS for frame in frames]
+    total_ms = sum(delays)
+    # 第 N 帧的时间戳（毫秒）为前 N 帧时长之和
+    pts_expr = '+'.join(f"{d}*gte(N,{i + 1})" for i, d in enumerate(delays))
+    retime = f"settb=1/1000,setpts='{pts_expr}'"
+    input_codec = _PIPE_FRAME_CODECS.get(os.path.splitext(frames[0]['file'])[1].lower(), 'mjpeg')
+    absolute_output_path = str(Path(output_path).resolve())
+    cpu_threads = str(os.cpu_count() or 2)
+
+    cmd = ['ffmpeg', '-f', 'image2pipe', '-c:v', input_codec, '-framerate', '1000', '-i', 'pipe:0']
+    if format == 'webp':
+        # libwebp_anim 按平均帧间隔推算末帧时长，因此先按时长的公约数补齐为恒定间隔，
+        # 编码器会再把相同的连续帧合并回一帧
+        step = math.gcd(*delays)
+        cmd += [
+            '-filter:v', f"{retime},fps=1000/{step},trim=end_frame={total_ms // step}",
+            '-c:v', 'libwebp_anim',
+            '-lossless', '1' if webp_lossless else '0',
+            '-q:v', str(webp_quality),
+            '-preset', webp_preset,
+            '-loop', '0',
+        ]
+    else:  # 默认为 gif
+        vf_chain = "split[s0][s1];[s0]palettegen=stats_mode=single[p];[s1][p]paletteuse=new=1"
+        if gif_fps:
+            # 至少保留一帧，避免总时长短于一个输出帧间隔时输出为空
+            end = max(total_ms / 1000, 1 / gif_fps)
+            cmd += ['-filter:v', f"{retime},fps={gif_fps}:eof_action=pass,trim=end={end}," + vf_chain]
+        else:
+            # 按可变帧率输出并丢弃结尾的副本帧；最后一帧的时长由 final_delay（百分之一秒）指定
+            cmd += [
+                '-filter:v', f"{retime},trim=end_frame={len(frames)}," + vf_chain,
+                *FFMPEG_VFR_ARGS,
+                '-final_delay', str(delays[-1] // 10),
+            ]
+        cmd += ['-preset', gif_preset]
+    cmd += ['-threads', cpu_threads, '-y', absolute_output_path]
+
+    try:
+        frame_data = await asyncio.to_thread(_read_zip_frames, zip_path, frames)
+        async with state.cpu_bound_semaphore:
+            logger.info(f"开始动图合成 (格式: {format}, 管道模式)... CPU并发: {state.cpu_bound_semaphore.in_use}/{state.cpu_bound_semaphore.limit}")
+            await _run_ffmpeg(cmd, cwd=work_dir, stdin_chunks=frame_data + frame_data[-1:])
+            logger.info(f"动图合成成功: {output_path}")
+        return output_path
+    except asyncio.CancelledError:
+        if os.path.exists(output_path):
+            os.remove(output_path)
+        raise
+    except subprocess.CalledProcessError as e:
+        logger.error(f"FFmpeg conversion failed for {Path(output_path).stem}. Exit code: {e.returncode}")
+        logger.error(f"FFmpeg stderr:\n{e.stderr}")
+        raise e
+    finally:
+        if os.path.exists(zip_path):
+            os.remove(zip_path)
+
+
+async def _pillow_convert_ugoira(
+    zip_path: str,
+    frames: List[Dict],
+    work_dir: str,
+    output_path: str,
+    format: str,
+    webp_quality: int = 80,
+    webp_preset: str = 'default',
+    webp_lossless: bool = False,
+    gif_preset: str = 'ultrafast',
+    gif_fps: int = None
+) -> str:
+    """
+    不依赖 FFmpeg 的备用转换：在进程池中用 Pillow 编码，进程数与 CPU_BOUND_SEMAPHORE 一致。
+    webp_preset 与 gif_preset 是 FFmpeg 专有参数，此处忽略。
+    """
+    if format == 'webp' and not has_webp_support():
+        raise RuntimeError("当前 Pillow 未编译 WebP 支持，请安装 FFmpeg 或改用 gif 格式。")
+    try:
+        async with state.cpu_bound_semaphore:
+            logger.info(f"开始动图合成 (格式: {format}, Pillow 进程池)... CPU并发: {state.cpu_bound_semaphore.in_use}/{state.cpu_bound_semaphore.limit}")
+            await encode_ugoira_in_pool(
+                state.cpu_bound_semaphore.limit,
+                zip_path=zip_path,
+                frames=frames,
+                output_path=output_path,
+                format=format,
+                webp_quality=webp_quality,
+                webp_lossless=webp_lossless,
+                gif_fps=gif_fps,
+            )
+            logger.info(f"动图合成成功: {output_path}")
+        return output_path
+    finally:
+        # 取消时子进程中的编码仍会跑完，但输出先写入 .part，不会留下被误认为已完成的文件
+        if os.path.exists(zip_path):
+            os.remove(zip_path)
+
+
+async def _convert_ugoira(**kwargs) -> str:
+    """按 UGOIRA_CONVERT_MODE 选择转换方式；未安装 FFmpeg 时自动使用 Pillow 备用编码器。"""
+    mode = settings.ugoira_convert_mode
+    if mode == 'pillow' or not HAS_FFMPEG:
+        return await _pillow_convert_ugoira(**kwargs)
+    if mode == 'disk':
+        return await _sync_convert_ugoira(**kwargs)
+    return await _pipe_convert_ugoira(**kwargs)
+
+async def _record_in_library(job: Dict, files: List[Tuple[int, Path]]) -> None:
+    """将已完整下载的作品写入作品索引（计算哈希在线程中进行）。"""
+    library = state.library_index
+    if library is None:
+        return
+    try:
+        await asyncio.to_thread(library.record_work, job['illust_id'], job['kind'], files)
+    except Exception as e:
+        logger.warning(f"写入作品索引失败 ({job['illust_id']}): {e}")
+
+
+def _new_job(task_id: str, illust_id: int, params: Dict, illust: Optional[Dict] = None) -> Dict:
+    """创建在各流水线阶段之间传递的下载作业。illust 为列表接口中已取得的作品信息，提供时不再请求 illust_detail。"""
+    job = {'task_id': task_id, 'illust_id': illust_id, 'params': dict(params)}
+    if illust is not None:
+        job['illust'] = illust
+    return job
+
+
+def _skip_if_in_library(task_id: str, illust_id: int, page_count: Optional[int] = None) -> bool:
+    """作品已完整存在于作品索引中时将任务标记为成功并返回 True。"""
+    if state.library_index is None:
+        return False
+    paths = state.library_index.lookup(illust_id, ugoira_format=state.ugoira_format, page_count=page_count)
+    if not paths:
+        return False
+    final_path = paths[0] if len(paths) == 1 else str(Path(paths[0]).parent)
+    _update_task_status(task_id, "success", f"作品已在库中，跳过: {final_path}", {"final_path": final_path})
+    return True
+
+
+async def _stage_metadata(job: Dict) -> Optional[str]:
+    """元数据阶段：获取作品信息，确定保存位置，并处理已存在或缓存命中的情况。"""
+    task_id, illust_id = job['task_id'], job['illust_id']
+    # 先查作品索引：已完整下载的作品无需任何网络请求
+    known = job.get('illust')
+    if _skip_if_in_library(task_id, illust_id, known.get('page_count') if known else None):
+        return None
+
     if not state.api_client:
         _update_task_status(task_id, "failed", "API 客户端尚未初始化，下载任务取消。")
-        return
+        return None
+
+    _update_task_status(task_id, "downloading", f"开始处理作品 ID {illust_id}。")
+    illust = job.get('illust')
+    if illust is None:
+        detail_result = await state.api_client.illust_detail(illust_id)
+        error = handle_api_error(detail_result)
+        if error:
+            _update_task_status(task_id, "failed", f"无法获取作品信息: {error}")
+            return None
+        illust = detail_result['illust']
+        job['illust'] = illust
+    _update_task_status(task_id, "downloading", "成功获取作品信息。", {"illust_title": illust.get('title')})
+
+    page_count = illust.get('page_count', 1)
+    illust_type = illust.get('type')
+    # 扫描得到的多页作品页数未知，取得作品信息后再确认是否已下载完整
+    if known is None and _skip_if_in_library(task_id, illust_id, page_count):
+        return None
+
+    save_path_base = Path(state.download_path)
+    if page_count > 1 or illust_type == 'ugoira':
+        sub_folder_name = _sanitize_filename(f"{illust_id} - {illust.get('title', 'Untitled')}")
+        save_path_base = save_path_base / sub_folder_name
+    save_path_base.mkdir(parents=True, exist_ok=True)
+    job['save_path_base'] = save_path_base
+
+    if illust_type != 'ugoira':
+        job['kind'] = 'single' if page_count == 1 else 'pages'
+        return 'fetch'
+
+    job['kind'] = 'ugoira'
+    output_format = job['format'] = state.ugoira_format
+    final_output_path = job['final_path'] = save_path_base / f"{_generate_filename(illust)}.{output_format}"
+    if final_output_path.exists():
+        await _record_in_library(job, [(0, final_output_path)])
+        _update_task_status(task_id, "success", f"动图已存在，跳过: {final_output_path}", {"final_path": str(final_output_path)})
+        return None
+
+    cache = state.ugoira_cache
+    revision = illust_revision(illust)
+    job['output_key'] = UgoiraCache.output_key(illust_id, revision, output_format, job['params'])
+    if cache is not None and cache.fetch_output(job['output_key'], final_output_path):
+        await _record_in_library(job, [(0, final_output_path)])
+        _update_task_status(task_id, "success", f"动图已从缓存恢复至 {final_output_path}", {"final_path": str(final_output_path)})
+        return None
+
+    job['zip_key'] = UgoiraCache.zip_key(illust_id, revision)
+    zip_path = save_path_base / f"{illust_id}_ugoira.zip"
+    frames = cache.fetch_zip(job['zip_key'], zip_path) if cache is not None else None
+    if frames is not None:
+        job['zip_path'], job['frames'] = zip_path, frames
+        _update_task_status(task_id, "processing", f"已从缓存取得动图 .zip，等待合成为 {output_format}...")
+        return 'encode'
+
+    _update_task_status(task_id, "downloading", "正在获取动图元数据...")
+    metadata = await state.api_client.ugoira_metadata(illust_id)
+    error = handle_api_error(metadata)
+    if error:
+        _update_task_status(task_id, "failed", f"无法获取动图元数据: {error}")
+        return None
+    job['zip_url'] = metadata['ugoira_metadata']['zip_urls']['medium']
+    job['zip_path'] = save_path_base / os.path.basename(urlparse(job['zip_url']).path)
+    job['frames'] = metadata['ugoira_metadata']['frames']
+    _update_task_status(task_id, "downloading", "动图元数据已就绪，等待下载 .zip 文件...")
+    return 'fetch'
+
 
-    _update_task_status(task_id, "pending", f"任务已加入队列，等待处理。")
-    
+async def _stage_fetch(job: Dict) -> Optional[str]:
+    """下载阶段：在网络并发预算内下载图片或动图 zip。"""
+    task_id, illust = job['task_id'], job['illust']
+    progress = state.download_tasks.progress(task_id)
+    if progress is not None and job['kind'] != 'pages':
+        progress.pages_total = 1
     async with state.download_semaphore:
-        _update_task_status(task_id, "downloading", f"开始处理作品 ID {illust_id}。")
+        if job['kind'] == 'ugoira':
+            _update_task_status(task_id, "downloading", "正在下载动图 .zip 文件...")
+            await _fetch_file(job['zip_url'], job['zip_path'], progress)
+            if progress is not None:
+                progress.page_done()
+            if state.ugoira_cache is not None:
+                state.ugoira_cache.store_zip(job['zip_key'], job['zip_path'], job['frames'])
+            _update_task_status(task_id, "processing", f"动图 .zip 下载完成，等待合成为 {job['format']}...")
+            return 'encode'
+        if job['kind'] == 'single':
+            url = illust['meta_single_page']['original_image_url']
+            file_ext = os.path.splitext(os.path.basename(urlparse(url).path))[1]
+            path = job['save_path_base'] / (_generate_filename(illust) + file_ext)
+            await _download_page(url, path, progress)
+            job['files'] = [(0, path)]
+        else:
+            job['files'] = await _download_pages(task_id, illust, job['save_path_base'])
+    job['final_path'] = job['save_path_base']
+    return 'finalize'
+
+
+async def _stage_encode(job: Dict) -> Optional[str]:
+    """编码阶段：将动图 zip 合成为 webp/gif（CPU 并发由 cpu_bound_semaphore 控制）。"""
+    _update_task_status(job['task_id'], "processing", f"正在合成为 {job['format']}...")
+    await _convert_ugoira(
+        zip_path=str(job['zip_path']),
+        frames=job['frames'],
+        work_dir=str(job['save_path_base']),
+        output_path=str(job['final_path']),
+        format=job['format'],
+        **job['params']
+    )
+    return 'finalize'
+
+
+async def _stage_finalize(job: Dict) -> Optional[str]:
+    """收尾阶段：写入缓存与作品索引，并将任务标记为成功。"""
+    final_path = job['final_path']
+    if job['kind'] == 'ugoira':
+        if state.ugoira_cache is not None:
+            state.ugoira_cache.store_output(job['output_key'], final_path)
+        await _record_in_library(job, [(0, final_path)])
+        _update_task_status(job['task_id'], "success", f"动图已成功保存至 {final_path}", {"final_path": str(final_path)})
+    else:
+        await _record_in_library(job, job['files'])
+        _update_task_status(job['task_id'], "success", f"插画已成功下载至 {final_path}", {"final_path": str(final_path)})
+    return None
+
+
+def _discard_partial_downloads(job: Dict) -> None:
+    """删除作业未完成下载的 `.part` 文件（已完成的暂存页面保留，供再次下载时复用）。"""
+    targets: List[Path] = []
+    if job.get('zip_path') is not None:
+        targets.append(Path(job['zip_path']))
+    illust, save_path_base = job.get('illust'), job.get('save_path_base')
+    if illust is not None and save_path_base is not None:
+        if job.get('kind') == 'single':
+            url = illust['meta_single_page']['original_image_url']
+            targets.append(save_path_base / (_generate_filename(illust) + os.path.splitext(urlparse(url).path)[1]))
+        elif job.get('kind') == 'pages':
+            for i, page in enumerate(illust['meta_pages']):
+                ext = os.path.splitext(urlparse(page['image_urls']['original']).path)[1]
+                targets.append(save_path_base / PAGE_STAGING_DIR / (_generate_filename(illust, page_num=i) + ext))
+    for dest in targets:
         try:
-            if not state.api_client:
-                _update_task_status(task_id, "failed", "API 客户端尚未初始化，下载任务取消。")
-                return
-            detail_result = await state.api_client.illust_detail(illust_id)
-            error = handle_api_error(detail_result)
-            if error:
-                _update_task_status(task_id, "failed", f"无法获取作品信息: {error}")
-                return
+            stream_downloader.discard(dest)
+        except OSError as e:
+            logger.warning(f"删除未完成的文件 {dest} 失败: {e}")
+
+
+# 流水线阶段：每个阶段返回下一阶段的名称，返回 None 表示作业已结束
+DOWNLOAD_STAGES = {
+    'metadata': _stage_metadata,
+    'fetch': _stage_fetch,
+    'encode': _stage_encode,
+    'finalize': _stage_finalize,
+}
 
-            illust = detail_result['illust']
-            _update_task_status(task_id, "downloading", "成功获取作品信息。", {"illust_title": illust.get('title')})
-
-            page_count = illust.get('page_count', 1)
-            illust_type = illust.get('type')
-            
-            save_path_base = Path(state.download_path)
-            if page_count > 1 or illust_type == 'ugoira':
-                sub_folder_name = _sanitize_filename(f"{illust_id} - {illust.get('title', 'Untitled')}")
-                save_path_base = save_path_base / sub_folder_name
-            
-            save_path_base.mkdir(parents=True, exist_ok=True)
-            
-            if illust_type == 'ugoira':
-                if not HAS_FFMPEG:
-                    _update_task_status(task_id, "failed", "未找到 FFmpeg，无法处理动图。")
-                    return
-                
-                _update_task_status(task_id, "downloading", "正在获取动图元数据...")
-                metadata = await state.api_client.ugoira_metadata(illust_id)
-                error = handle_api_error(metadata)
-                if error:
-                    _update_task_status(task_id, "failed", f"无法获取动图元数据: {error}")
-                    return
-                
-                zip_url = metadata['ugoira_metadata']['zip_urls']['medium']
-                zip_filename = os.path.basename(urlparse(zip_url).path)
-                zip_path = save_path_base / zip_filename
-                
-                _update_task_status(task_id, "downloading", f"正在下载动图 .zip 文件...")
-                await state.api_client.download(zip_url, path=str(save_path_base))
-                
-                output_format = state.ugoira_format
-                filename_base = _generate_filename(illust)
-                final_output_path = save_path_base / f"{filename_base}.{output_format}"
-
-                _update_task_status(task_id, "processing", f"动图 .zip 下载完成，准备合成为 {output_format}...")
-                await _sync_convert_ugoira(
-                    zip_path=str(zip_path),
-                    frames=metadata['ugoira_metadata']['frames'],
-                    work_dir=str(save_path_base),
-                    output_path=str(final_output_path),
-                    format=output_format,
-                    webp_quality=webp_quality,
-                    webp_preset=webp_preset,
-                    webp_lossless=webp_lossless,
-                    gif_preset=gif_preset,
-                    gif_fps=gif_fps
-                )
-                _update_task_status(task_id, "success", f"动图已成功保存至 {final_output_path}", {"final_path": str(final_output_path)})
-
-            else:
-                if page_count == 1:
-                    url = illust['meta_single_page']['original_image_url']
-                    file_ext = os.path.splitext(os.path.basename(urlparse(url).path))[1]
-                    filename = _generate_filename(illust) + file_ext
-                    final_path = save_path_base / filename
-                    await state.api_client.download(url, path=str(save_path_base), name=filename)
-                else:
-                    for i, page in enumerate(illust['meta_pages']):
-                        url = page['image_urls']['original']
-                        file_ext = os.path.splitext(os.path.basename(urlparse(url).path))[1]
-                        filename = _generate_filename(illust, page_num=i) + file_ext
-                        await state.api_client.download(url, path=str(save_path_base), name=filename)
-                
-                final_path = save_path_base
-                _update_task_status(task_id, "success", f"插画已成功下载至 {final_path}", {"final_path": str(final_path)})
-
-        except Exception as e:
-            logger.error(f"背景下载任务 ({task_id} - {illust_id}) 发生未预期错误: {e}", exc_info=True)
-            _update_task_status(task_id, "failed", f"发生未预期错误: {str(e)}")
+
+async def _run_stage(stage: str, job: Dict) -> Optional[str]:
+    """运行单个阶段，统一处理取消与异常。"""
+    task_id, illust_id = job['task_id'], job['illust_id']
+    try:
+        return await DOWNLOAD_STAGES[stage](job)
+    except asyncio.CancelledError:
+        if state.download_tasks.status_of(task_id) == "cancelled":
+            # manage_download_tasks 先标记状态再取消协程：用户不再需要这些文件
+            logger.info(f"背景下载任务 ({task_id} - {illust_id}) 已取消。")
+            _discard_partial_downloads(job)
+        else:
+            # 服务器关闭：保留 .part 与暂存页面，任务从日志恢复后续传
+            logger.info(f"背景下载任务 ({task_id} - {illust_id}) 因服务器关闭而中断。")
+        raise
+    except Exception as e:
+        logger.error(f"背景下载任务 ({task_id} - {illust_id}) 在 {stage} 阶段发生未预期错误: {e}", exc_info=True)
+        _update_task_status(task_id, "failed", f"发生未预期错误: {str(e)}")
+        return None
@@ -0,0 +1,84 @@
+import json
+import logging
+import sqlite3
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+logger = logging.getLogger('pixiv-mcp-server')
+
+# 尚未结束的任务状态；服务器重启后这些任务会被恢复
+UNFINISHED_STATUSES = ('queued', 'downloading', 'processing')
+
+JOURNAL_FILENAME = '.pixiv-mcp-queue.sqlite3'
+
+
+class DownloadJournal:
+    """
+    基于 SQLite 的下载任务日志，记录每个任务的参数与状态变化，
+    使服务器重启后可以恢复未完成的任务。
+    """
+
+    def __init__(self, path: str):
+        self.path = str(path)
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+        # WAL + NORMAL：每次状态更新不必 fsync，崩溃时最多丢失最后几条更新
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute(
+            '''CREATE TABLE IF NOT EXISTS tasks (
+                task_id TEXT PRIMARY KEY,
+                illust_id INTEGER NOT NULL,
+                params TEXT NOT NULL,
+                status TEXT NOT NULL,
+                message TEXT,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )'''
+        )
+        self._conn.execute('CREATE INDEX IF NOT EXISTS idx_tasks_status ON tasks (status)')
+        columns = {row[1] for row in self._conn.execute('PRAGMA table_info(tasks)')}
+        if 'batch_id' not in columns:
+            self._conn.execute('ALTER TABLE tasks ADD COLUMN batch_id TEXT')
+
+    def add(
+        self, task_id: str, illust_id: int, params: Dict[str, Any],
+        status: str = 'queued', message: str = '', batch_id: Optional[str] = None,
+    ) -> None:
+        now = time.time()
+        self._conn.execute(
+            'INSERT OR REPLACE INTO tasks (task_id, illust_id, params, status, message, created_at, updated_at, batch_id)'
+            ' VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            (task_id, illust_id, json.dumps(params), status, message, now, now, batch_id),
+        )
+
+    def update(self, task_id: str, status: str, message: str = '') -> None:
+        self._conn.execute(
+            'UPDATE tasks SET status = ?, message = ?, updated_at = ? WHERE task_id = ?',
+            (status, message, time.time(), task_id),
+        )
+
+    def unfinished(self) -> List[Dict[str, Any]]:
+        """按创建顺序返回所有未结束的任务。"""
+        placeholders = ','.join('?' * len(UNFINISHED_STATUSES))
+        rows = self._conn.execute(
+            f'SELECT task_id, illust_id, params, batch_id FROM tasks WHERE status IN ({placeholders}) ORDER BY created_at',
+            UNFINISHED_STATUSES,
+        ).fetchall()
+        return [{'task_id': r[0], 'illust_id': r[1], 'params': json.loads(r[2]), 'batch_id': r[3]} for r in rows]
+
+    def prune(self, older_than: float) -> int:
+        """删除早于指定时间结束的任务记录。"""
+        placeholders = ','.join('?' * len(UNFINISHED_STATUSES))
+        cur = self._conn.execute(
+            f'DELETE FROM tasks WHERE status NOT IN ({placeholders}) AND updated_at < ?',
+            (*UNFINISHED_STATUSES, older_than),
+        )
+        return cur.rowcount
+
+    def close(self) -> None:
+        try:
+            self._conn.close()
+        except sqlite3.Error as e:
+            logger.warning(f"关闭下载任务日志失败: {e}")
@@ -0,0 +1,222 @@
+import hashlib
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+logger = logging.getLogger('pixiv-mcp-server')
+
+LIBRARY_FILENAME = '.pixiv-mcp-library.sqlite3'
+
+# 扫描下载目录时识别的作品文件类型
+LIBRARY_EXTENSIONS = frozenset({'.jpg', '.jpeg', '.png', '.gif', '.webp'})
+
+_PAGE_SUFFIX = re.compile(r'_p(\d+)$')
+_FOLDER_PREFIX = re.compile(r'^(\d+) - ')
+
+
+def file_sha256(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _template_pattern(template: str) -> re.Pattern:
+    """将文件名模板转换为提取作品 ID 的正则。"""
+    pattern = re.escape(template)
+    pattern = pattern.replace(re.escape('{id}'), r'(?P<id>\d+)')
+    for field in ('{author}', '{title}'):
+        pattern = pattern.replace(re.escape(field), '.*?')
+    return re.compile(f'^{pattern}$')
+
+
+def parse_library_file(path: Path, root: Path, template: str) -> Optional[Tuple[int, Optional[int]]]:
+    """
+    从文件路径推断 (作品 ID, 页码)。依次尝试当前文件名模板与作品文件夹前缀（"{id} - 标题"），
+    其他文件不视为作品，以免误把普通图片当作已下载的作品。
+    文件名没有 _pN 后缀（单页作品或动图）时页码为 None。
+    """
+    stem = path.stem
+    page = None
+    match = _PAGE_SUFFIX.search(stem)
+    if match:
+        page = int(match.group(1))
+        stem = stem[:match.start()]
+
+    match = _template_pattern(template).match(stem)
+    if match:
+        return int(match.group('id')), page
+    if path.parent != root:
+        match = _FOLDER_PREFIX.match(path.parent.name)
+        if match:
+            return int(match.group(1)), page
+    return None
+
+
+class LibraryIndex:
+    """
+    已下载作品的持久化索引（下载目录中的 SQLite 文件），记录每个作品的各页文件路径、大小与哈希。
+    下载前先查询索引，文件仍在时直接跳过，无需任何网络请求；索引也可以通过扫描下载目录重建。
+    """
+
+    def __init__(self, path: str):
+        self.path = str(path)
+        self.hits = 0
+        self.created = not Path(self.path).exists()
+        # 目录扫描在线程中进行，所有数据库操作通过锁串行化
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute(
+            '''CREATE TABLE IF NOT EXISTS works (
+                illust_id INTEGER PRIMARY KEY,
+                kind TEXT NOT NULL,
+                page_count INTEGER,
+                recorded_at REAL NOT NULL
+            )'''
+        )
+        self._conn.execute(
+            '''CREATE TABLE IF NOT EXISTS files (
+                illust_id INTEGER NOT NULL,
+                page INTEGER NOT NULL,
+                path TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                sha256 TEXT,
+                PRIMARY KEY (illust_id, page)
+            )'''
+        )
+
+    def lookup(
+        self, illust_id: int, ugoira_format: Optional[str] = None, page_count: Optional[int] = None
+    ) -> Optional[List[str]]:
+        """
+        作品已完整存在于库中时返回其文件路径列表，否则返回 None。
+        只比较文件大小（一次 stat），不读取文件内容；动图还要求格式与当前设置一致。
+        page_count 为作品信息中的页数：扫描目录得到的多页作品页数未知，必须提供它才能确认完整，
+        确认后写回索引，之后的查询无需再提供。
+        """
+        with self._lock:
+            work = self._conn.execute('SELECT kind, page_count FROM works WHERE illust_id = ?', (illust_id,)).fetchone()
+            if work is None:
+                return None
+            rows = self._conn.execute(
+                'SELECT page, path, size FROM files WHERE illust_id = ? ORDER BY page', (illust_id,)
+            ).fetchall()
+        kind, stored_count = work
+        expected = page_count if page_count is not None else stored_count
+        if expected is None or not rows:
+            return None
+        if kind != 'ugoira' and not set(range(expected)) <= {page for page, _, _ in rows}:
+            return None
+        if kind == 'ugoira' and ugoira_format and not rows[0][1].endswith(f'.{ugoira_format}'):
+            return None
+        for _, path, size in rows:
+            try:
+                if os.stat(path).st_size != size:
+                    return None
+            except OSError:
+                return None
+        if stored_count is None:
+            with self._lock:
+                self._conn.execute('UPDATE works SET page_count = ? WHERE illust_id = ?', (expected, illust_id))
+        self.hits += 1
+        return [path for _, path, _ in rows]
+
+    def record_work(
+        self, illust_id: int, kind: str, files: List[Tuple[int, Path]], hash_files: bool = True
+    ) -> None:
+        """记录一个已完整下载的作品。files 为 (页码, 路径) 列表。在线程中调用以免阻塞事件循环。"""
+        entries = []
+        for page, path in files:
+            path = Path(path)
+            entries.append((illust_id, page, str(path.resolve()), path.stat().st_size, file_sha256(path) if hash_files else None))
+        with self._lock:
+            self._conn.execute('BEGIN')
+            try:
+                self._conn.execute('DELETE FROM files WHERE illust_id = ?', (illust_id,))
+                self._write_work(illust_id, kind, len(entries), entries)
+                self._conn.execute('COMMIT')
+            except Exception:
+                self._conn.execute('ROLLBACK')
+                raise
+
+    def _write_work(self, illust_id: int, kind: str, page_count: Optional[int], entries: List[Tuple]) -> None:
+        self._conn.executemany('INSERT INTO files VALUES (?, ?, ?, ?, ?)', entries)
+        self._conn.execute('INSERT OR REPLACE INTO works VALUES (?, ?, ?, ?)', (illust_id, kind, page_count, time.time()))
+
+    def rebuild(self, root: str, template: str) -> int:
+        """
+        扫描下载目录重建索引，返回识别出的作品数。
+        不重新计算哈希：路径与大小未变的文件沿用已记录的哈希。整个重建在一个事务中完成，扫描出错时保留原索引。
+        """
+        root_path = Path(root).resolve()
+        found: Dict[int, List[Tuple[Optional[int], Path]]] = {}
+        for dirpath, dirnames, filenames in os.walk(root_path):
+            # 跳过缓存等隐藏目录
+            dirnames[:] = [d for d in dirnames if not d.startswith('.')]
+            for name in filenames:
+                path = Path(dirpath) / name
+                if path.suffix.lower() not in LIBRARY_EXTENSIONS:
+                    continue
+                parsed = parse_library_file(path, root_path, template)
+                if parsed:
+                    found.setdefault(parsed[0], []).append((parsed[1], path))
+
+        works = []
+        for illust_id, files in found.items():
+            if len(files) == 1 and files[0][0] is None:
+                # 没有页码后缀的单个文件是单页作品或动图，文件本身即完整作品
+                kind = 'ugoira' if files[0][1].suffix.lower() in ('.gif', '.webp') else 'single'
+                pages = [(0, files[0][1])]
+            else:
+                kind = 'pages'
+                # 同一页出现多个文件时保留最后扫描到的一个
+                pages = sorted({page or 0: path for page, path in files}.items())
+            entries = [(illust_id, page, str(path.resolve()), path.stat().st_size) for page, path in pages]
+            works.append((illust_id, kind, entries))
+
+        with self._lock:
+            self._conn.execute('BEGIN')
+            try:
+                hashes = {
+                    (path, size): sha256
+                    for path, size, sha256 in self._conn.execute('SELECT path, size, sha256 FROM files WHERE sha256 IS NOT NULL')
+                }
+                known_counts = dict(self._conn.execute(
+                    "SELECT illust_id, page_count FROM works WHERE kind = 'pages' AND page_count IS NOT NULL"
+                ))
+                self._conn.execute('DELETE FROM files')
+                self._conn.execute('DELETE FROM works')
+                for illust_id, kind, entries in works:
+                    page_count: Optional[int] = len(entries)
+                    if kind == 'pages':
+                        # 多页作品可能只下载了部分页面：只有此前已确认的页数全部在盘时才沿用，否则留待下载前用作品信息确认
+                        count = known_counts.get(illust_id)
+                        page_count = count if count is not None and set(range(count)) <= {e[1] for e in entries} else None
+                    rows = [entry + (hashes.get((entry[2], entry[3])),) for entry in entries]
+                    self._write_work(illust_id, kind, page_count, rows)
+                self._conn.execute('COMMIT')
+            except Exception:
+                self._conn.execute('ROLLBACK')
+                raise
+        logger.info(f"已扫描 {root_path} 重建作品索引，共 {len(found)} 个作品。")
+        return len(found)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            works = self._conn.execute('SELECT COUNT(*) FROM works').fetchone()[0]
+            files, size = self._conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM files').fetchone()
+        return {"works": works, "files": files, "bytes": size, "hits": self.hits}
+
+    def close(self) -> None:
+        try:
+            self._conn.close()
+        except sqlite3.Error as e:
+            logger.warning(f"关闭作品索引失败: {e}")
@@ -0,0 +1,186 @@
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, NamedTuple, Optional
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+logger = logging.getLogger('pixiv-mcp-server')
+
+# 单个条目最多占缓存上限的比例，避免一张超大原图挤掉所有缩略图
+MAX_ENTRY_FRACTION = 8
+
+
+def normalize_url(url: str) -> str:
+    """规范化图片 URL 作为缓存键：协议与主机小写、去掉默认端口与片段、查询参数排序。"""
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or '').lower()
+    if parts.port and (scheme, parts.port) not in (('http', 80), ('https', 443)):
+        host = f'{host}:{parts.port}'
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    return urlunsplit((scheme, host, parts.path, query, ''))
+
+
+def client_etag(key: str, size: int, etag: Optional[str] = None) -> str:
+    """发给客户端的 ETag：优先使用上游的，上游未提供时由缓存键与大小生成。"""
+    return etag or f'"{key[:16]}-{size}"'
+
+
+class CacheEntry(NamedTuple):
+    key: str
+    path: Path
+    size: int
+    content_type: str
+    etag: Optional[str]
+    last_modified: Optional[str]
+    fetched_at: float
+
+    @property
+    def client_etag(self) -> str:
+        return client_etag(self.key, self.size, self.etag)
+
+
+class PreviewCache:
+    """
+    预览代理的磁盘图片缓存，按规范化后的 URL 索引（SQLite），总大小超过上限时按最近使用时间淘汰。
+    条目在 ttl 内视为新鲜，过期后由代理携带 If-None-Match / If-Modified-Since 向上游重新验证。
+    索引可能被主线程读取统计，所有数据库操作通过锁串行化。
+    """
+
+    def __init__(self, root: str, max_bytes: int, ttl: int):
+        self.root = Path(root).expanduser()
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max(1, max_bytes // MAX_ENTRY_FRACTION)
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        self.not_modified = 0
+        self.uncacheable = 0
+        self.evictions = 0
+        self.renditions = 0
+        self.served_bytes = 0
+        self.upstream_bytes = 0
+        self.root.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.root / 'index.sqlite3'), isolation_level=None, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute(
+            '''CREATE TABLE IF NOT EXISTS entries (
+                key TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                content_type TEXT NOT NULL,
+                etag TEXT,
+                last_modified TEXT,
+                fetched_at REAL NOT NULL,
+                last_used REAL NOT NULL
+            )'''
+        )
+        self._conn.execute('CREATE INDEX IF NOT EXISTS idx_entries_last_used ON entries (last_used)')
+
+    @staticmethod
+    def key_for(url: str, variant: str = '') -> str:
+        """缓存键；variant 区分同一图片派生出的不同版本（如缩略图尺寸与格式）。"""
+        normalized = normalize_url(url)
+        if variant:
+            normalized += '|' + variant
+        return hashlib.sha256(normalized.encode('utf-8')).hexdigest()[:40]
+
+    def _path(self, key: str) -> Path:
+        return self.root / key
+
+    def temp_path(self, key: str) -> Path:
+        return self.root / (key + '.part')
+
+    def lookup(self, key: str) -> Optional[CacheEntry]:
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT size, content_type, etag, last_modified, fetched_at FROM entries WHERE key = ?', (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            path = self._path(key)
+            if not path.exists():
+                self._conn.execute('DELETE FROM entries WHERE key = ?', (key,))
+                return None
+            self._conn.execute('UPDATE entries SET last_used = ? WHERE key = ?', (time.time(), key))
+        return CacheEntry(key, path, *row)
+
+    def is_fresh(self, entry: CacheEntry) -> bool:
+        return time.time() - entry.fetched_at < self.ttl
+
+    def store(self, key: str, tmp: Path, content_type: str, etag: Optional[str], last_modified: Optional[str]) -> CacheEntry:
+        """将已下载完成的临时文件登记为缓存条目。"""
+        path = self._path(key)
+        os.replace(tmp, path)
+        size = path.stat().st_size
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (key, size, content_type, etag, last_modified, now, now),
+            )
+            self._evict(keep=key)
+        return CacheEntry(key, path, size, content_type, etag, last_modified, now)
+
+    def mark_revalidated(self, entry: CacheEntry) -> CacheEntry:
+        """上游返回 304：刷新条目的验证时间。"""
+        now = time.time()
+        with self._lock:
+            self._conn.execute('UPDATE entries SET fetched_at = ?, last_used = ? WHERE key = ?', (now, now, entry.key))
+        self.revalidated += 1
+        return entry._replace(fetched_at=now)
+
+    def _evict(self, keep: str) -> None:
+        total = self._conn.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for key, size in self._conn.execute('SELECT key, size FROM entries ORDER BY last_used').fetchall():
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            try:
+                self._path(key).unlink()
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                # 文件正被读取（Windows）等情况，留待下次淘汰
+                logger.debug(f"淘汰预览缓存 {key} 失败: {e}")
+                continue
+            self._conn.execute('DELETE FROM entries WHERE key = ?', (key,))
+            total -= size
+            self.evictions += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            entries, size = self._conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries').fetchone()
+        lookups = self.hits + self.revalidated + self.misses
+        return {
+            "entries": entries,
+            "bytes": size,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "revalidated": self.revalidated,
+            "misses": self.misses,
+            "uncacheable": self.uncacheable,
+            "hit_ratio": round((self.hits + self.revalidated) / lookups, 3) if lookups else None,
+            "not_modified_to_client": self.not_modified,
+            "bytes_served": self.served_bytes,
+            "bytes_from_upstream": self.upstream_bytes,
+            "bytes_saved": max(0, self.served_bytes - self.upstream_bytes),
+            "evictions": self.evictions,
+            "renditions_rendered": self.renditions,
+        }
+
+    def close(self) -> None:
+        try:
+            with self._lock:
+                self._conn.close()
+        except sqlite3.Error as e:
+            logger.warning(f"关闭预览缓存索引失败: {e}")
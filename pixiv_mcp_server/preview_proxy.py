@@ -1,66 +1,728 @@
 import asyncio
 import logging
 import os
-from urllib.parse import urlparse
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, NamedTuple, Optional, Tuple
+from urllib.parse import parse_qsl, urlparse
 
-from aiohttp import web, ClientSession, ClientTimeout
+import aiofiles
+from aiohttp import web, ClientSession, ClientTimeout, TCPConnector
+from aiohttp.abc import AbstractResolver
+
+from .bandwidth import BandwidthLimiter
+from .config import settings
+from .preview_cache import CacheEntry, PreviewCache, client_etag
+from .singleflight import SingleFlight
+from .thumbnailer import FORMAT_ALIASES, RENDITION_FORMATS, render_thumbnail_in_pool, resolve_format
+from .thumbnailer import shutdown_executor as shutdown_thumbnailer
 
 logger = logging.getLogger('pixiv-mcp-server')
 
+# 读取上游响应的分块大小，每块计入一次带宽限制；单个请求的内存占用以此为上限
+PROXY_CHUNK_SIZE = 64 * 1024
+
+# 转发给上游的客户端请求头（支持断点与部分请求）
+FORWARD_REQUEST_HEADERS = ('Range', 'If-Range')
+# 原样转发给客户端的上游响应头
+FORWARD_RESPONSE_HEADERS = (
+    'Content-Type', 'Content-Length', 'Content-Range', 'Content-Encoding',
+    'Accept-Ranges', 'ETag', 'Last-Modified',
+)
+
+UPSTREAM_HEADERS = {
+    'Referer': 'https://www.pixiv.net/',
+    'User-Agent': 'Mozilla/5.0 (PixivPreviewProxy)',
+}
+
+# 缩略图参数的取值范围，避免借代理渲染任意大的图片
+MAX_RENDITION_DIMENSION = 4096
+DEFAULT_RENDITION_QUALITY = 80
+RENDITION_PARAMS = ('w', 'h', 'fmt', 'q')
+
+# 预取只是优化：队列满时直接丢弃，并发也远低于交互请求
+PREFETCH_QUEUE_SIZE = 256
+PREFETCH_WORKERS = 2
+# 记录最近预取的缓存键，用于统计命中率
+PREFETCH_HISTORY = 1024
+
+
+class Rendition(NamedTuple):
+    """请求的缩略图版本：在 width x height 内等比缩放（不放大），转码为 fmt（None 为保持原格式）。"""
+    width: Optional[int]
+    height: Optional[int]
+    fmt: Optional[str]
+    quality: int
+
+    @property
+    def variant(self) -> str:
+        return f'w={self.width or ""}&h={self.height or ""}&fmt={self.fmt or ""}&q={self.quality}'
+
+
+def _parse_int(value: Optional[str], name: str, low: int, high: int) -> Optional[int]:
+    if value is None or value.strip() == '':
+        return None
+    try:
+        number = int(value)
+    except ValueError:
+        raise ValueError(f'invalid {name}')
+    if not low <= number <= high:
+        raise ValueError(f'{name} must be between {low} and {high}')
+    return number
+
+
+def parse_rendition(query) -> Optional[Rendition]:
+    """从查询参数解析缩略图请求；未携带任何缩略图参数时返回 None，参数非法时抛出 ValueError。"""
+    if not any(name in query for name in RENDITION_PARAMS):
+        return None
+    width = _parse_int(query.get('w'), 'w', 1, MAX_RENDITION_DIMENSION)
+    height = _parse_int(query.get('h'), 'h', 1, MAX_RENDITION_DIMENSION)
+    quality = _parse_int(query.get('q'), 'q', 1, 100) or DEFAULT_RENDITION_QUALITY
+    fmt = (query.get('fmt') or '').strip().lower() or None
+    if fmt is not None:
+        if FORMAT_ALIASES.get(fmt, fmt) not in RENDITION_FORMATS:
+            raise ValueError(f'unsupported fmt, expected one of: {", ".join(RENDITION_FORMATS)}')
+        fmt = resolve_format(fmt)
+    return Rendition(width, height, fmt, quality)
+
+
+def _host_allowed(url: str) -> bool:
+    """仅允许 Pixiv 图片域名，避免滥用。"""
+    host = (urlparse(url).hostname or '').lower()
+    return host.endswith('pximg.net') or host.endswith('pixiv.net')
+
+
+def _parse_proxy_url(proxy_url: str) -> Optional[Tuple[str, Optional[Rendition]]]:
+    """把注入的代理直链（/pximg?url=...&w=...）还原为上游 URL 与缩略图参数，无效时返回 None。"""
+    try:
+        query = dict(parse_qsl(urlparse(proxy_url).query))
+        url = query.get('url', '').strip()
+        if not url or not _host_allowed(url):
+            return None
+        return url, parse_rendition(query)
+    except ValueError:
+        return None
+
+
+class Prefetcher:
+    """
+    卡片渲染后预先填充预览缓存，使客户端稍后请求缩略图时直接命中本地缓存。
+    主线程通过 submit 投递代理直链，实际获取在代理自己的事件循环中由少量工作协程完成；
+    已预取的条目随后被客户端请求到时计为命中，客户端先于预取完成到达时计为迟到。
+    """
+
+    def __init__(self, ctx: 'ProxyContext'):
+        self.ctx = ctx
+        self.loop: asyncio.AbstractEventLoop | None = None
+        self._queue: asyncio.Queue | None = None
+        self._workers: List[asyncio.Task] = []
+        # 缓存键 -> 是否已完成预取
+        self._prefetched: 'OrderedDict[str, bool]' = OrderedDict()
+        self.queued = 0
+        self.dropped = 0
+        self.skipped = 0
+        self.fetched = 0
+        self.failed = 0
+        self.hits = 0
+        self.late_hits = 0
+
+    def start(self) -> None:
+        self.loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue(PREFETCH_QUEUE_SIZE)
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(PREFETCH_WORKERS)]
+
+    async def stop(self) -> None:
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        self.loop = None
+
+    def submit(self, proxy_urls: Iterable[str]) -> None:
+        """线程安全：投递待预取的代理直链。"""
+        loop = self.loop
+        if loop is None or loop.is_closed():
+            return
+        loop.call_soon_threadsafe(self._enqueue, list(proxy_urls))
+
+    def _enqueue(self, proxy_urls: List[str]) -> None:
+        cache = self.ctx.cache
+        if cache is None or self._queue is None:
+            return
+        for proxy_url in proxy_urls:
+            target = _parse_proxy_url(proxy_url)
+            if target is None:
+                continue
+            url, rendition = target
+            key = _entry_key(cache, url, rendition)
+            if key in self._prefetched:
+                continue
+            try:
+                self._queue.put_nowait((key, url, rendition))
+            except asyncio.QueueFull:
+                self.dropped += 1
+                continue
+            self.queued += 1
+            self._prefetched[key] = False
+            while len(self._prefetched) > PREFETCH_HISTORY:
+                self._prefetched.popitem(last=False)
+
+    async def _worker(self) -> None:
+        while True:
+            key, url, rendition = await self._queue.get()
+            try:
+                await self._prefetch(key, url, rendition)
+            finally:
+                self._queue.task_done()
+
+    async def _prefetch(self, key: str, url: str, rendition: Optional[Rendition]) -> None:
+        cache = self.ctx.cache
+        if cache is None or key not in self._prefetched:
+            # 客户端已先行请求，无需再预取
+            return
+        entry = cache.lookup(key)
+        if entry is not None and cache.is_fresh(entry):
+            self.skipped += 1
+            self._prefetched.pop(key, None)
+            return
+        try:
+            # 预取按批量流量计入带宽限制，让位于客户端实际发起的请求
+            entry = await _resolve_entry(self.ctx, url, rendition, interactive=False)
+        except Exception as e:
+            logger.debug(f'预取预览失败 {url}: {e}')
+            entry = None
+        if entry is None:
+            self.failed += 1
+            self._prefetched.pop(key, None)
+            return
+        self.fetched += 1
+        if key in self._prefetched:
+            self._prefetched[key] = True
+
+    def note_request(self, key: str) -> None:
+        """客户端请求了某个条目：若它来自预取，则记入命中统计。"""
+        done = self._prefetched.pop(key, None)
+        if done is True:
+            self.hits += 1
+        elif done is False:
+            self.late_hits += 1
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "queued": self.queued,
+            "pending": self._queue.qsize() if self._queue is not None else 0,
+            "dropped": self.dropped,
+            "skipped_cached": self.skipped,
+            "fetched": self.fetched,
+            "failed": self.failed,
+            "hits": self.hits,
+            "late_hits": self.late_hits,
+            "hit_rate": round(self.hits / self.fetched, 3) if self.fetched else None,
+        }
+
+
+class ProxyContext:
+    """
+    预览代理应用内共享的状态：一个长连接的上游 ClientSession（连接池、DNS 缓存、keep-alive）、
+    可选的磁盘图片缓存及代理配置。会话与缓存在应用启动时创建，在 runner.cleanup 时关闭。
+    resolver 仅供基准测试将图片域名解析到本地服务器。
+    """
+
+    def __init__(
+        self,
+        proxy: str | None,
+        bandwidth: BandwidthLimiter | None = None,
+        pool_size: int | None = None,
+        pool_per_host: int | None = None,
+        resolver: AbstractResolver | None = None,
+        cache_dir: str | None = None,
+    ):
+        self.proxy = proxy or None
+        self.bandwidth = bandwidth
+        self.pool_size = pool_size or settings.preview_proxy_pool_size
+        self.pool_per_host = pool_per_host or settings.preview_proxy_pool_per_host
+        self.resolver = resolver
+        self.cache_dir = cache_dir
+        self.session: ClientSession | None = None
+        self.cache: PreviewCache | None = None
+        self.prefetcher: Prefetcher | None = None
+        # 合并同一图片的并发缓存填充
+        self.fills = SingleFlight()
+        # 代理运行所在的后台线程及其事件循环，由 start_preview_proxy 设置
+        self.thread: threading.Thread | None = None
+        self.loop: asyncio.AbstractEventLoop | None = None
+
+    async def start(self, app: web.Application) -> None:
+        connector = TCPConnector(
+            limit=self.pool_size,
+            limit_per_host=self.pool_per_host,
+            ttl_dns_cache=300,
+            keepalive_timeout=60,
+            resolver=self.resolver,
+        )
+        # 不解压上游响应，使转发的 Content-Length / Content-Range 与字节流一致
+        self.session = ClientSession(
+            connector=connector,
+            # 大图可能传输较久，只限制连接与单次读取的等待时间
+            timeout=ClientTimeout(total=None, sock_connect=30, sock_read=30),
+            auto_decompress=False,
+        )
+        if self.cache_dir:
+            try:
+                self.cache = PreviewCache(self.cache_dir, settings.preview_cache_max_bytes, settings.preview_cache_ttl)
+            except Exception as e:
+                logger.warning(f"无法打开预览缓存 {self.cache_dir}: {e}")
+                self.cache = None
+        if self.cache is not None:
+            self.prefetcher = Prefetcher(self)
+            self.prefetcher.start()
+
+    async def close(self, app: web.Application) -> None:
+        if self.prefetcher is not None:
+            await self.prefetcher.stop()
+            self.prefetcher = None
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+        if self.cache is not None:
+            self.cache.close()
+            self.cache = None
+        shutdown_thumbnailer()
+
+    async def stop(self, timeout: float = 10.0) -> None:
+        """从其他线程的事件循环调用：停止代理的事件循环，等待其完成清理（关闭会话、预取与缩略图进程池）。"""
+        loop, thread = self.loop, self.thread
+        if loop is not None:
+            try:
+                loop.call_soon_threadsafe(loop.stop)
+            except RuntimeError:
+                # 事件循环已自行退出并关闭
+                pass
+        if thread is not None:
+            await asyncio.to_thread(thread.join, timeout)
+            if thread.is_alive():
+                logger.warning('预览代理未能在限定时间内退出')
+            self.thread = None
+
+    def prefetch(self, proxy_urls: Iterable[str]) -> None:
+        """从其他线程调用：以低优先级预取这些代理直链，未启用缓存时忽略。"""
+        if self.prefetcher is not None:
+            self.prefetcher.submit(proxy_urls)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "cache": self.cache.stats() if self.cache else None,
+            "fills": self.fills.stats(),
+            "resize_workers": settings.preview_resize_workers,
+            "prefetch": self.prefetcher.stats() if self.prefetcher else None,
+        }
+
+
+class _ClientTee:
+    """
+    缓存未命中时发起填充的客户端请求：上游响应边写入缓存临时文件边转发给该客户端，
+    客户端无需等待整张图片落盘；响应不可缓存时也直接转发，不必再向上游请求一次。
+    客户端中途断开时停止转发，缓存填充照常完成。
+    """
+
+    def __init__(self, request: web.Request):
+        self.request = request
+        self.response: Optional[web.StreamResponse] = None
+        self.connected = True
+
+    async def prepare(self, status: int, headers: Dict[str, str]) -> None:
+        self.response = web.StreamResponse(status=status, headers=headers)
+        try:
+            await self.response.prepare(self.request)
+        except ConnectionResetError:
+            self.connected = False
+
+    async def write(self, chunk: bytes) -> None:
+        if not self.connected:
+            return
+        try:
+            await self.response.write(chunk)
+        except ConnectionResetError:
+            self.connected = False
+            logger.debug(f'客户端已断开: {self.request.query.get("url", "")}')
+
+    async def finish(self) -> None:
+        if self.connected:
+            try:
+                await self.response.write_eof()
+            except ConnectionResetError:
+                self.connected = False
+
+    def abort(self) -> None:
+        """响应头已发出后上游失败：无法再改为错误响应，只能中断连接让客户端感知。"""
+        if self.request.transport is not None:
+            self.request.transport.close()
+
+
+def _forwarded_headers(resp) -> Dict[str, str]:
+    return {name: resp.headers[name] for name in FORWARD_RESPONSE_HEADERS if name in resp.headers}
+
+
+def _cache_headers(cache: PreviewCache, etag: Optional[str], last_modified: Optional[str]) -> Dict[str, str]:
+    """经缓存发出的响应头，与之后从缓存发送同一条目时一致。"""
+    headers = {'Cache-Control': f'public, max-age={cache.ttl}', 'Accept-Ranges': 'bytes'}
+    if etag:
+        headers['ETag'] = etag
+    if last_modified:
+        headers['Last-Modified'] = last_modified
+    return headers
 
-async def _handle_pximg(request: web.Request, proxy: str | None) -> web.StreamResponse:
+
+async def _fill_cache(
+    ctx: ProxyContext, key: str, url: str, stale: Optional[CacheEntry], interactive: bool = True,
+    tee: Optional[_ClientTee] = None,
+) -> Optional[CacheEntry]:
+    """
+    从上游获取图片写入缓存；有过期条目时携带验证头，上游返回 304 则直接续期。
+    返回 None 表示该响应不可缓存（非 200、过大等），未经 tee 转发时由调用方改走直通转发。
+    interactive=False（预取）时按批量流量计入带宽限制。
+    提供 tee 时同一个上游响应同时转发给该客户端（见 _ClientTee），只有完整的 200 响应才写入缓存；
+    有过期条目时非 200 响应不转发，由调用方退回过期条目。
+    """
+    cache = ctx.cache
+    headers = dict(UPSTREAM_HEADERS)
+    if stale is not None:
+        if stale.etag:
+            headers['If-None-Match'] = stale.etag
+        if stale.last_modified:
+            headers['If-Modified-Since'] = stale.last_modified
+
+    async with ctx.session.get(url, headers=headers, proxy=ctx.proxy) as resp:
+        if resp.status == 304 and stale is not None:
+            return cache.mark_revalidated(stale)
+        length = resp.content_length
+        if resp.status != 200 or 'Content-Encoding' in resp.headers or (length or 0) > cache.max_entry_bytes:
+            cache.uncacheable += 1
+            if tee is not None and (resp.status == 200 or stale is None):
+                await _tee_body(ctx, resp, tee, None, interactive)
+            return None
+
+        if tee is not None:
+            etag = resp.headers.get('ETag')
+            if etag is None and length is not None:
+                etag = client_etag(key, length)
+            response_headers = _cache_headers(cache, etag, resp.headers.get('Last-Modified'))
+            response_headers['Content-Type'] = resp.headers.get('Content-Type', 'application/octet-stream')
+            if length is not None:
+                response_headers['Content-Length'] = str(length)
+            await tee.prepare(200, response_headers)
+
+        tmp = cache.temp_path(key)
+        try:
+            received = await _tee_body(ctx, resp, tee, tmp, interactive)
+            if received is None:
+                cache.uncacheable += 1
+                return None
+            cache.upstream_bytes += received
+            cache.misses += 1
+            return cache.store(
+                key, tmp,
+                content_type=resp.headers.get('Content-Type', 'application/octet-stream'),
+                etag=resp.headers.get('ETag'),
+                last_modified=resp.headers.get('Last-Modified'),
+            )
+        finally:
+            if tmp.exists():
+                tmp.unlink()
+
+
+async def _tee_body(
+    ctx: ProxyContext, resp, tee: Optional[_ClientTee], tmp: Optional[Path], interactive: bool
+) -> Optional[int]:
+    """
+    读取上游响应体，写入缓存临时文件 tmp 并/或转发给 tee 的客户端。
+    返回写入 tmp 的字节数；未写入缓存（tmp 为空或超过单条目上限）时返回 None。
+    """
+    if tee is not None and tee.response is None:
+        await tee.prepare(resp.status, _forwarded_headers(resp))
+    f = await aiofiles.open(tmp, 'wb') if tmp is not None else None
+    received = 0
+    try:
+        async for chunk in resp.content.iter_chunked(PROXY_CHUNK_SIZE):
+            received += len(chunk)
+            if f is not None and received > ctx.cache.max_entry_bytes:
+                # 比 Content-Length 声明的大（或未声明）：放弃缓存，只继续转发
+                await f.close()
+                f = None
+            if f is None and (tee is None or not tee.connected):
+                return None
+            if ctx.bandwidth is not None:
+                await ctx.bandwidth.acquire(len(chunk), interactive=interactive)
+            if f is not None:
+                await f.write(chunk)
+            if tee is not None:
+                await tee.write(chunk)
+        if tee is not None:
+            await tee.finish()
+    except Exception:
+        if tee is not None and tee.response is not None:
+            tee.abort()
+        raise
+    finally:
+        if f is not None:
+            await f.close()
+    return received if f is not None else None
+
+
+def _client_has_current(request: web.Request, entry: CacheEntry) -> bool:
+    """客户端携带的验证头是否与缓存条目一致。"""
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match is not None:
+        tags = [tag.strip() for tag in if_none_match.split(',')]
+        return '*' in tags or entry.client_etag in tags or f'W/{entry.client_etag}' in tags
+    return entry.last_modified is not None and request.headers.get('If-Modified-Since') == entry.last_modified
+
+
+async def _send_entry(request: web.Request, entry: CacheEntry, cache: PreviewCache) -> web.StreamResponse:
+    """从磁盘发送缓存条目，支持 304 与单段 Range 请求。"""
+    headers = _cache_headers(cache, entry.client_etag, entry.last_modified)
+    if _client_has_current(request, entry):
+        cache.not_modified += 1
+        return web.Response(status=304, headers=headers)
+
+    start, end = 0, entry.size
+    status = 200
+    if 'Range' in request.headers and request.headers.get('If-Range', entry.client_etag) == entry.client_etag:
+        try:
+            rng = request.http_range
+        except ValueError:
+            # 多段等无法解析的范围按规范忽略，返回完整内容
+            rng = slice(None, None)
+        if rng.start is not None or rng.stop is not None:
+            start, end = rng.indices(entry.size)[:2]
+            if start >= end:
+                headers['Content-Range'] = f'bytes */{entry.size}'
+                return web.Response(status=416, headers=headers)
+            status = 206
+            headers['Content-Range'] = f'bytes {start}-{end - 1}/{entry.size}'
+
+    response = web.StreamResponse(status=status, headers=headers)
+    response.content_type = entry.content_type
+    response.content_length = end - start
+    await response.prepare(request)
+    try:
+        async with aiofiles.open(entry.path, 'rb') as f:
+            await f.seek(start)
+            remaining = end - start
+            while remaining > 0:
+                chunk = await f.read(min(PROXY_CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                await response.write(chunk)
+                remaining -= len(chunk)
+                cache.served_bytes += len(chunk)
+        await response.write_eof()
+    except ConnectionResetError:
+        logger.debug(f'客户端已断开: {entry.key}')
+    return response
+
+
+async def _cached_entry(
+    ctx: ProxyContext, key: str, fill: Callable[[Optional[CacheEntry]], Awaitable[Optional[CacheEntry]]]
+) -> Optional[CacheEntry]:
+    """
+    取新鲜的缓存条目，缺失或过期时通过 fill（参数为过期条目）合并填充。
+    填充失败或得到不可缓存的响应时，有过期条目则退回过期条目；否则返回 None 表示不可缓存。
+    """
+    cache = ctx.cache
+    entry = cache.lookup(key)
+    if entry is not None and cache.is_fresh(entry):
+        cache.hits += 1
+        return entry
+    stale = entry
+    try:
+        entry = await ctx.fills.do(key, lambda: fill(stale))
+    except Exception as e:
+        if stale is None:
+            raise
+        # 上游不可用时退回过期的缓存，预览总比报错好
+        logger.warning(f'重新验证预览缓存失败，使用过期条目: {e}')
+        return stale
+    if entry is None and stale is not None:
+        # 上游返回了不可缓存的响应（如 5xx），同样退回过期条目
+        logger.warning(f'重新验证预览缓存未得到可用响应，使用过期条目: {key}')
+        return stale
+    return entry
+
+
+async def _source_entry(
+    ctx: ProxyContext, url: str, interactive: bool = True, tee: Optional[_ClientTee] = None
+) -> Optional[CacheEntry]:
+    key = ctx.cache.key_for(url)
+    return await _cached_entry(ctx, key, lambda stale: _fill_cache(ctx, key, url, stale, interactive, tee))
+
+
+async def _fill_rendition(
+    ctx: ProxyContext, key: str, url: str, rendition: Rendition, interactive: bool = True
+) -> Optional[CacheEntry]:
+    """由缓存中的原图渲染缩略图版本并写入缓存；原图不可缓存时返回 None。"""
+    cache = ctx.cache
+    source = await _source_entry(ctx, url, interactive)
+    if source is None:
+        return None
+    tmp = cache.temp_path(key)
+    try:
+        content_type = await render_thumbnail_in_pool(
+            settings.preview_resize_workers,
+            source_path=str(source.path),
+            output_path=str(tmp),
+            width=rendition.width,
+            height=rendition.height,
+            fmt=rendition.fmt,
+            quality=rendition.quality,
+        )
+        cache.renditions += 1
+        return cache.store(key, tmp, content_type=content_type, etag=None, last_modified=source.last_modified)
+    finally:
+        if tmp.exists():
+            tmp.unlink()
+
+
+def _entry_key(cache: PreviewCache, url: str, rendition: Optional[Rendition]) -> str:
+    return cache.key_for(url, rendition.variant if rendition is not None else '')
+
+
+async def _resolve_entry(
+    ctx: ProxyContext, url: str, rendition: Optional[Rendition], interactive: bool = True,
+    tee: Optional[_ClientTee] = None,
+) -> Optional[CacheEntry]:
+    """
+    取原图或缩略图版本的缓存条目，必要时从上游填充；返回 None 表示不可缓存。
+    interactive 为填充时的带宽优先级：客户端请求为交互流量，预取为批量流量。
+    tee 只用于原图：本次调用负责填充时，上游响应同时转发给该客户端。
+    """
+    if rendition is None:
+        return await _source_entry(ctx, url, interactive, tee)
+    key = _entry_key(ctx.cache, url, rendition)
+    return await _cached_entry(ctx, key, lambda stale: _fill_rendition(ctx, key, url, rendition, interactive))
+
+
+async def _serve_from_cache(
+    request: web.Request, ctx: ProxyContext, url: str, rendition: Optional[Rendition] = None
+) -> Optional[web.StreamResponse]:
+    """
+    经缓存响应（可选渲染为缩略图版本）；返回 None 时由调用方直通转发原图。
+    原图未命中且由本请求填充时，填充过程中已把上游响应转发给客户端，直接返回该响应。
+    """
+    if ctx.prefetcher is not None:
+        ctx.prefetcher.note_request(_entry_key(ctx.cache, url, rendition))
+    # 范围请求需要完整的缓存条目才能切片，不边填充边转发
+    tee = _ClientTee(request) if rendition is None and 'Range' not in request.headers else None
+    try:
+        entry = await _resolve_entry(ctx, url, rendition, tee=tee)
+    except Exception:
+        if tee is not None and tee.response is not None:
+            # 响应已在填充时开始发送，连接已由 _tee_body 中断
+            return tee.response
+        raise
+    if tee is not None and tee.response is not None:
+        return tee.response
+    if entry is None:
+        return None
+    return await _send_entry(request, entry, ctx.cache)
+
+
+async def _stream_passthrough(request: web.Request, ctx: ProxyContext, url: str) -> web.StreamResponse:
+    """不经缓存，将上游响应逐块直通给客户端。"""
+    headers = dict(UPSTREAM_HEADERS)
+    for name in FORWARD_REQUEST_HEADERS:
+        if name in request.headers:
+            headers[name] = request.headers[name]
+
+    async with ctx.session.get(url, headers=headers, proxy=ctx.proxy) as resp:
+        response = web.StreamResponse(status=resp.status, headers=_forwarded_headers(resp))
+        await response.prepare(request)
+        # 上游数据块直接写给客户端，不在内存中拼接整张图片
+        try:
+            async for chunk in resp.content.iter_chunked(PROXY_CHUNK_SIZE):
+                # 预览属于交互流量，优先于后台下载获得带宽
+                if ctx.bandwidth is not None:
+                    await ctx.bandwidth.acquire(len(chunk), interactive=True)
+                await response.write(chunk)
+            await response.write_eof()
+        except ConnectionResetError:
+            logger.debug(f'客户端已断开: {url}')
+        except Exception as e:
+            # 响应头已发出，无法再改为错误响应，只能中断连接让客户端感知
+            logger.warning(f'Fetch failed mid-stream: {e}')
+            if request.transport is not None:
+                request.transport.close()
+        return response
+
+
+async def _handle_pximg(request: web.Request, ctx: ProxyContext) -> web.StreamResponse:
     url = request.query.get('url', '').strip()
     if not url:
         return web.json_response({'ok': False, 'error': 'missing url'}, status=400)
 
     try:
-        p = urlparse(url)
+        allowed = _host_allowed(url)
     except Exception:
         return web.json_response({'ok': False, 'error': 'invalid url'}, status=400)
-
-    # 仅允许 Pixiv 图片域名，避免滥用
-    host = (p.hostname or '').lower()
-    if not (host.endswith('pximg.net') or host.endswith('pixiv.net')):
+    if not allowed:
         return web.json_response({'ok': False, 'error': 'host not allowed'}, status=403)
 
-    headers = {
-        'Referer': 'https://www.pixiv.net/',
-        'User-Agent': 'Mozilla/5.0 (PixivPreviewProxy)',
-    }
-    timeout = ClientTimeout(total=30)
+    try:
+        rendition = parse_rendition(request.query)
+    except ValueError as e:
+        return web.json_response({'ok': False, 'error': str(e)}, status=400)
 
-    async with ClientSession(timeout=timeout) as session:
-        try:
-            async with session.get(url, headers=headers, proxy=proxy) as resp:
-                content = await resp.read()
-                ctype = resp.headers.get('Content-Type', 'application/octet-stream')
-                return web.Response(body=content, content_type=ctype, status=resp.status)
-        except Exception as e:
-            logger.warning(f'Fetch failed: {e}')
-            return web.json_response({'ok': False, 'error': str(e)}, status=502)
+    try:
+        # 缩略图版本由缓存中的原图渲染，未启用缓存时退回原图直通
+        if ctx.cache is not None:
+            response = await _serve_from_cache(request, ctx, url, rendition)
+            if response is not None:
+                return response
+        return await _stream_passthrough(request, ctx, url)
+    except Exception as e:
+        logger.warning(f'Fetch failed: {e}')
+        return web.json_response({'ok': False, 'error': str(e)}, status=502)
 
 
-def start_preview_proxy(host: str, port: int, proxy: str | None) -> None:
+def create_preview_app(ctx: ProxyContext) -> web.Application:
+    """创建预览代理应用，上游会话随应用的启动与清理创建和关闭。"""
+    async def handler_wrapper(request):
+        return await _handle_pximg(request, ctx)
+
+    app = web.Application()
+    app.on_startup.append(ctx.start)
+    app.on_cleanup.append(ctx.close)
+    app.add_routes([web.get('/pximg', handler_wrapper)])
+    return app
+
+
+def start_preview_proxy(
+    host: str, port: int, proxy: str | None, bandwidth: BandwidthLimiter | None = None, cache_dir: str | None = None
+) -> ProxyContext:
+    """在后台线程中启动预览代理，返回其共享状态（用于读取统计与停止代理）。"""
+    ctx = ProxyContext(proxy, bandwidth, cache_dir=cache_dir)
+
     def _run():
         loop = asyncio.new_event_loop()
         asyncio.set_event_loop(loop)
-        
-        async def handler_wrapper(request):
-            return await _handle_pximg(request, proxy)
-
-        app = web.Application()
-        app.add_routes([web.get('/pximg', handler_wrapper)])
-        runner = web.AppRunner(app)
-        loop.run_until_complete(runner.setup())
-        site = web.TCPSite(runner, host=host, port=port)
-        loop.run_until_complete(site.start())
-        logger.info(f'预览代理已监听 http://{host}:{port}/pximg?url=...')
+        ctx.loop = loop
+
+        runner = web.AppRunner(create_preview_app(ctx))
         try:
+            loop.run_until_complete(runner.setup())
+            site = web.TCPSite(runner, host=host, port=port)
+            loop.run_until_complete(site.start())
+            logger.info(f'预览代理已监听 http://{host}:{port}/pximg?url=...')
             loop.run_forever()
+        except Exception as e:
+            logger.warning(f'预览代理运行失败: {e}')
         finally:
+            # runner.cleanup 触发 on_cleanup，关闭上游会话、预取与缩略图进程池
             loop.run_until_complete(runner.cleanup())
+            ctx.loop = None
             loop.close()
 
-    import threading
-    th = threading.Thread(target=_run, name='pximg-proxy', daemon=True)
-    th.start()
+    ctx.thread = threading.Thread(target=_run, name='pximg-proxy', daemon=True)
+    ctx.thread.start()
+    return ctx
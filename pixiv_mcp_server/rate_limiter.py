@@ -0,0 +1,120 @@
+import asyncio
+import random
+import time
+from typing import Any, Dict, Optional
+
+from pixivpy3 import PixivError
+
+
+class RateLimitedError(PixivError):
+    """上游返回 429 等限流响应时抛出。"""
+
+
+def is_rate_limited_response(result: Any) -> bool:
+    """判断 API 返回的错误字典是否为限流错误（app-api 以 403 + "Rate Limit" 表示）。"""
+    if not isinstance(result, dict) or 'error' not in result:
+        return False
+    return 'rate limit' in str(result.get('error', '')).lower()
+
+
+class AdaptiveRateLimiter:
+    """
+    令牌桶限流器，按 AIMD 自适应调整速率：
+    每次成功请求加性恢复速率，遇到 429/限流响应时乘性减半，
+    使吞吐稳定在上游限额之下，而不是让任务直接失败。
+    rate <= 0 时不限流。
+    """
+
+    def __init__(
+        self,
+        rate: float,
+        burst: float,
+        min_rate: float = 0.5,
+        increase_step: float = 0.05,
+        decrease_factor: float = 0.5,
+        cooldown: float = 1.0,
+    ):
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = max(burst, 1.0)
+        self.min_rate = min(min_rate, rate) if rate > 0 else min_rate
+        self.increase_step = increase_step
+        self.decrease_factor = decrease_factor
+        self.cooldown = cooldown
+        self.throttle_events = 0
+        self.acquired = 0
+        self._tokens = self.burst
+        self._updated_at = time.monotonic()
+        self._last_decrease = 0.0
+        self._lock = asyncio.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_rate > 0
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+    async def acquire(self, tokens: float = 1.0) -> None:
+        """获取令牌；令牌不足时按当前速率等待。锁保证等待者按先来后到获取。"""
+        if not self.enabled:
+            return
+        async with self._lock:
+            while True:
+                if not self.enabled:
+                    # 等待期间被改为不限流
+                    return
+                self._refill()
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    self.acquired += 1
+                    return
+                await asyncio.sleep((tokens - self._tokens) / self.rate)
+
+    def configure(
+        self, rate: Optional[float] = None, burst: Optional[float] = None, min_rate: Optional[float] = None
+    ) -> None:
+        """运行时调整参数。设置 rate 时当前速率重置为新的上限，之后照常按 AIMD 调整。"""
+        self._refill()
+        if rate is not None:
+            self.max_rate = self.rate = rate
+        if burst is not None:
+            self.burst = max(burst, 1.0)
+            self._tokens = min(self._tokens, self.burst)
+        if min_rate is not None:
+            self.min_rate = min(min_rate, self.max_rate) if self.max_rate > 0 else min_rate
+        if self.enabled:
+            self.rate = min(self.max_rate, max(self.rate, self.min_rate))
+
+    def on_success(self) -> None:
+        if self.enabled and self.rate < self.max_rate:
+            self.rate = min(self.max_rate, self.rate + self.increase_step)
+
+    def on_throttle(self) -> None:
+        """记录一次限流；冷却期内的连续限流只降速一次，避免一个突发把速率降到底。"""
+        self.throttle_events += 1
+        if not self.enabled:
+            return
+        now = time.monotonic()
+        if now - self._last_decrease >= self.cooldown:
+            self._refill()
+            self.rate = max(self.min_rate, self.rate * self.decrease_factor)
+            self._tokens = min(self._tokens, 0.0)
+            self._last_decrease = now
+
+    def backoff_delay(self, attempt: int, base: float = 1.0, cap: float = 30.0) -> float:
+        """带抖动的指数退避时长。"""
+        return min(cap, base * (2 ** attempt)) * random.uniform(0.5, 1.5)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "current_rate": round(self.rate, 3),
+            "max_rate": self.max_rate,
+            "min_rate": self.min_rate,
+            "burst": self.burst,
+            "acquired": self.acquired,
+            "throttle_events": self.throttle_events,
+        }
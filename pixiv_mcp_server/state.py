@@ -1,22 +1,36 @@
 import asyncio
 import logging
 import os
+import time
 from typing import Optional, TYPE_CHECKING, Dict, Any
 
 from pixivpy3 import AppPixivAPI
 
+from .bandwidth import BandwidthLimiter
+from .concurrency import AdaptiveLimiter, ResizableLimiter
 from .config import settings
+from .rate_limiter import AdaptiveRateLimiter
+from .task_registry import TaskRegistry
 
 if TYPE_CHECKING:
     from .api_client import PixivAPIClient
+    from .auth import TokenRefresher
+    from .journal import DownloadJournal
+    from .library import LibraryIndex
+    from .preview_proxy import ProxyContext
+    from .ugoira_cache import UgoiraCache
 
 logger = logging.getLogger('pixiv-mcp-server')
 
 class PixivState:
     """一个用于封装所有服务器状态的类。"""
     def __init__(self):
+        # 进程启动时间，用于统计首次工具响应耗时
+        self.started_at = time.perf_counter()
+        self.first_response_at: Optional[float] = None
         self.api = AppPixivAPI()
         self.api_client: Optional["PixivAPIClient"] = None
+        self.token_refresher: Optional["TokenRefresher"] = None
         self.is_authenticated = False
         self.user_id: Optional[int] = None
         self.refresh_token: Optional[str] = settings.pixiv_refresh_token
@@ -27,9 +41,21 @@ class PixivState:
         self.preview_proxy_enabled = settings.preview_proxy_enabled
         self.preview_proxy_host = settings.preview_proxy_host
         self.preview_proxy_port = settings.preview_proxy_port
+        # 运行中的预览代理（在独立线程中），用于读取其统计
+        self.preview_proxy: Optional["ProxyContext"] = None
         
         # 下载任务状态跟踪
-        self.download_tasks = {}
+        self.download_tasks = TaskRegistry(
+            max_tasks=settings.task_registry_max_tasks, ttl=settings.task_registry_ttl
+        )
+        # 正在运行的下载任务句柄（task_id -> asyncio.Task），用于真正取消任务
+        self.download_task_handles: Dict[str, asyncio.Task] = {}
+        # 持久化的下载任务日志，由下载队列在启动时打开
+        self.download_journal: Optional["DownloadJournal"] = None
+        # 动图转换结果缓存，由下载队列在启动时打开
+        self.ugoira_cache: Optional["UgoiraCache"] = None
+        # 已下载作品索引，由下载队列在启动时打开
+        self.library_index: Optional["LibraryIndex"] = None
         
         # 上一次可分页的API调用，用于 next_page
         self.last_api_call: Optional[Dict[str, Any]] = None
@@ -37,10 +63,30 @@ class PixivState:
         # 动图输出格式 (gif, webp)
         self.ugoira_format = settings.ugoira_format
 
-        # 并发控制器
-        self.download_semaphore = asyncio.Semaphore(settings.download_semaphore)  # 网络I/O并发
-        self.cpu_bound_semaphore = asyncio.Semaphore(settings.cpu_bound_semaphore) # CPU密集型任务并发
+        # 并发控制器（可在运行时通过 update_setting 调整上限）
+        self.download_semaphore = AdaptiveLimiter(
+            settings.download_semaphore,
+            name='download',
+            min_limit=settings.download_concurrency_min,
+            max_limit=settings.download_concurrency_max,
+            adaptive=settings.download_concurrency_adaptive,
+        )  # 网络I/O并发
+        self.cpu_bound_semaphore = ResizableLimiter(settings.cpu_bound_semaphore, name='cpu')  # CPU密集型任务并发
         self.auth_lock = asyncio.Lock()  # 认证锁
+        # API 调用的请求速率限制
+        self.rate_limiter = AdaptiveRateLimiter(
+            rate=settings.rate_limit_per_second,
+            burst=settings.rate_limit_burst,
+            min_rate=settings.rate_limit_min_per_second,
+        )
+        # 图片下载使用独立的令牌桶，不与 API 调用争抢额度（默认不限，字节速率由 bandwidth_limiter 控制）
+        self.download_rate_limiter = AdaptiveRateLimiter(
+            rate=settings.download_rate_limit_per_second,
+            burst=settings.rate_limit_burst,
+            min_rate=settings.rate_limit_min_per_second,
+        )
+        # 全局字节速率限制（下载与预览代理共享，预览优先）
+        self.bandwidth_limiter = BandwidthLimiter(settings.bandwidth_limit)
 
         # 代理读取
         if settings.https_proxy:
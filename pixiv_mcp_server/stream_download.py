@@ -0,0 +1,219 @@
+import asyncio
+import json
+import logging
+import os
+import re
+from pathlib import Path
+from typing import TYPE_CHECKING, Dict, List, Optional
+
+import aiofiles
+from aiohttp import ClientError, ClientSession, ClientTimeout, TCPConnector
+from pixivpy3 import PixivError
+
+from .rate_limiter import AdaptiveRateLimiter, RateLimitedError
+
+if TYPE_CHECKING:
+    from .bandwidth import BandwidthLimiter
+    from .task_registry import TaskProgress
+
+logger = logging.getLogger('pixiv-mcp-server')
+
+PIXIV_REFERER = 'https://app-api.pixiv.net/'
+_CONTENT_RANGE = re.compile(r'bytes\s+(\d+)-\d+/(\d+)\s*$')
+_CONTENT_RANGE_TOTAL = re.compile(r'/(\d+)\s*$')
+
+
+def _part_path(dest: Path) -> Path:
+    return dest.with_name(dest.name + '.part')
+
+
+def _validator_path(part: Path) -> Path:
+    # 与 .part 放在一起，记录其内容对应的资源版本
+    return part.with_name(part.name + '.json')
+
+
+def _load_validator(part: Path) -> Optional[Dict]:
+    try:
+        return json.loads(_validator_path(part).read_text(encoding='utf-8'))
+    except (OSError, ValueError):
+        return None
+
+
+def _save_validator(part: Path, if_range: Optional[str], total: Optional[int]) -> None:
+    path = _validator_path(part)
+    if if_range is None:
+        # 服务器未提供强校验值，无法确认续传时资源未变，不记录（下次从头下载）
+        if path.exists():
+            path.unlink()
+        return
+    path.write_text(json.dumps({'if_range': if_range, 'total': total}), encoding='utf-8')
+
+
+def _range_matches(content_range: str, offset: int, total: Optional[int]) -> bool:
+    """206 响应是否从 offset 开始，且资源总长与首次下载时一致。"""
+    match = _CONTENT_RANGE.search(content_range)
+    if not match or int(match.group(1)) != offset:
+        return False
+    return total is None or int(match.group(2)) == total
+
+
+def _remove_partial(part: Path) -> None:
+    for path in (part, _validator_path(part)):
+        if path.exists():
+            path.unlink()
+
+
+class StreamDownloader:
+    """
+    原生异步的流式下载器。
+    数据按固定大小分块写入 `.part` 文件，连接中断后通过 HTTP Range 从断点续传，
+    完成后原子重命名为目标文件；无论文件多大，内存占用只与分块大小相关。
+    续传请求携带 If-Range（首次响应的强 ETag 或 Last-Modified），资源已变化时服务器返回完整内容并从头写入。
+    同一目标同时只有一个下载在进行，其余调用等待其完成。
+    配置了 bandwidth 时，每个数据块都按批量流量计入全局带宽限制。
+    """
+
+    def __init__(
+        self,
+        rate_limiter: Optional[AdaptiveRateLimiter] = None,
+        bandwidth: Optional["BandwidthLimiter"] = None,
+        proxy: Optional[str] = None,
+        chunk_size: int = 256 * 1024,
+        max_retries: int = 5,
+        pool_size: int = 32,
+    ):
+        self.rate_limiter = rate_limiter
+        self.bandwidth = bandwidth
+        self.proxy = proxy or None
+        self.chunk_size = chunk_size
+        self.max_retries = max_retries
+        self.pool_size = pool_size
+        self.resumed = 0
+        self._session: Optional[ClientSession] = None
+        # 目标路径 -> [锁, 使用者数]，无人使用时移除
+        self._dest_locks: Dict[Path, List] = {}
+
+    def _get_session(self) -> ClientSession:
+        if self._session is None or self._session.closed:
+            # 大文件不设总超时，只限制连接与单次读取的等待时间
+            timeout = ClientTimeout(total=None, sock_connect=30, sock_read=60)
+            connector = TCPConnector(limit=self.pool_size, ttl_dns_cache=300, keepalive_timeout=60)
+            self._session = ClientSession(connector=connector, timeout=timeout)
+        return self._session
+
+    async def download(
+        self, url: str, dest: Path, replace: bool = False, referer: str = PIXIV_REFERER,
+        progress: Optional["TaskProgress"] = None,
+    ) -> bool:
+        """
+        下载 url 到 dest。目标已存在且 replace=False 时跳过并返回 False。提供 progress 时记录传输进度。
+        被取消时保留 `.part`（如服务器关闭），下次下载同一目标时续传；用户主动取消的任务由调用方 discard。
+        """
+        dest = Path(dest)
+        if dest.exists() and not replace:
+            return False
+        key = dest.resolve()
+        entry = self._dest_locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                # 并发的同一目标下载共用一个 .part，等待前一个完成后再检查一次
+                if dest.exists() and not replace:
+                    return False
+                return await self._download_with_retries(url, dest, _part_path(dest), referer, progress)
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._dest_locks[key]
+
+    def discard(self, dest: Path) -> None:
+        """删除 dest 未完成的 `.part` 文件及其校验信息。"""
+        _remove_partial(_part_path(Path(dest)))
+
+    async def _download_with_retries(
+        self, url: str, dest: Path, part: Path, referer: str, progress: Optional["TaskProgress"]
+    ) -> bool:
+        for attempt in range(self.max_retries + 1):
+            try:
+                await self._fetch_to_part(url, part, referer, progress)
+                os.replace(part, dest)
+                _remove_partial(part)
+                return True
+            except RateLimitedError:
+                if self.rate_limiter:
+                    self.rate_limiter.on_throttle()
+                if attempt >= self.max_retries:
+                    raise
+            except (ClientError, asyncio.TimeoutError, ConnectionError) as e:
+                if attempt >= self.max_retries:
+                    raise PixivError(f"下载 {url} 失败: {e}")
+                logger.warning(f"下载中断 ({e})，已保留 {part.stat().st_size if part.exists() else 0} 字节，准备续传...")
+            delay = self.rate_limiter.backoff_delay(attempt, base=0.5) if self.rate_limiter else 0.5 * (2 ** attempt)
+            await asyncio.sleep(delay)
+        return False
+
+    async def _fetch_to_part(self, url: str, part: Path, referer: str, progress: Optional["TaskProgress"]) -> None:
+        offset = part.stat().st_size if part.exists() else 0
+        validator = _load_validator(part) if offset else None
+        if offset and validator is None:
+            # 无法确认 .part 与当前资源是同一版本，从头下载
+            _remove_partial(part)
+            offset = 0
+        headers = {'Referer': referer}
+        if offset:
+            headers['Range'] = f'bytes={offset}-'
+            headers['If-Range'] = validator['if_range']
+
+        if self.rate_limiter:
+            await self.rate_limiter.acquire()
+        session = self._get_session()
+        async with session.get(url, headers=headers, proxy=self.proxy) as resp:
+            if resp.status == 429:
+                raise RateLimitedError(f"HTTP 429 Too Many Requests: {url}", header=resp.headers)
+            if resp.status == 416 and offset:
+                # 请求的起点超出文件长度：.part 可能已完整，否则从头开始
+                match = _CONTENT_RANGE_TOTAL.search(resp.headers.get('Content-Range', ''))
+                if match and int(match.group(1)) == offset and validator['total'] in (None, offset):
+                    if progress is not None:
+                        progress.begin_file(str(part), offset, offset)
+                    return
+                _remove_partial(part)
+                raise ClientError(f"续传位置无效 (offset={offset})，将从头下载")
+            if resp.status not in (200, 206):
+                raise PixivError(f"下载 {url} 失败: HTTP {resp.status}", header=resp.headers)
+
+            if resp.status == 206:
+                if not offset or not _range_matches(resp.headers.get('Content-Range', ''), offset, validator['total']):
+                    _remove_partial(part)
+                    raise ClientError(f"续传响应与 .part 不匹配 ({resp.headers.get('Content-Range')})，将从头下载")
+                self.resumed += 1
+            else:
+                # 首次下载，或资源已变化 / 服务器忽略了 Range：从头写入，并记录新的校验值
+                offset = 0
+                etag = resp.headers.get('ETag')
+                if_range = etag if etag and not etag.startswith('W/') else resp.headers.get('Last-Modified')
+                _save_validator(part, if_range, resp.content_length)
+
+            expected = None
+            if resp.content_length is not None:
+                expected = offset + resp.content_length
+            if progress is not None:
+                progress.begin_file(str(part), offset, expected)
+
+            async with aiofiles.open(part, 'ab' if offset else 'wb') as f:
+                async for chunk in resp.content.iter_chunked(self.chunk_size):
+                    if self.bandwidth is not None:
+                        await self.bandwidth.acquire(len(chunk))
+                    await f.write(chunk)
+                    if progress is not None:
+                        progress.advance(str(part), len(chunk))
+
+        if self.rate_limiter:
+            self.rate_limiter.on_success()
+        if expected is not None and part.stat().st_size < expected:
+            raise ClientError(f"连接提前关闭 ({part.stat().st_size}/{expected} 字节)")
+
+    async def close(self) -> None:
+        if self._session and not self._session.closed:
+            await self._session.close()
+        self._session = None
@@ -0,0 +1,337 @@
+import time
+from collections import Counter, OrderedDict
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Set
+
+# 已结束的任务状态，只有这些任务会被淘汰
+FINISHED_STATUSES = frozenset({'success', 'failed', 'cancelled'})
+
+# 瞬时速率的最短采样间隔（秒）；两次采样之间每个数据块只做整数累加
+PROGRESS_SAMPLE_INTERVAL = 0.5
+# 瞬时速率的指数平滑系数
+PROGRESS_EWMA_ALPHA = 0.3
+
+
+class TaskProgress:
+    """
+    单个任务的传输进度：已下载/总字节数、瞬时与平均速率、页数与预计剩余时间。
+    热路径 (advance) 只做累加，速率按固定间隔采样，快照在查询时才计算。
+    """
+
+    __slots__ = (
+        'bytes_done', 'bytes_total', 'bytes_transferred', 'files', 'pages_done', 'pages_total',
+        'started_at', 'finished_at', 'rate', 'last_activity_at', '_sample_at', '_sample_bytes',
+    )
+
+    def __init__(self):
+        self.bytes_done = 0
+        self.bytes_total = 0
+        # 本次实际经网络传输的字节（不含续传前已在磁盘上的部分），用于计算平均速率
+        self.bytes_transferred = 0
+        # 文件 -> [已下载, 总大小]；Content-Length 未知时总大小为 None
+        self.files: Dict[str, List[Optional[int]]] = {}
+        self.pages_done = 0
+        self.pages_total = 0
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.rate = 0.0
+        self.last_activity_at: Optional[float] = None
+        self._sample_at = 0.0
+        self._sample_bytes = 0
+
+    def begin_file(self, key: str, offset: int, total: Optional[int]) -> None:
+        """开始（或续传）一个文件：offset 为已在磁盘上的字节数，total 为完整大小。"""
+        now = time.monotonic()
+        if self.started_at is None:
+            self.started_at = self._sample_at = now
+        previous = self.files.get(key)
+        if previous is not None:
+            self.bytes_done -= previous[0]
+            self.bytes_total -= previous[1] or 0
+        self.files[key] = [offset, total]
+        self.bytes_done += offset
+        self.bytes_total += total or 0
+
+    def advance(self, key: str, n: int) -> None:
+        self.files[key][0] += n
+        self.bytes_done += n
+        self.bytes_transferred += n
+        now = self.last_activity_at = time.monotonic()
+        elapsed = now - self._sample_at
+        if elapsed >= PROGRESS_SAMPLE_INTERVAL:
+            instant = (self.bytes_transferred - self._sample_bytes) / elapsed
+            self.rate = instant if not self.rate else PROGRESS_EWMA_ALPHA * instant + (1 - PROGRESS_EWMA_ALPHA) * self.rate
+            self._sample_at = now
+            self._sample_bytes = self.bytes_transferred
+
+    def page_done(self) -> None:
+        self.pages_done += 1
+
+    def finish(self) -> None:
+        if self.finished_at is None:
+            self.finished_at = time.monotonic()
+
+    def estimated_total(self) -> Optional[int]:
+        """已知文件的总大小；还有页面未开始时按已知页面的平均大小外推。"""
+        known = [total for _, total in self.files.values() if total]
+        if not known:
+            return None
+        started = len(self.files)
+        if self.pages_total > started:
+            return int(sum(known) / len(known) * self.pages_total)
+        if len(known) < started:
+            return None
+        return self.bytes_total
+
+    def current_rate(self, now: float) -> float:
+        """瞬时速率；传输停滞时没有新的采样，改按上次采样以来的实际字节数计算，使其逐渐降到 0。"""
+        if self.finished_at is not None:
+            return 0.0
+        since_sample = now - self._sample_at
+        if since_sample > 2 * PROGRESS_SAMPLE_INTERVAL:
+            return min(self.rate, (self.bytes_transferred - self._sample_bytes) / since_sample)
+        return self.rate
+
+    def snapshot(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        end = self.finished_at or now
+        elapsed = end - self.started_at if self.started_at is not None else 0.0
+        average = self.bytes_transferred / elapsed if elapsed > 0 else 0.0
+        rate = self.current_rate(now)
+        total = self.estimated_total()
+        eta = None
+        if self.finished_at is not None:
+            eta = 0.0
+        elif total is not None and rate > 0:
+            eta = round(max(0, total - self.bytes_done) / rate, 1)
+        return {
+            "bytes_done": self.bytes_done,
+            "bytes_total": total,
+            "pages_done": self.pages_done,
+            "pages_total": self.pages_total,
+            "rate_bytes_per_sec": round(rate),
+            "avg_bytes_per_sec": round(average),
+            "elapsed_sec": round(elapsed, 1),
+            # 距最近一次收到数据的秒数，可用于判断任务是否停滞
+            "idle_sec": round(end - self.last_activity_at, 1) if self.last_activity_at is not None else None,
+            "eta_sec": eta,
+        }
+
+
+class TaskRecord:
+    """单个下载任务的状态记录。"""
+
+    __slots__ = ('task_id', 'illust_id', 'batch_id', 'status', 'message', 'details', 'progress', 'created_at', 'updated_at')
+
+    def __init__(self, task_id: str, illust_id: Optional[int], batch_id: Optional[str], status: str, message: str):
+        now = time.time()
+        self.task_id = task_id
+        self.illust_id = illust_id
+        self.batch_id = batch_id
+        self.status = status
+        self.message = message
+        self.details: Dict[str, Any] = {}
+        self.progress: Optional[TaskProgress] = None
+        self.created_at = now
+        self.updated_at = now
+
+    def to_dict(self) -> Dict[str, Any]:
+        data = {
+            "illust_id": self.illust_id,
+            "status": self.status,
+            "message": self.message,
+            "updated_at": self.updated_at,
+            "details": self.details,
+        }
+        if self.progress is not None:
+            data["progress"] = self.progress.snapshot()
+        if self.batch_id:
+            data["batch_id"] = self.batch_id
+        return data
+
+
+class TaskRegistry:
+    """
+    下载任务登记表。
+    - 按最近更新时间排序的索引：查询“最新 N 个任务”只需 O(N)。
+    - 按状态与批次维护计数，汇总无需遍历全部任务。
+    - 已结束的任务超过 TTL 或总数超过上限时按结束先后淘汰，未结束的任务永不淘汰。
+    """
+
+    def __init__(self, max_tasks: int = 10000, ttl: float = 24 * 3600):
+        self.max_tasks = max_tasks
+        self.ttl = ttl
+        self.evicted = 0
+        # task_id -> 记录，按最近更新排序（最新的在末尾）
+        self._tasks: "OrderedDict[str, TaskRecord]" = OrderedDict()
+        # 已结束的任务，按结束时间排序，用于淘汰
+        self._finished: "OrderedDict[str, float]" = OrderedDict()
+        self._status_counts: Counter = Counter()
+        self._batches: Dict[str, Counter] = {}
+        self._batch_members: Dict[str, Set[str]] = {}
+
+    def __contains__(self, task_id: str) -> bool:
+        return task_id in self._tasks
+
+    def __len__(self) -> int:
+        return len(self._tasks)
+
+    def get(self, task_id: str) -> Optional[TaskRecord]:
+        return self._tasks.get(task_id)
+
+    def status_of(self, task_id: str) -> Optional[str]:
+        record = self._tasks.get(task_id)
+        return record.status if record else None
+
+    def add(self, task_id: str, illust_id: Optional[int], status: str, message: str, batch_id: Optional[str] = None) -> TaskRecord:
+        self._discard(task_id)
+        record = TaskRecord(task_id, illust_id, batch_id, status, message)
+        self._tasks[task_id] = record
+        self._status_counts[status] += 1
+        if batch_id:
+            self._batches.setdefault(batch_id, Counter())[status] += 1
+            self._batch_members.setdefault(batch_id, set()).add(task_id)
+        self._track_finished(record)
+        self._evict()
+        return record
+
+    def update(self, task_id: str, status: str, message: str, details: Optional[Dict[str, Any]] = None) -> TaskRecord:
+        record = self._tasks.get(task_id)
+        if record is None:
+            return self.add(task_id, None, status, message)
+        if record.status != status:
+            self._status_counts[record.status] -= 1
+            self._status_counts[status] += 1
+            if record.batch_id:
+                batch = self._batches[record.batch_id]
+                batch[record.status] -= 1
+                batch[status] += 1
+            record.status = status
+            if status in FINISHED_STATUSES and record.progress is not None:
+                record.progress.finish()
+        record.message = message
+        record.updated_at = time.time()
+        if details:
+            record.details.update(details)
+        self._tasks.move_to_end(task_id)
+        self._track_finished(record)
+        self._evict()
+        return record
+
+    def _track_finished(self, record: TaskRecord) -> None:
+        if record.status in FINISHED_STATUSES:
+            self._finished[record.task_id] = record.updated_at
+            self._finished.move_to_end(record.task_id)
+        else:
+            self._finished.pop(record.task_id, None)
+
+    def _discard(self, task_id: str) -> None:
+        record = self._tasks.pop(task_id, None)
+        if record is None:
+            return
+        self._finished.pop(task_id, None)
+        self._status_counts[record.status] -= 1
+        if record.batch_id:
+            batch = self._batches.get(record.batch_id)
+            if batch is not None:
+                batch[record.status] -= 1
+                self._batch_members[record.batch_id].discard(task_id)
+                if not +batch:
+                    del self._batches[record.batch_id]
+                    del self._batch_members[record.batch_id]
+
+    def _evict(self) -> None:
+        cutoff = time.time() - self.ttl
+        while self._finished:
+            task_id, finished_at = next(iter(self._finished.items()))
+            if finished_at >= cutoff and len(self._tasks) <= self.max_tasks:
+                break
+            self._discard(task_id)
+            self.evicted += 1
+
+    def progress(self, task_id: str) -> Optional[TaskProgress]:
+        """取得任务的进度对象（首次调用时创建）。"""
+        record = self._tasks.get(task_id)
+        if record is None:
+            return None
+        if record.progress is None:
+            record.progress = TaskProgress()
+        return record.progress
+
+    def latest(self, n: int) -> Iterator[TaskRecord]:
+        """按最近更新时间倒序返回最多 n 个任务。"""
+        for i, task_id in enumerate(reversed(self._tasks)):
+            if i >= n:
+                break
+            yield self._tasks[task_id]
+
+    def batch_task_ids(self, batch_id: str) -> List[str]:
+        return list(self._batch_members.get(batch_id, ()))
+
+    def batch_summary(self, batch_id: str) -> Optional[Dict[str, Any]]:
+        """批次内各状态的任务数，以及是否已全部结束。"""
+        counts = self._batches.get(batch_id)
+        if counts is None:
+            return None
+        by_status = {status: n for status, n in counts.items() if n > 0}
+        total = sum(by_status.values())
+        finished = sum(n for status, n in by_status.items() if status in FINISHED_STATUSES)
+        return {
+            "batch_id": batch_id,
+            "total": total,
+            "finished": finished,
+            "done": finished == total,
+            "by_status": by_status,
+            "progress": self._aggregate_progress(self._tasks[t] for t in self._batch_members.get(batch_id, ())),
+        }
+
+    @staticmethod
+    def _aggregate_progress(records: Iterable[TaskRecord]) -> Dict[str, Any]:
+        """
+        汇总一组任务的进度。尚未开始传输的任务按已知任务的平均大小估算总字节数，
+        剩余时间按当前总速率估算。
+        """
+        bytes_done = bytes_total = pages_done = pages_total = 0
+        known = unknown = 0
+        rate = 0.0
+        for record in records:
+            snapshot = record.progress.snapshot() if record.progress is not None else None
+            if snapshot is None or snapshot["bytes_total"] is None:
+                # 已结束但没有传输（例如命中索引或缓存）的任务不计入
+                if record.status not in FINISHED_STATUSES:
+                    unknown += 1
+                if snapshot is None:
+                    continue
+            else:
+                known += 1
+                bytes_total += snapshot["bytes_total"]
+            bytes_done += snapshot["bytes_done"]
+            pages_done += snapshot["pages_done"]
+            pages_total += snapshot["pages_total"]
+            rate += snapshot["rate_bytes_per_sec"]
+        estimated_total = None
+        if known:
+            estimated_total = int(bytes_total + bytes_total / known * unknown)
+        elif not unknown:
+            estimated_total = 0
+        eta = None
+        if estimated_total is not None and not unknown and bytes_done >= estimated_total:
+            eta = 0.0
+        elif estimated_total is not None and rate > 0:
+            eta = round(max(0, estimated_total - bytes_done) / rate, 1)
+        return {
+            "bytes_done": bytes_done,
+            "bytes_total": estimated_total,
+            "bytes_total_estimated": bool(unknown and known),
+            "pages_done": pages_done,
+            "pages_total": pages_total,
+            "rate_bytes_per_sec": round(rate),
+            "eta_sec": eta,
+        }
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "tasks": len(self._tasks),
+            "by_status": {status: n for status, n in self._status_counts.items() if n > 0},
+            "batches": len(self._batches),
+            "evicted": self.evicted,
+        }
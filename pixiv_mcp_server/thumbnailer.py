@@ -0,0 +1,99 @@
+import asyncio
+import functools
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+
+from PIL import Image, ImageOps, features
+
+# 本模块会在子进程中被导入，因此只依赖 Pillow 与标准库，不引入服务器状态
+
+# 支持的输出格式 -> (Pillow 格式名, Content-Type)
+RENDITION_FORMATS = {
+    'webp': ('WEBP', 'image/webp'),
+    'jpeg': ('JPEG', 'image/jpeg'),
+    'png': ('PNG', 'image/png'),
+}
+FORMAT_ALIASES = {'jpg': 'jpeg'}
+
+_executor: Optional[ProcessPoolExecutor] = None
+_executor_workers = 0
+
+
+def resolve_format(fmt: str) -> str:
+    """规范化格式名；环境缺少 WebP 编码支持时退回 JPEG。"""
+    fmt = FORMAT_ALIASES.get(fmt, fmt)
+    if fmt == 'webp' and not features.check('webp'):
+        return 'jpeg'
+    return fmt
+
+
+def render_thumbnail(
+    source_path: str,
+    output_path: str,
+    width: Optional[int],
+    height: Optional[int],
+    fmt: Optional[str],
+    quality: int,
+) -> str:
+    """
+    将图片等比缩放到 width x height 以内（不放大）并转码，写入 output_path。
+    fmt 为空时保持原格式（非 JPEG/PNG/WebP 的统一转为 JPEG），返回输出的 Content-Type。
+    """
+    with Image.open(source_path) as img:
+        if fmt is None:
+            fmt = FORMAT_ALIASES.get((img.format or '').lower(), (img.format or '').lower())
+            if fmt not in RENDITION_FORMATS:
+                fmt = 'jpeg'
+        fmt = resolve_format(fmt)
+        pil_format, content_type = RENDITION_FORMATS[fmt]
+
+        img = ImageOps.exif_transpose(img)
+        if width or height:
+            img.thumbnail((width or img.width, height or img.height), Image.LANCZOS)
+
+        if fmt == 'jpeg' and img.mode not in ('RGB', 'L'):
+            if img.mode in ('RGBA', 'LA', 'P'):
+                img = img.convert('RGBA')
+                background = Image.new('RGB', img.size, (255, 255, 255))
+                background.paste(img, mask=img.getchannel('A'))
+                img = background
+            else:
+                img = img.convert('RGB')
+        elif fmt == 'webp' and img.mode not in ('RGB', 'RGBA'):
+            img = img.convert('RGBA' if 'A' in img.getbands() or img.mode == 'P' else 'RGB')
+
+        options = {'optimize': True}
+        if fmt in ('jpeg', 'webp'):
+            options['quality'] = quality
+        if fmt == 'jpeg':
+            options['progressive'] = True
+        elif fmt == 'webp':
+            options['method'] = 4
+        img.save(output_path, format=pil_format, **options)
+    return content_type
+
+
+def get_executor(max_workers: int) -> ProcessPoolExecutor:
+    """惰性创建缩略图进程池，与 ugoira 编码池相互独立，预览不会排在大批量编码任务之后。"""
+    global _executor, _executor_workers
+    max_workers = max(1, max_workers)
+    if _executor is None or max_workers != _executor_workers:
+        if _executor is not None:
+            _executor.shutdown(wait=False)
+        _executor = ProcessPoolExecutor(max_workers=max_workers)
+        _executor_workers = max_workers
+    return _executor
+
+
+async def render_thumbnail_in_pool(max_workers: int, **kwargs) -> str:
+    """在进程池中运行 render_thumbnail，不阻塞代理的事件循环。"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_executor(max_workers), functools.partial(render_thumbnail, **kwargs))
+
+
+def shutdown_executor() -> None:
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
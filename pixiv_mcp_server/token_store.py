@@ -0,0 +1,57 @@
+import hashlib
+import json
+import logging
+import os
+import time
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger('pixiv-mcp-server')
+
+
+def _fingerprint(refresh_token: str) -> str:
+    """refresh_token 的指纹，用于确认缓存属于当前配置的账号，本身不落盘明文。"""
+    return hashlib.sha256(refresh_token.encode('utf-8')).hexdigest()
+
+
+def load_cached_token(path: str, refresh_token: str, min_ttl: float = 0) -> Optional[Dict[str, Any]]:
+    """读取本地缓存的 access token；文件不存在、属于其他账号或剩余有效期不足时返回 None。"""
+    if not path or not refresh_token:
+        return None
+    file = Path(path).expanduser()
+    try:
+        data = json.loads(file.read_text(encoding='utf-8'))
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.warning(f"读取 token 缓存失败: {e}")
+        return None
+    if data.get('refresh_token_sha256') != _fingerprint(refresh_token):
+        return None
+    if not data.get('access_token') or float(data.get('expires_at', 0)) - min_ttl <= time.time():
+        return None
+    return data
+
+
+def save_cached_token(path: str, refresh_token: str, access_token: str, user_id: Any, expires_at: float) -> None:
+    """以仅当前用户可读写的权限原子地写入 token 缓存。"""
+    if not path or not refresh_token or not access_token:
+        return
+    file = Path(path).expanduser()
+    data = {
+        'access_token': access_token,
+        'user_id': user_id,
+        'expires_at': expires_at,
+        'refresh_token_sha256': _fingerprint(refresh_token),
+    }
+    tmp = file.with_name(file.name + '.tmp')
+    try:
+        file.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+        fd = os.open(str(tmp), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(data, f)
+        os.replace(tmp, file)
+    except Exception as e:
+        logger.warning(f"写入 token 缓存失败: {e}")
+        if tmp.exists():
+            tmp.unlink()
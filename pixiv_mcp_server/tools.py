@@ -1,14 +1,21 @@
-import asyncio
 import json
 import logging
 import random
+import time
 import uuid
+from contextlib import asynccontextmanager
 from pathlib import Path
 from typing import List, Optional, Dict, Any
 
 from mcp.server.fastmcp import FastMCP
 
-from .downloader import _background_download_single
+from .download_queue import download_queue
+from .downloader import _update_task_status, host_limit_stats, resize_host_limits, stream_downloader
+from .journal import UNFINISHED_STATUSES
+from .preview_proxy import MAX_RENDITION_DIMENSION
+from .task_registry import FINISHED_STATUSES
+from .thumbnailer import RENDITION_FORMATS
+from .ugoira_encoder import shutdown_executor
 from .config import settings
 from .state import state
 from .utils import (
@@ -25,10 +32,47 @@ from .utils import (
     inject_proxy_into_trend_tags,
     structure_tool_response,
     render_cards_to_markdown,
+    displayed_preview_urls,
 )
 
 logger = logging.getLogger('pixiv-mcp-server')
-mcp = FastMCP("pixiv-server")
+
+
+@asynccontextmanager
+async def _server_lifespan(server: FastMCP):
+    """服务器生命周期：启动后台 token 刷新，退出时释放在事件循环内创建的资源。"""
+    if state.token_refresher and state.refresh_token:
+        state.token_refresher.start()
+    download_queue.start()
+    logger.info(f"MCP 服务已就绪，距进程启动: {(time.perf_counter() - state.started_at) * 1000:.0f} ms")
+    try:
+        yield {}
+    finally:
+        await download_queue.stop()
+        if state.preview_proxy is not None:
+            await state.preview_proxy.stop()
+            state.preview_proxy = None
+        if state.token_refresher:
+            await state.token_refresher.stop()
+        if state.api_client:
+            await state.api_client.aclose()
+        await stream_downloader.close()
+        shutdown_executor()
+
+
+class PixivMCP(FastMCP):
+    """在 FastMCP 基础上记录首次工具响应耗时（自进程启动起算）。"""
+
+    async def call_tool(self, name: str, arguments: Dict[str, Any]):
+        result = await super().call_tool(name, arguments)
+        if state.first_response_at is None:
+            state.first_response_at = time.perf_counter()
+            elapsed_ms = (state.first_response_at - state.started_at) * 1000
+            logger.info(f"首次工具响应 ({name}) 距进程启动: {elapsed_ms:.0f} ms")
+        return result
+
+
+mcp = PixivMCP("pixiv-server", lifespan=_server_lifespan)
 
 
 async def _api_tool_handler(
@@ -115,6 +159,9 @@ async def _api_tool_handler(
             cards = items
 
         markdown = render_cards_to_markdown(cards, title, show_nsfw, limit)
+        # 客户端拿到 Markdown 后才会请求缩略图，提前让预览代理填充缓存
+        if settings.preview_prefetch_enabled and state.preview_proxy is not None:
+            state.preview_proxy.prefetch(displayed_preview_urls(cards, show_nsfw, limit))
         return {
             "ok": True,
             "markdown": markdown,
@@ -166,7 +213,7 @@ async def download(
 ) -> dict:
     """
     Downloads one or more artworks by their IDs asynchronously in the background. 
-    Returns task IDs for tracking progress via `get_download_status`.
+    Returns task IDs and a batch ID for tracking progress via `manage_download_tasks`.
     Advanced parameters can be used to control the quality of ugoira (animated) downloads.
     """
     if not illust_id and not illust_ids:
@@ -183,41 +230,117 @@ async def download(
     
     unique_ids = sorted(list(set(id_list)))
     task_ids = []
+    batch_id = f"batch_{uuid.uuid4()}"
     
+    params = {
+        "webp_quality": webp_quality,
+        "webp_preset": webp_preset,
+        "webp_lossless": webp_lossless,
+        "gif_preset": gif_preset,
+        "gif_fps": gif_fps,
+    }
     for an_id in unique_ids:
         task_id = f"task_{uuid.uuid4()}"
         task_ids.append(task_id)
-        state.download_tasks[task_id] = {
-            "illust_id": an_id,
-            "status": "queued",
-            "message": "任务已创建，正在等待调度。",
-        }
-        asyncio.create_task(_background_download_single(
-            task_id=task_id, 
-            illust_id=an_id,
-            webp_quality=webp_quality,
-            webp_preset=webp_preset,
-            webp_lossless=webp_lossless,
-            gif_preset=gif_preset,
-            gif_fps=gif_fps
-        ))
+        download_queue.enqueue(task_id, an_id, params, batch_id=batch_id)
     
     return {
         "ok": True,
-        "message": f"已成功为 {len(unique_ids)} 个作品创建下载任务。请使用 get_download_status 工具凭任务ID查询进度。",
-        "task_ids": task_ids
+        "message": f"已成功为 {len(unique_ids)} 个作品创建下载任务。请使用 manage_download_tasks 工具凭任务ID或批次ID查询进度。",
+        "task_ids": task_ids,
+        "batch_id": batch_id,
+    }
+
+LISTING_SOURCES = ("ranking", "search", "bookmarks")
+
+
+@mcp.tool()
+async def download_listing(
+    source: str = "ranking",
+    mode: str = "day",
+    date: Optional[str] = None,
+    word: Optional[str] = None,
+    search_target: str = "partial_match_for_tags",
+    sort: str = "date_desc",
+    duration: Optional[str] = None,
+    search_r18: bool = False,
+    user_id_to_check: Optional[int] = None,
+    restrict: str = "public",
+    tag: Optional[str] = None,
+    max_items: Optional[int] = None,
+    max_pages: Optional[int] = None,
+    webp_quality: int = 80,
+    webp_preset: str = 'default',
+    webp_lossless: bool = False,
+    gif_preset: str = 'ultrafast',
+    gif_fps: Optional[int] = None
+) -> dict:
+    """
+    Downloads every artwork of a ranking, search result or bookmark list in the background, following all pages.
+    - source='ranking': uses `mode` and `date` (same as `get_illust_ranking`).
+    - source='search': uses `word`, `search_target`, `sort`, `duration` and `search_r18` (same as `search_illust`).
+    - source='bookmarks': uses `user_id_to_check`, `restrict` and `tag` (same as `get_user_bookmarks`).
+    `max_items` / `max_pages` limit how much of the listing is downloaded.
+    Works are queued as soon as each page arrives. Returns a batch ID for `manage_download_tasks`.
+    """
+    if source == "ranking":
+        method_name, args, kwargs = "illust_ranking", (), {"mode": mode, "date": date}
+        description = f"'{mode}' 排行榜"
+    elif source == "search":
+        if not word:
+            return {"ok": False, "error": "source='search' 时必须提供 word 参数。"}
+        search_word = f"{word} R-18" if search_r18 else word
+        method_name, args = "search_illust", (search_word,)
+        kwargs = {"search_target": search_target, "sort": sort, "duration": duration}
+        description = f"搜索 '{search_word}'"
+    elif source == "bookmarks":
+        # 启动时认证在后台进行，state.user_id 在首次认证完成前为空
+        if not state.is_authenticated and state.refresh_token and state.token_refresher:
+            await state.token_refresher.wait_ready()
+        target_user_id = user_id_to_check if user_id_to_check is not None else state.user_id
+        if target_user_id is None:
+            return {"ok": False, "error": "查询自己的收藏时，需要先认证以获取用户ID。"}
+        method_name, args, kwargs = "user_bookmarks_illust", (target_user_id,), {"restrict": restrict, "tag": tag}
+        description = f"用户 {target_user_id} 的收藏"
+    else:
+        return {"ok": False, "error": f"不支持的来源: '{source}'", "supported_sources": list(LISTING_SOURCES)}
+
+    if not state.api_client:
+        return {"ok": False, "error": "API 客户端尚未初始化。"}
+    if max_items is not None and max_items <= 0:
+        return {"ok": False, "error": "max_items 必须为正整数。"}
+
+    params = {
+        "webp_quality": webp_quality,
+        "webp_preset": webp_preset,
+        "webp_lossless": webp_lossless,
+        "gif_preset": gif_preset,
+        "gif_fps": gif_fps,
+    }
+    batch_id = f"batch_{uuid.uuid4()}"
+    kwargs = {k: v for k, v in kwargs.items() if v is not None}
+    pages = state.api_client.iter_pages(method_name, *args, max_pages=max_pages, **kwargs)
+    download_queue.enqueue_listing(batch_id, pages, params, max_items=max_items)
+
+    return {
+        "ok": True,
+        "message": f"已开始下载{description}中的作品，作品会随翻页陆续加入下载队列。请使用 manage_download_tasks 凭批次ID查询进度。",
+        "batch_id": batch_id,
     }
 
 @mcp.tool()
 async def manage_download_tasks(
     task_id: Optional[str] = None, 
     task_ids: Optional[List[str]] = None,
-    action: str = "status"
+    action: str = "status",
+    batch_id: Optional[str] = None
 ) -> dict:
     """
     Manages download tasks. The default action is to query the status.
     - action='status': Queries the status of one or more tasks. If no ID is provided, it displays the 10 most recent tasks.
-    - action='cancel': Cancels one or more tasks that are currently queued or downloading.
+      With `batch_id` (returned by `download` or `download_listing`), returns the aggregate status of the whole batch.
+    - action='cancel': Cancels one or more tasks that are still running (queued, downloading or converting).
+      With `batch_id`, stops paging its listing and cancels all of its running tasks.
     """
     id_list = []
     if task_id:
@@ -226,21 +349,40 @@ async def manage_download_tasks(
         id_list.extend(task_ids)
 
     if action == "status":
+        if batch_id:
+            summary = state.download_tasks.batch_summary(batch_id)
+            listing = download_queue.listing_status(batch_id)
+            if summary is None and listing is None:
+                return {"ok": False, "error": "未找到指定的批次ID。"}
+            if summary is None:
+                # 列表的第一页尚未返回
+                summary = {"batch_id": batch_id, "total": 0, "finished": 0, "done": True, "by_status": {}}
+            if listing is not None:
+                summary["listing"] = listing
+                summary["done"] = summary["done"] and listing["status"] != "listing"
+            return {"ok": True, "batch": summary}
         if not id_list:
             # 返回最近10个任务的摘要
-            recent_tasks = dict(sorted(state.download_tasks.items(), key=lambda item: item[1].get('updated_at', 0), reverse=True)[:10])
+            recent_tasks = {record.task_id: record.to_dict() for record in state.download_tasks.latest(10)}
             if not recent_tasks:
                 return {"ok": True, "tasks": {}, "message": "当前没有活动的下载任务。"}
             return {"ok": True, "tasks": recent_tasks}
         
         results = {}
         for an_id in id_list:
-            results[an_id] = state.download_tasks.get(an_id, {"status": "not_found", "message": "未找到指定的任务ID。"})
+            record = state.download_tasks.get(an_id)
+            results[an_id] = record.to_dict() if record else {"status": "not_found", "message": "未找到指定的任务ID。"}
         return {"ok": True, "tasks": results}
 
     elif action == "cancel":
-        if not id_list:
-            return {"ok": False, "error": "必须提供 task_id 或 task_ids 来取消任务。"}
+        if batch_id:
+            download_queue.cancel_listing(batch_id)
+            id_list.extend(
+                an_id for an_id in state.download_tasks.batch_task_ids(batch_id)
+                if state.download_tasks.status_of(an_id) not in FINISHED_STATUSES
+            )
+        if not id_list and not batch_id:
+            return {"ok": False, "error": "必须提供 task_id、task_ids 或 batch_id 来取消任务。"}
         
         cancelled_count = 0
         not_found_count = 0
@@ -252,13 +394,16 @@ async def manage_download_tasks(
                 results[an_id] = {"status": "not_found"}
                 continue
             
-            if task["status"] in ["queued", "downloading"]:
-                task["status"] = "cancelled"
-                task["message"] = "任务已被用户取消。"
+            if task.status in UNFINISHED_STATUSES:
+                _update_task_status(an_id, "cancelled", "任务已被用户取消。")
+                # 取消底层协程：中断进行中的 HTTP 流、终止 FFmpeg，并清理不完整的文件
+                handle = state.download_task_handles.pop(an_id, None)
+                if handle and not handle.done():
+                    handle.cancel()
                 cancelled_count += 1
                 results[an_id] = {"status": "cancelled"}
             else:
-                results[an_id] = {"status": task["status"], "message": "任务已完成或失败，无法取消。"}
+                results[an_id] = {"status": task.status, "message": "任务已完成或失败，无法取消。"}
 
         return {
             "ok": True, 
@@ -269,6 +414,47 @@ async def manage_download_tasks(
     else:
         return {"ok": False, "error": f"不支持的操作: '{action}'", "supported_actions": ["status", "cancel"]}
 
+
+def _configure_rate_limiters(**kwargs) -> None:
+    state.rate_limiter.configure(**kwargs)
+    state.download_rate_limiter.configure(**kwargs)
+
+
+# 需要作用到运行中对象上的配置项：更新时调用对应函数，而不是直接覆盖 state 上的同名属性
+_LIVE_SETTINGS = {
+    "download_semaphore": lambda value: state.download_semaphore.resize(value),
+    "cpu_bound_semaphore": lambda value: state.cpu_bound_semaphore.resize(value),
+    # 下载与编码阶段的 worker 数由以上两个限制器的监听器同步（download_queue.resize_stage）
+    "per_host_download_limit": resize_host_limits,
+    "download_metadata_workers": lambda value: download_queue.resize_stage("metadata", value),
+    "download_concurrency_adaptive": lambda value: state.download_semaphore.set_adaptive(value),
+    "download_concurrency_min": lambda value: state.download_semaphore.set_bounds(min_limit=value),
+    "download_concurrency_max": lambda value: state.download_semaphore.set_bounds(max_limit=value),
+    "rate_limit_per_second": lambda value: state.rate_limiter.configure(
+        rate=value, min_rate=settings.rate_limit_min_per_second
+    ),
+    "download_rate_limit_per_second": lambda value: state.download_rate_limiter.configure(
+        rate=value, min_rate=settings.rate_limit_min_per_second
+    ),
+    "rate_limit_burst": lambda value: _configure_rate_limiters(burst=value),
+    "rate_limit_min_per_second": lambda value: _configure_rate_limiters(min_rate=value),
+}
+
+# 必须为正整数的配置项
+_POSITIVE_INT_SETTINGS = frozenset({
+    "download_semaphore",
+    "cpu_bound_semaphore",
+    "per_host_download_limit",
+    "download_metadata_workers",
+    "download_concurrency_min",
+    "download_concurrency_max",
+    "preview_resize_workers",
+    "rate_limit_burst",
+})
+# 不能为负数的配置项（速率为 0 表示不限流）
+_NON_NEGATIVE_SETTINGS = frozenset({"rate_limit_per_second", "download_rate_limit_per_second", "rate_limit_max_retries"})
+
+
 @mcp.tool()
 async def update_setting(key: str, value: Any) -> dict:
     """
@@ -303,6 +489,32 @@ async def update_setting(key: str, value: Any) -> dict:
             return {"ok": False, "error": f"不支持的动图格式 '{validated_value}'", "supported_formats": supported_formats}
         validated_value = str(validated_value).lower()
     
+    if key in _POSITIVE_INT_SETTINGS and validated_value < 1:
+        return {"ok": False, "error": f"配置项 '{key}' 必须为正整数。"}
+
+    if key in _NON_NEGATIVE_SETTINGS and validated_value < 0:
+        return {"ok": False, "error": f"配置项 '{key}' 不能为负数。"}
+
+    if key == "rate_limit_min_per_second" and validated_value <= 0:
+        return {"ok": False, "error": "rate_limit_min_per_second 必须大于 0。"}
+
+    if key == "bandwidth_limit":
+        if validated_value < 0:
+            return {"ok": False, "error": "bandwidth_limit 不能为负数 (0 表示不限速)。"}
+        state.bandwidth_limiter.set_rate(validated_value)
+
+    if key == "preview_thumbnail_format":
+        supported_formats = list(RENDITION_FORMATS)
+        if str(validated_value).lower() not in supported_formats:
+            return {"ok": False, "error": f"不支持的预览图格式 '{validated_value}'", "supported_formats": supported_formats}
+        validated_value = str(validated_value).lower()
+
+    if key == "preview_thumbnail_quality" and not 1 <= validated_value <= 100:
+        return {"ok": False, "error": "preview_thumbnail_quality 必须在 1 到 100 之间。"}
+
+    if key == "preview_thumbnail_size" and not 0 <= validated_value <= MAX_RENDITION_DIMENSION:
+        return {"ok": False, "error": f"preview_thumbnail_size 必须在 0 到 {MAX_RENDITION_DIMENSION} 之间 (0 表示不缩放)。"}
+
     if key == "download_path":
         try:
             Path(validated_value).mkdir(parents=True, exist_ok=True)
@@ -311,7 +523,10 @@ async def update_setting(key: str, value: Any) -> dict:
             return {"ok": False, "error": f"无法创建或访问指定的下载路径: {e}"}
 
     try:
-        setattr(state, key, validated_value)
+        if key in _LIVE_SETTINGS:
+            _LIVE_SETTINGS[key](validated_value)
+        else:
+            setattr(state, key, validated_value)
         setattr(settings, key, validated_value) # Also update the source settings object
         logger.info(f"配置项 '{key}' 已更新为: {validated_value}")
         return {"ok": True, "message": f"配置 '{key}' 已成功更新。", "new_value": validated_value}
@@ -319,6 +534,45 @@ async def update_setting(key: str, value: Any) -> dict:
         logger.error(f"更新配置项 '{key}' 失败: {e}")
         return {"ok": False, "error": f"更新配置时发生未知错误: {e}"}
 
+@mcp.tool()
+@ensure_json_serializable
+async def get_server_stats() -> dict:
+    """
+    Returns runtime statistics of the server, such as API transport, response cache hit/miss counters,
+    the current request rate limit, bandwidth usage, concurrency limits and utilization, the queue depth / throughput
+    of each download pipeline stage and the preview proxy cache / prefetch hit ratios.
+    """
+    if not state.api_client:
+        return {"ok": False, "error": "API 客户端尚未初始化。"}
+    return {
+        "ok": True,
+        "api_client": state.api_client.stats(),
+        "rate_limiter": state.rate_limiter.stats(),
+        "download_rate_limiter": state.download_rate_limiter.stats(),
+        "bandwidth": state.bandwidth_limiter.stats(),
+        "concurrency": {
+            "download": state.download_semaphore.stats(),
+            "cpu": state.cpu_bound_semaphore.stats(),
+            "hosts": host_limit_stats(),
+        },
+        "download_queue": download_queue.stats(),
+        "preview_proxy": state.preview_proxy.stats() if state.preview_proxy else None,
+    }
+
+@mcp.tool()
+async def rebuild_library_index() -> dict:
+    """
+    Rescans the download directory and rebuilds the index of already-downloaded works.
+    Works found in the index are skipped by `download` without any network request.
+    """
+    if not download_queue.started:
+        download_queue.start()
+    try:
+        count = await download_queue.rebuild_library_index()
+    except Exception as e:
+        return {"ok": False, "error": f"重建作品索引失败: {e}"}
+    return {"ok": True, "message": f"作品索引已重建，共识别 {count} 个作品。", "works": count}
+
 @mcp.tool()
 @ensure_json_serializable
 async def search_illust(
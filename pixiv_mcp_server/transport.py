@@ -0,0 +1,134 @@
+import asyncio
+import logging
+from typing import Any, Dict, List, Optional, Tuple
+
+from aiohttp import ClientSession, ClientTimeout, TCPConnector
+from pixivpy3 import AppPixivAPI, PixivError
+
+from .rate_limiter import RateLimitedError
+
+logger = logging.getLogger('pixiv-mcp-server')
+
+# 通过原生 aiohttp 传输层发送的 app-api 方法，其余方法（如 download）仍走 pixivpy3
+AIOHTTP_METHODS = frozenset({
+    'illust_detail',
+    'illust_related',
+    'illust_recommended',
+    'illust_ranking',
+    'illust_follow',
+    'search_illust',
+    'search_user',
+    'trending_tags_illust',
+    'user_bookmarks_illust',
+    'user_following',
+    'ugoira_metadata',
+})
+
+
+class _CapturedRequest(Exception):
+    """携带 pixivpy3 构造好的请求参数，用于中断其同步发送流程。"""
+
+    def __init__(self, method: str, url: str, headers: Dict[str, str], params: Optional[Dict], data: Optional[Dict]):
+        super().__init__(method, url)
+        self.method = method
+        self.url = url
+        self.headers = headers
+        self.params = params
+        self.data = data
+
+
+class _RequestRecorder(AppPixivAPI):
+    """复用 pixivpy3 的 URL 与参数构造逻辑，但不真正发出请求。"""
+
+    def requests_call(self, method, url, headers=None, params=None, data=None, stream=False):
+        merged_headers = self.additional_headers.copy()
+        if headers:
+            merged_headers.update(headers)
+        raise _CapturedRequest(method, url, dict(merged_headers), params, data)
+
+
+def _flatten_params(params: Optional[Dict[str, Any]]) -> List[Tuple[str, str]]:
+    """将 requests 风格的参数转换为 aiohttp 可接受的键值对列表（丢弃 None，展开列表）。"""
+    flat: List[Tuple[str, str]] = []
+    for key, value in (params or {}).items():
+        if value is None:
+            continue
+        if isinstance(value, (list, tuple)):
+            flat.extend((key, str(v)) for v in value)
+        else:
+            flat.append((key, str(value)))
+    return flat
+
+
+class AiohttpTransport:
+    """
+    基于 aiohttp 的 app-api 异步传输层。
+    所有调用共享同一个连接池（带单主机上限与 keep-alive），避免占用线程池和重复 TLS 握手。
+    认证信息始终从 pixivpy3 的 api 对象读取，因此 token 刷新后立即生效。
+    """
+
+    def __init__(self, api: AppPixivAPI, proxy: Optional[str] = None, pool_size: int = 32, pool_per_host: int = 8):
+        self.api = api
+        self.proxy = proxy or None
+        self.pool_size = pool_size
+        self.pool_per_host = pool_per_host
+        self._recorder = _RequestRecorder()
+        self._session: Optional[ClientSession] = None
+
+    def supports(self, method_name: str) -> bool:
+        return method_name in AIOHTTP_METHODS
+
+    def _get_session(self) -> ClientSession:
+        """惰性创建共享会话，确保其绑定到当前运行的事件循环。"""
+        if self._session is None or self._session.closed:
+            connector = TCPConnector(
+                limit=self.pool_size,
+                limit_per_host=self.pool_per_host,
+                ttl_dns_cache=300,
+                keepalive_timeout=60,
+            )
+            self._session = ClientSession(connector=connector, timeout=ClientTimeout(total=30))
+        return self._session
+
+    def _build_request(self, method_name: str, *args, **kwargs) -> _CapturedRequest:
+        """调用 pixivpy3 的同名方法以获得完整的请求描述。"""
+        self._recorder.hosts = self.api.hosts
+        self._recorder.access_token = self.api.access_token
+        self._recorder.additional_headers = self.api.additional_headers
+        try:
+            getattr(self._recorder, method_name)(*args, **kwargs)
+        except _CapturedRequest as captured:
+            return captured
+        raise PixivError(f"无法为 {method_name} 构造请求。")
+
+    async def call(self, method_name: str, *args, **kwargs) -> Dict[str, Any]:
+        request = self._build_request(method_name, *args, **kwargs)
+        session = self._get_session()
+        try:
+            async with session.request(
+                request.method,
+                request.url,
+                headers=request.headers,
+                params=_flatten_params(request.params),
+                data=request.data,
+                proxy=self.proxy,
+            ) as resp:
+                body = await resp.read()
+                headers = resp.headers
+                status = resp.status
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            raise PixivError(f"requests {request.method} {request.url} error: {e}")
+
+        if status == 429:
+            raise RateLimitedError(f"HTTP 429 Too Many Requests: {request.url}", header=headers)
+        try:
+            return self.api.parse_json(body)
+        except Exception as e:
+            raise PixivError(f"parse_json() error: {e}", header=headers, body=body.decode('utf-8', errors='replace'))
+
+    async def close(self) -> None:
+        if self._session and not self._session.closed:
+            await self._session.close()
+        self._session = None
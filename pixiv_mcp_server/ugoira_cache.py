@@ -0,0 +1,179 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import sqlite3
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+logger = logging.getLogger('pixiv-mcp-server')
+
+UGOIRA_CACHE_DIRNAME = '.pixiv-mcp-ugoira-cache'
+
+# 图片 URL 中的 /img/YYYY/MM/DD/hh/mm/ss/ 段，作品重新上传后会随之变化
+_REVISION_PATTERN = re.compile(r'/img/(\d{4}/\d{2}/\d{2}/\d{2}/\d{2}/\d{2})/')
+
+# 只有对所选格式生效的参数才参与缓存键
+_FORMAT_PARAMS = {
+    'webp': ('webp_quality', 'webp_preset', 'webp_lossless'),
+    'gif': ('gif_preset', 'gif_fps'),
+}
+
+
+def illust_revision(illust: Dict[str, Any]) -> str:
+    """从作品信息中取出其版本标识（图片 URL 中的时间戳，取不到时退回 create_date）。"""
+    for url in (illust.get('image_urls') or {}).values():
+        match = _REVISION_PATTERN.search(url or '')
+        if match:
+            return match.group(1)
+    return str(illust.get('create_date', ''))
+
+
+def link_or_copy(src: Path, dest: Path) -> None:
+    """优先创建硬链接（不占额外空间），跨设备或文件系统不支持时复制。"""
+    tmp = dest.with_name(dest.name + '.part')
+    if tmp.exists():
+        tmp.unlink()
+    try:
+        os.link(src, tmp)
+    except OSError:
+        shutil.copy2(src, tmp)
+    os.replace(tmp, dest)
+
+
+class UgoiraCache:
+    """
+    动图转换结果的内容缓存。
+    - 输出：按 (作品 ID, 版本, 格式, 编码参数) 缓存，命中时直接硬链接到下载目录，无需下载与编码。
+    - 源 zip（可选）：按 (作品 ID, 版本) 缓存 zip 与帧信息，换参数重新编码时不必再访问网络。
+    总大小超过上限时按最近使用时间淘汰。
+    """
+
+    def __init__(self, root: str, max_bytes: int, keep_zip: bool = False):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self.keep_zip = keep_zip
+        self.hits = 0
+        self.zip_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.root.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(str(self.root / 'index.sqlite3'), isolation_level=None, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute(
+            '''CREATE TABLE IF NOT EXISTS entries (
+                key TEXT PRIMARY KEY,
+                filename TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                frames TEXT,
+                last_used REAL NOT NULL
+            )'''
+        )
+        self._conn.execute('CREATE INDEX IF NOT EXISTS idx_entries_last_used ON entries (last_used)')
+
+    @staticmethod
+    def _digest(parts: Dict[str, Any]) -> str:
+        return hashlib.sha256(json.dumps(parts, sort_keys=True).encode('utf-8')).hexdigest()[:32]
+
+    @staticmethod
+    def output_key(illust_id: int, revision: str, format: str, params: Dict[str, Any]) -> str:
+        relevant = {name: params.get(name) for name in _FORMAT_PARAMS.get(format, ())}
+        return 'out-' + UgoiraCache._digest({'id': illust_id, 'rev': revision, 'format': format, 'params': relevant})
+
+    @staticmethod
+    def zip_key(illust_id: int, revision: str) -> str:
+        return 'zip-' + UgoiraCache._digest({'id': illust_id, 'rev': revision})
+
+    def _lookup(self, key: str) -> Optional[Tuple[Path, Optional[str]]]:
+        row = self._conn.execute('SELECT filename, frames FROM entries WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        path = self.root / row[0]
+        if not path.exists():
+            self._conn.execute('DELETE FROM entries WHERE key = ?', (key,))
+            return None
+        self._conn.execute('UPDATE entries SET last_used = ? WHERE key = ?', (time.time(), key))
+        return path, row[1]
+
+    def fetch_output(self, key: str, dest: Path) -> bool:
+        """命中时将缓存的输出链接到 dest 并返回 True。"""
+        found = self._lookup(key)
+        if found is None:
+            self.misses += 1
+            return False
+        link_or_copy(found[0], dest)
+        self.hits += 1
+        return True
+
+    def fetch_zip(self, key: str, dest: Path) -> Optional[List[Dict]]:
+        """命中时将缓存的 zip 链接到 dest，并返回其帧信息。"""
+        if not self.keep_zip:
+            return None
+        found = self._lookup(key)
+        if found is None:
+            return None
+        link_or_copy(found[0], dest)
+        self.zip_hits += 1
+        return json.loads(found[1]) if found[1] else None
+
+    def _store(self, key: str, src: Path, suffix: str, frames: Optional[List[Dict]] = None) -> None:
+        filename = key + suffix
+        try:
+            link_or_copy(src, self.root / filename)
+        except OSError as e:
+            logger.warning(f"写入动图缓存失败: {e}")
+            return
+        self._conn.execute(
+            'INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)',
+            (key, filename, src.stat().st_size, json.dumps(frames) if frames is not None else None, time.time()),
+        )
+        self._evict()
+
+    def store_output(self, key: str, src: Path) -> None:
+        self._store(key, src, src.suffix)
+
+    def store_zip(self, key: str, src: Path, frames: List[Dict]) -> None:
+        if self.keep_zip:
+            self._store(key, src, '.zip', frames)
+
+    def total_bytes(self) -> int:
+        return self._conn.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+
+    def _evict(self) -> None:
+        total = self.total_bytes()
+        if total <= self.max_bytes:
+            return
+        for key, filename, size in self._conn.execute(
+            'SELECT key, filename, size FROM entries ORDER BY last_used'
+        ).fetchall():
+            if total <= self.max_bytes:
+                break
+            try:
+                (self.root / filename).unlink()
+            except FileNotFoundError:
+                pass
+            self._conn.execute('DELETE FROM entries WHERE key = ?', (key,))
+            total -= size
+            self.evictions += 1
+
+    def stats(self) -> Dict[str, Any]:
+        count = self._conn.execute('SELECT COUNT(*) FROM entries').fetchone()[0]
+        return {
+            "entries": count,
+            "bytes": self.total_bytes(),
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "zip_hits": self.zip_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+    def close(self) -> None:
+        try:
+            self._conn.close()
+        except sqlite3.Error as e:
+            logger.warning(f"关闭动图缓存索引失败: {e}")
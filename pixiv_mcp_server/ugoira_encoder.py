@@ -0,0 +1,113 @@
+import asyncio
+import functools
+import os
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+from typing import Dict, List, Optional, Tuple
+
+from PIL import Image, features
+
+# 本模块会在子进程中被导入，因此只依赖 Pillow 与标准库，不引入服务器状态
+
+_executor: Optional[ProcessPoolExecutor] = None
+_executor_workers = 0
+
+
+def has_webp_support() -> bool:
+    return features.check('webp')
+
+
+def _resample_to_fps(frame_indices: List[int], delays: List[int], fps: int) -> Tuple[List[int], List[int]]:
+    """按固定帧率重新采样：每个输出时刻取当时正在显示的原始帧。"""
+    total_ms = sum(delays)
+    interval = 1000 / fps
+    indices: List[int] = []
+    elapsed, current = 0, 0
+    t = 0.0
+    while t < total_ms or not indices:
+        while current < len(delays) - 1 and t >= elapsed + delays[current]:
+            elapsed += delays[current]
+            current += 1
+        indices.append(frame_indices[current])
+        t += interval
+    return indices, [round(interval)] * len(indices)
+
+
+def encode_ugoira(
+    zip_path: str,
+    frames: List[Dict],
+    output_path: str,
+    format: str,
+    webp_quality: int = 80,
+    webp_lossless: bool = False,
+    gif_fps: Optional[int] = None,
+) -> str:
+    """
+    用 Pillow 将 Ugoira 的 zip 帧编码为动画 WebP/GIF（同步执行，供进程池调用）。
+    帧时长取自元数据中的 delay；指定 gif_fps 时 GIF 按固定帧率重新采样。
+    先写入临时文件再重命名，避免不完整的输出被当作已完成的作品。
+    """
+    temp_path = output_path + '.part'
+
+    with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+        images = []
+        for frame in frames:
+            with Image.open(BytesIO(zip_ref.read(frame['file']))) as im:
+                images.append(im.convert('RGB'))
+    delays = [max(1, int(frame['delay'])) for frame in frames]
+
+    if format == 'webp':
+        images[0].save(
+            temp_path,
+            format='WEBP',
+            save_all=True,
+            append_images=images[1:],
+            duration=delays,
+            loop=0,
+            quality=webp_quality,
+            lossless=webp_lossless,
+        )
+    else:  # 默认为 gif
+        order = list(range(len(images)))
+        if gif_fps:
+            order, delays = _resample_to_fps(order, delays, gif_fps)
+        # 每帧独立生成自适应调色板，与 FFmpeg 路径的 palettegen=stats_mode=single 一致
+        palettized = {i: images[i].quantize(colors=256, method=Image.Quantize.MEDIANCUT) for i in set(order)}
+        sequence = [palettized[i] for i in order]
+        sequence[0].save(
+            temp_path,
+            format='GIF',
+            save_all=True,
+            append_images=sequence[1:],
+            duration=delays,
+            loop=0,
+            disposal=1,
+        )
+    os.replace(temp_path, output_path)
+    return output_path
+
+
+def get_executor(max_workers: int) -> ProcessPoolExecutor:
+    """惰性创建编码进程池。CPU 并发上限调大后换用更大的进程池，旧池中的任务照常完成。"""
+    global _executor, _executor_workers
+    max_workers = max(1, max_workers)
+    if _executor is None or max_workers > _executor_workers:
+        if _executor is not None:
+            _executor.shutdown(wait=False)
+        _executor = ProcessPoolExecutor(max_workers=max_workers)
+        _executor_workers = max_workers
+    return _executor
+
+
+async def encode_ugoira_in_pool(max_workers: int, **kwargs) -> str:
+    """在进程池中运行 encode_ugoira，不阻塞事件循环。"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_executor(max_workers), functools.partial(encode_ugoira, **kwargs))
+
+
+def shutdown_executor() -> None:
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
@@ -4,9 +4,10 @@ import re
 import subprocess
 import sys
 import json
-from typing import Callable, Optional, List, Dict, Any
+from typing import Callable, Optional, List, Dict, Any, Tuple
 from urllib.parse import quote_plus
 
+from .config import settings
 from .state import state
 
 logger = logging.getLogger('pixiv-mcp-server')
@@ -23,9 +24,21 @@ def check_ffmpeg() -> bool:
         logger.info("FFmpeg 已检测 - GIF 转换功能可用")
         return True
     except (subprocess.CalledProcessError, FileNotFoundError):
-        logger.warning("未找到 FFmpeg - GIF 转换功能已禁用")
+        logger.warning("未找到 FFmpeg - 动图将改用 Pillow 备用编码器")
         return False
 
+def ffmpeg_version() -> Optional[Tuple[int, int]]:
+    """返回 FFmpeg 的 (主版本, 次版本)；未安装或无法解析（如 git 构建）时返回 None。"""
+    try:
+        creationflags = 0
+        if sys.platform == 'win32':
+            creationflags = subprocess.CREATE_NO_WINDOW
+        result = subprocess.run(['ffmpeg', '-version'], capture_output=True, text=True, creationflags=creationflags)
+    except (OSError, subprocess.SubprocessError):
+        return None
+    match = re.match(r'ffmpeg version n?(\d+)\.(\d+)', result.stdout)
+    return (int(match.group(1)), int(match.group(2))) if match else None
+
 def handle_api_error(response: dict) -> Optional[str]:
     """处理来自 Pixiv API 的错误响应并格式化"""
     if not response:
@@ -82,6 +95,9 @@ def require_authentication(func: Callable) -> Callable:
     """
     @functools.wraps(func)
     async def wrapper(*args, **kwargs):
+        # 启动时认证在后台进行，首个请求可能在认证完成前到达
+        if not state.is_authenticated and state.refresh_token and state.token_refresher:
+            await state.token_refresher.wait_ready()
         if not state.is_authenticated:
             return {"ok": False, "error": "此功能需要认证。请在客户端配置 PIXIV_REFRESH_TOKEN 环境变量或确保认证成功。"}
         return await func(*args, **kwargs)
@@ -115,11 +131,29 @@ def _build_proxy_base() -> Optional[str]:
     return f"http://{host}:{port}/pximg?url="
 
 
-def inject_proxy_urls_into_illust(illust: Dict[str, Any]) -> None:
-    """为单个插画对象注入 proxy_urls 字段（就地修改）。"""
+# 原图缩略版本（proxy_urls['original_previews']）的最大边长，与 Pixiv 的 large 尺寸相当
+ORIGINAL_PREVIEW_SIZE = 1200
+
+
+def _rendition_query(size: int) -> str:
+    """代理缩略图参数：在 size x size 内等比缩放并按配置的格式与质量转码。"""
+    return (
+        f"&w={size}&h={size}"
+        f"&fmt={settings.preview_thumbnail_format}&q={settings.preview_thumbnail_quality}"
+    )
+
+
+def inject_proxy_urls_into_illust(illust: Dict[str, Any], thumbnail_size: Optional[int] = None) -> None:
+    """
+    为单个插画对象注入 proxy_urls 字段（就地修改）。
+    thumbnail_size（默认取 PREVIEW_THUMBNAIL_SIZE）大于 0 时，卡片预览（square_medium / medium）
+    请求代理缩放转码后的版本，并额外提供原图的缩略版本 original_previews。
+    """
     base = _build_proxy_base()
     if not base or not isinstance(illust, dict):
         return
+    if thumbnail_size is None:
+        thumbnail_size = settings.preview_thumbnail_size
     try:
         proxy_urls: Dict[str, Any] = {}
         imgs = illust.get('image_urls') or {}
@@ -127,6 +161,8 @@ def inject_proxy_urls_into_illust(illust: Dict[str, Any]) -> None:
             url = imgs.get(key)
             if url:
                 proxy_urls[key] = base + quote_plus(url)
+                if thumbnail_size > 0 and key != 'large':
+                    proxy_urls[key] += _rendition_query(thumbnail_size)
 
         # 原图（单页或多页）
         originals: List[str] = []
@@ -140,6 +176,10 @@ def inject_proxy_urls_into_illust(illust: Dict[str, Any]) -> None:
                     originals.append(ou)
         if originals:
             proxy_urls['originals'] = [base + quote_plus(u) for u in originals]
+            if thumbnail_size > 0:
+                proxy_urls['original_previews'] = [
+                    base + quote_plus(u) + _rendition_query(ORIGINAL_PREVIEW_SIZE) for u in originals
+                ]
 
         if proxy_urls:
             illust['proxy_urls'] = proxy_urls
@@ -290,6 +330,21 @@ def _get_next_params(current_params: Dict[str, Any], total_count: Optional[int]
     return next_params
 
 
+def _visible_cards(cards: List[Dict[str, Any]], show_nsfw: bool) -> List[Dict[str, Any]]:
+    if show_nsfw:
+        return cards
+    return [card for card in cards if not card.get('nsfw', False)]
+
+
+def displayed_preview_urls(cards: List[Dict[str, Any]], show_nsfw: bool = False, max_items: int = 10) -> List[str]:
+    """render_cards_to_markdown 实际会嵌入的预览链接（按显示顺序）。"""
+    return [
+        card['preferred_preview']
+        for card in _visible_cards(cards, show_nsfw)[:max_items]
+        if not card.get('nsfw', False) and card.get('preferred_preview')
+    ]
+
+
 def render_cards_to_markdown(cards: List[Dict[str, Any]], title: str = "作品列表", 
                            show_nsfw: bool = False, max_items: int = 10) -> str:
     """将卡片列表渲染为 Markdown 格式。"""
@@ -297,8 +352,7 @@ def render_cards_to_markdown(cards: List[Dict[str, Any]], title: str = "作品
         return f"## {title}\n\n暂无内容。"
     
     # 过滤 NSFW 内容
-    if not show_nsfw:
-        cards = [card for card in cards if not card.get('nsfw', False)]
+    cards = _visible_cards(cards, show_nsfw)
     
     # 限制显示数量
     display_cards = cards[:max_items]
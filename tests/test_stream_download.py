@@ -0,0 +1,151 @@
+import asyncio
+import random
+import tempfile
+import unittest
+from pathlib import Path
+
+from aiohttp import web
+
+from pixiv_mcp_server.stream_download import StreamDownloader
+
+SEND_CHUNK = 16 * 1024
+
+
+class FlakyImageServer:
+    """支持 Range / If-Range 的本地图片服务器；前 drops 个响应在 drop_bytes 字节后断开。"""
+
+    def __init__(self, body: bytes, etag: str = '"v1"', drops: int = 0, drop_bytes: int = 0, delay: float = 0.0):
+        self.body = body
+        self.etag = etag
+        self.drops = drops
+        self.drop_bytes = drop_bytes
+        self.delay = delay
+        self.requests = []
+        self._runner = None
+        self.url = None
+
+    async def handle(self, request: web.Request) -> web.StreamResponse:
+        self.requests.append({'range': request.headers.get('Range'), 'if_range': request.headers.get('If-Range')})
+        start = 0
+        if request.http_range.start is not None and request.headers.get('If-Range') == self.etag:
+            start = request.http_range.start
+        body = self.body
+        response = web.StreamResponse(status=206 if start else 200)
+        response.content_length = len(body) - start
+        response.headers['ETag'] = self.etag
+        if start:
+            response.headers['Content-Range'] = f'bytes {start}-{len(body) - 1}/{len(body)}'
+        await response.prepare(request)
+
+        limit = len(body)
+        if len(self.requests) <= self.drops:
+            limit = min(limit, start + self.drop_bytes)
+        for offset in range(start, limit, SEND_CHUNK):
+            await response.write(body[offset:min(offset + SEND_CHUNK, limit)])
+            if self.delay:
+                await asyncio.sleep(self.delay)
+        if limit < len(body):
+            # 留出时间让客户端读完已发送的数据，否则缓冲区中的字节会随连接错误一起丢弃
+            await asyncio.sleep(0.1)
+            request.transport.close()
+            return response
+        await response.write_eof()
+        return response
+
+    async def start(self) -> None:
+        app = web.Application()
+        app.add_routes([web.get('/{tail:.*}', self.handle)])
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f'http://127.0.0.1:{port}/img-original/image.png'
+
+    async def stop(self) -> None:
+        await self._runner.cleanup()
+
+
+class StreamDownloaderResumeTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        self._tmp = tempfile.TemporaryDirectory()
+        self.dest = Path(self._tmp.name) / 'image.png'
+        self.body = random.Random(0).randbytes(256 * 1024)
+        self.downloader = StreamDownloader(chunk_size=SEND_CHUNK, max_retries=3)
+
+    async def asyncTearDown(self) -> None:
+        await self.downloader.close()
+        self._tmp.cleanup()
+
+    async def _serve(self, **kwargs) -> FlakyImageServer:
+        server = FlakyImageServer(self.body, **kwargs)
+        await server.start()
+        self.addAsyncCleanup(server.stop)
+        return server
+
+    def _leftovers(self):
+        return sorted(p.name for p in self.dest.parent.glob(self.dest.name + '.part*'))
+
+    async def test_resume_sends_if_range_with_stored_validator(self):
+        server = await self._serve(drops=1, drop_bytes=100 * 1024)
+
+        self.assertTrue(await self.downloader.download(server.url, self.dest))
+
+        self.assertEqual(self.dest.read_bytes(), self.body)
+        self.assertEqual(self.downloader.resumed, 1)
+        self.assertEqual(server.requests[1], {'range': f'bytes={100 * 1024}-', 'if_range': '"v1"'})
+        self.assertEqual(self._leftovers(), [])
+
+    async def test_changed_resource_restarts_from_zero(self):
+        server = await self._serve(drops=1, drop_bytes=100 * 1024)
+        new_body = random.Random(1).randbytes(200 * 1024)
+
+        async def replace_after_drop():
+            while len(server.requests) < 1:
+                await asyncio.sleep(0.01)
+            server.body, server.etag = new_body, '"v2"'
+
+        changer = asyncio.create_task(replace_after_drop())
+        self.assertTrue(await self.downloader.download(server.url, self.dest))
+        await changer
+
+        self.assertEqual(self.dest.read_bytes(), new_body)
+        self.assertEqual(self.downloader.resumed, 0)
+        self.assertEqual(server.requests[1]['if_range'], '"v1"')
+
+    async def test_part_without_validator_is_not_resumed(self):
+        server = await self._serve()
+        self.dest.with_name(self.dest.name + '.part').write_bytes(b'stale bytes from another version')
+
+        self.assertTrue(await self.downloader.download(server.url, self.dest))
+
+        self.assertEqual(self.dest.read_bytes(), self.body)
+        self.assertIsNone(server.requests[0]['range'])
+
+    async def test_concurrent_downloads_of_one_dest_share_the_part_file(self):
+        server = await self._serve(delay=0.005)
+
+        results = await asyncio.gather(
+            self.downloader.download(server.url, self.dest),
+            self.downloader.download(server.url, self.dest),
+        )
+
+        self.assertEqual(sorted(results), [False, True])
+        self.assertEqual(len(server.requests), 1)
+        self.assertEqual(self.dest.read_bytes(), self.body)
+
+    async def test_cancel_keeps_part_until_discarded(self):
+        server = await self._serve(delay=0.02)
+        task = asyncio.create_task(self.downloader.download(server.url, self.dest))
+        while not self.dest.with_name(self.dest.name + '.part').exists():
+            await asyncio.sleep(0.01)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+        self.assertEqual(self._leftovers(), ['image.png.part', 'image.png.part.json'])
+        self.downloader.discard(self.dest)
+        self.assertEqual(self._leftovers(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()